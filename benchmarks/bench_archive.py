@@ -0,0 +1,65 @@
+"""Compare the latency of Archive.archive() with and without the
+single-statement PostgreSQL path.
+
+Usage: python benchmarks/bench_archive.py DB_STRING [REPEAT] [DELAY_MS]
+
+DB_STRING must name a PostgreSQL database.  The benchmark creates the
+repozitory tables if necessary and commits one warm-up version per run;
+the timed versions are rolled back.
+DELAY_MS adds a simulated round trip time to every statement.
+"""
+
+from latency import StatementCounter
+from latency import timed
+from repozitory.archive import Archive
+from repozitory.archive import EngineParams
+import datetime
+import sys
+import transaction
+
+
+class ObjectVersion(object):
+    path = u'/bench'
+    created = datetime.datetime(2012, 1, 1)
+    modified = datetime.datetime(2012, 1, 2)
+    title = u'Benchmark'
+    description = u'An object archived by the benchmark.'
+    attrs = {'text': u'x' * 1000}
+    blobs = None
+    user = u'bench'
+    comment = None
+
+    def __init__(self, docid):
+        self.docid = docid
+
+
+def run(archive, counter, fast_path, repeat, docid_base):
+    archive.postgresql_fast_path = fast_path
+    # Warm up the session and the class ID cache.
+    archive.archive(ObjectVersion(docid_base))
+    transaction.commit()
+    counter.count = 0
+
+    def archive_new_version(i):
+        archive.archive(ObjectVersion(docid_base + i % 10))
+    elapsed = timed(archive_new_version, repeat)
+    statements = float(counter.count) / repeat
+    transaction.abort()
+    return elapsed, statements
+
+
+def main():
+    db_string = sys.argv[1]
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    delay = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.0
+    archive = Archive(EngineParams(db_string))
+    counter = StatementCounter(archive.session.bind, delay)
+    for fast_path, docid_base in ((False, 1000000000), (True, 1000000100)):
+        elapsed, statements = run(
+            archive, counter, fast_path, repeat, docid_base)
+        print('fast path %-5s: %8.3f ms/archive, %.1f statements/archive' % (
+            fast_path, elapsed * 1000, statements))
+
+
+if __name__ == '__main__':
+    main()
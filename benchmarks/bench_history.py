@@ -0,0 +1,94 @@
+"""Compare the latency of Archive.history() and Archive.get_version()
+with the three-query approach they used to take.
+
+Usage: python benchmarks/bench_history.py DB_STRING [REPEAT] [DELAY_MS]
+
+The benchmark creates the repozitory tables if necessary and archives
+a few versions of an object, then rolls them back at the end.
+DELAY_MS adds a simulated round trip time to every statement.
+"""
+
+from latency import StatementCounter
+from latency import timed
+from repozitory.archive import Archive
+from repozitory.archive import EngineParams
+from repozitory.archive import ObjectHistoryRecord
+from repozitory.schema import ArchivedCurrent
+from repozitory.schema import ArchivedObject
+from repozitory.schema import ArchivedState
+import datetime
+import sys
+import transaction
+
+docid = 1000000200
+versions = 20
+
+
+class ObjectVersion(object):
+    path = u'/bench'
+    created = datetime.datetime(2012, 1, 1)
+    modified = datetime.datetime(2012, 1, 2)
+    title = u'Benchmark'
+    description = u'An object archived by the benchmark.'
+    attrs = {'text': u'x' * 1000}
+    blobs = None
+    user = u'bench'
+    comment = None
+
+    def __init__(self, docid):
+        self.docid = docid
+
+
+def separate_queries(archive, version_num=None):
+    """Load history records the way history() and get_version() used to."""
+    session = archive.session
+    created = (session.query(ArchivedObject.created)
+        .filter_by(docid=docid)
+        .scalar())
+    current_version = (session.query(ArchivedCurrent.version_num)
+        .filter_by(docid=docid)
+        .scalar())
+    q = session.query(ArchivedState).filter_by(docid=docid)
+    if version_num is not None:
+        q = q.filter_by(version_num=version_num)
+    rows = q.order_by(ArchivedState.version_num.desc()).all()
+    return [ObjectHistoryRecord(row, created, current_version)
+        for row in rows]
+
+
+def run(archive, counter, func, repeat):
+    counter.count = 0
+
+    def call(i):
+        func()
+        archive.session.expunge_all()
+    elapsed = timed(call, repeat)
+    return elapsed, float(counter.count) / repeat
+
+
+def main():
+    db_string = sys.argv[1]
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    delay = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.0
+    archive = Archive(EngineParams(db_string))
+    counter = StatementCounter(archive.session.bind, delay)
+    for i in range(versions):
+        archive.archive(ObjectVersion(docid))
+    tests = (
+        ('history, separate queries', lambda: separate_queries(archive)),
+        ('history()', lambda: archive.history(docid)),
+        ('get_version, separate queries',
+            lambda: separate_queries(archive, 1)),
+        ('get_version()', lambda: archive.get_version(docid, 1)),
+    )
+    try:
+        for name, func in tests:
+            elapsed, statements = run(archive, counter, func, repeat)
+            print('%-30s: %8.3f ms/call, %.1f statements/call' % (
+                name, elapsed * 1000, statements))
+    finally:
+        transaction.abort()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+"""Helpers for benchmarking repozitory with simulated network latency."""
+
+from sqlalchemy import event
+import time
+
+
+class StatementCounter(object):
+    """Counts the statements executed by an engine.
+
+    If delay is nonzero, each statement also sleeps for that many seconds
+    to simulate the round trip to a remote database server.
+    """
+
+    def __init__(self, engine, delay=0.0):
+        self.count = 0
+        self.delay = delay
+        event.listen(engine, 'before_cursor_execute', self._before)
+
+    def _before(self, conn, cursor, statement, parameters, context,
+            executemany):
+        self.count += 1
+        if self.delay:
+            time.sleep(self.delay)
+
+
+def timed(func, repeat):
+    """Call func repeat times.  Return the mean time per call in seconds."""
+    start = time.time()
+    for i in xrange(repeat):
+        func(i)
+    return (time.time() - start) / repeat
@@ -1,39 +1,84 @@
 
-from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 from perfmetrics import metricmethod
+from repozitory.chunking import iter_content_chunks
+from repozitory.cache import LRUCache
+from repozitory.compression import compress_chunk
+from repozitory.compression import decompress_chunk
+from repozitory.compression import looks_compressed
+from repozitory.delta import apply_delta
+from repozitory.delta import load_attrs
+from repozitory.delta import make_delta
 from repozitory.interfaces import IArchive
 from repozitory.interfaces import IContainerRecord
 from repozitory.interfaces import IDeletedItem
 from repozitory.interfaces import IObjectHistoryRecord
+from repozitory.schema import ArchivedBlobChunk
 from repozitory.schema import ArchivedBlobInfo
 from repozitory.schema import ArchivedBlobLink
 from repozitory.schema import ArchivedChunk
 from repozitory.schema import ArchivedClass
 from repozitory.schema import ArchivedContainer
 from repozitory.schema import ArchivedCurrent
+from repozitory.schema import ArchivedGeneration
 from repozitory.schema import ArchivedItem
 from repozitory.schema import ArchivedItemDeleted
 from repozitory.schema import ArchivedObject
+from repozitory.schema import ArchivedSharedChunk
 from repozitory.schema import ArchivedState
 from repozitory.schema import Base
+from repozitory.staging import DigestedBlob
+from repozitory.staging import StagedBlob
+from repozitory.staging import TrustedBlob
+from repozitory.upgrade import upgrade
+from sqlalchemy import and_
 from sqlalchemy import func
+from sqlalchemy import or_
 from sqlalchemy.engine import create_engine
+from sqlalchemy.orm import defer
+from sqlalchemy.orm import lazyload
+from sqlalchemy.orm import object_session
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm.session import sessionmaker
+from sqlalchemy.orm.util import identity_key
+from sqlalchemy.sql.expression import bindparam
+from sqlalchemy.sql.expression import text
 from zope.interface import implements
 from zope.sqlalchemy import ZopeTransactionExtension
+from zope.sqlalchemy import mark_changed
+import bisect
 import datetime
 import hashlib
 import logging
-import tempfile
+import simplejson as json
+import sys
+import threading
+import time
+import transaction
+import weakref
 
 _global_sessions = {}  # {db_string: SQLAlchemy session}
+_postgresql_archive_statements = {}  # {(column_name,): text clause}
+_class_ids = {}  # {db_string: {(module, name): (class, class_id)}}
+_hash_pools = {}  # {size: ThreadPool}
+_hash_pools_lock = threading.Lock()
+# _pending_class_keys holds the classes added by uncommitted transactions.
+_pending_class_keys = weakref.WeakKeyDictionary()  # {txn: set([key])}
+_version_caches = {}  # {(max_entries, max_bytes): LRUCache}
+_history_caches = {}  # {(max_entries, max_bytes): LRUCache}
+_version_caches_lock = threading.Lock()
+# _written_docids holds the objects changed by uncommitted transactions.
+_written_docids = weakref.WeakKeyDictionary()  # {txn: set([(db, docid)])}
+_chunk_fetch_window = 4  # Max chunks per query when streaming a blob
 
 log = logging.getLogger(__name__)
 
 
 def forget_sessions():
     _global_sessions.clear()
+    _class_ids.clear()
+    _version_caches.clear()
+    _history_caches.clear()
 
 
 class EngineParams(object):
@@ -58,6 +103,166 @@ def find_class(module, name):
     return getattr(m, name, None)
 
 
+def _get_hash_pool(size):
+    """Get the thread pool used to stage blobs concurrently."""
+    pool = _hash_pools.get(size)
+    if pool is None:
+        _hash_pools_lock.acquire()
+        try:
+            pool = _hash_pools.get(size)
+            if pool is None:
+                _hash_pools[size] = pool = ThreadPool(size)
+        finally:
+            _hash_pools_lock.release()
+    return pool
+
+
+def _get_cache(caches, max_entries, max_bytes, metric_prefix):
+    """Get a cache shared by archives with the same limits."""
+    key = (max_entries, max_bytes)
+    cache = caches.get(key)
+    if cache is None:
+        _version_caches_lock.acquire()
+        try:
+            cache = caches.get(key)
+            if cache is None:
+                caches[key] = cache = LRUCache(
+                    max_entries, max_bytes, metric_prefix)
+        finally:
+            _version_caches_lock.release()
+    return cache
+
+
+def _get_version_cache(max_entries, max_bytes):
+    """Get the cache of versions shared by archives with the same limits."""
+    return _get_cache(_version_caches, max_entries, max_bytes,
+        'repozitory.version_cache')
+
+
+def _get_history_cache(max_entries, max_bytes):
+    """Get the cache of histories shared by archives with the same limits."""
+    return _get_cache(_history_caches, max_entries, max_bytes,
+        'repozitory.history_cache')
+
+
+def _discard_cached_versions(success, db_string, docids):
+    """Remove the cached versions of some objects.
+
+    Called after a transaction that shredded the objects.
+    """
+    if success:
+        docids = frozenset(docids)
+        for cache in _version_caches.values():
+            cache.discard_matching(
+                lambda key: key[0] == db_string and key[1] in docids)
+
+
+def _discard_cached_histories(success, written):
+    """Remove the cached histories of objects changed by a transaction.
+
+    written is a set of (db_string, docid).
+    """
+    if success and written:
+        for cache in _history_caches.values():
+            cache.discard_matching(lambda key: key[:2] in written)
+
+
+def blob_store_key(blob):
+    """Get the key of an ArchivedBlobInfo in a blob store."""
+    if blob.digest:
+        return blob.digest
+    return 'sha256:%s' % blob.sha256
+
+
+def _delete_stored_blobs(success, blob_store, keys):
+    if success:
+        for key in keys:
+            try:
+                blob_store.delete(key)
+            except Exception:
+                log.exception("Unable to delete blob %s", key)
+
+
+def _delete_aborted_blobs(blob_store, keys):
+    """Delete the blobs stored by a transaction that was aborted."""
+    _delete_stored_blobs(True, blob_store, keys)
+
+
+def _get_postgresql_archive_statement(dialect, names):
+    """Get the statement used by Archive._archive_postgresql().
+
+    names is the sorted list of archived_state columns to set from
+    parameters.  Each column is set from a parameter named s_<column>.
+    """
+    key = tuple(names)
+    stmt = _postgresql_archive_statements.get(key)
+    if stmt is not None:
+        return stmt
+
+    state_t = ArchivedState.__table__
+    q = dialect.identifier_preparer.quote_identifier
+    sql = """
+    WITH obj AS (
+        INSERT INTO archived_object (docid, created, latest_version)
+        VALUES (:s_docid, :created, 1)
+        ON CONFLICT (docid) DO UPDATE SET latest_version = COALESCE(
+            archived_object.latest_version,
+            (SELECT max(version_num) FROM archived_state
+                WHERE docid = :s_docid),
+            0) + 1
+        RETURNING latest_version
+    ), prev AS (
+        SELECT version_num FROM archived_current
+        WHERE docid = :s_docid
+        FOR UPDATE
+    ), state AS (
+        INSERT INTO archived_state (version_num, derived_from_version, %s)
+        SELECT obj.latest_version, (SELECT version_num FROM prev), %s
+        FROM obj
+        RETURNING version_num
+    ), cur AS (
+        INSERT INTO archived_current (docid, version_num)
+        SELECT :s_docid, version_num FROM state
+        ON CONFLICT (docid) DO UPDATE SET version_num = EXCLUDED.version_num
+    ), gen AS (
+        INSERT INTO archived_generation (docid, generation, shred_count)
+        VALUES (:s_docid, 1, 0)
+        ON CONFLICT (docid) DO UPDATE
+        SET generation = archived_generation.generation + 1
+    )
+    SELECT version_num FROM state
+    """ % (
+        ', '.join(q(name) for name in names),
+        ', '.join(':s_%s' % name for name in names),
+    )
+    stmt = text(sql, bindparams=[
+        bindparam('s_%s' % name, type_=state_t.c[name].type)
+        for name in names])
+    _postgresql_archive_statements[key] = stmt
+    return stmt
+
+
+_postgresql_bump_generations = text("""
+    INSERT INTO archived_generation (docid, generation, shred_count)
+    SELECT docid, 1, :shred_count
+    FROM unnest(CAST(:docids AS BIGINT[])) AS docid
+    ON CONFLICT (docid) DO UPDATE SET
+        generation = archived_generation.generation + 1,
+        shred_count = archived_generation.shred_count + EXCLUDED.shred_count
+    """)
+
+
+def _has_postgresql_upsert(session):
+    """Return True if the database supports INSERT ... ON CONFLICT."""
+    dialect = session.bind.dialect
+    if dialect.name != 'postgresql':
+        return False
+    # INSERT ... ON CONFLICT requires PostgreSQL 9.5.  The dialect
+    # learns the server version when the first connection is made.
+    session.connection()
+    return dialect.server_version_info >= (9, 5)
+
+
 class Archive(object):
     """An object archive that uses SQLAlchemy.
 
@@ -67,6 +272,24 @@ class Archive(object):
     implements(IArchive)
 
     chunk_size = 1048576    # Store blobs in chunks of this size
+    blob_spool_size = 1048576  # Stage larger blobs on disk while hashing
+    hash_threads = 4  # Number of threads that hash the blobs of a version
+    blob_digest = None  # Match blobs by this digest instead of MD5+SHA-256
+    trust_blob_digests = False  # Use DigestedBlob digests without hashing
+    chunk_codec = None  # Compress chunks with this codec, such as 'zlib'
+    content_defined_chunking = False  # Share chunks of similar blobs; ~10 MB/s
+    blob_store = None  # An IBlobStore that holds the data of new blobs
+    _shared_chunk_batch = 16  # Look up this many shared chunks at a time
+    docid_batch_size = 500  # Max number of docids (or pairs) per query
+    postgresql_fast_path = True  # Use _archive_postgresql when possible
+    skip_unchanged = False  # Don't store a version identical to the current
+    attrs_snapshot_interval = None  # Store attrs deltas between snapshots
+    class_id_cache_size = 1000  # Max number of class IDs to cache per DB
+    version_cache_size = 0  # Max number of versions to cache (0 disables)
+    version_cache_bytes = 16777216  # Max total size of cached versions
+    history_cache_size = 0  # Max number of histories to cache (0 disables)
+    history_cache_bytes = 16777216  # Max total size of cached histories
+    history_cache_check_interval = 0  # Seconds between generation checks
 
     def __init__(self, engine_params):
         self.engine_params = engine_params
@@ -85,6 +308,7 @@ class Archive(object):
 
     def _create_session(self, engine):
         Base.metadata.create_all(engine)
+        upgrade(engine)
         # Distinguish sessions by thread.
         session = scoped_session(sessionmaker(
             extension=ZopeTransactionExtension()))
@@ -98,45 +322,482 @@ class Archive(object):
         The object does not need to have been in the archive
         previously.  The object must provide the IObjectVersion interface.
 
-        Returns the new version number.
+        Returns the new version number.  If skip_unchanged is true and
+        the path, title, description, attrs, class, and blobs of the object
+        match the current version, returns the current version number
+        without adding a version.
         """
         docid = obj.docid
         session = self.session
-        max_version = None
+        self._note_written([docid])
+        if self._use_postgresql_fast_path(session):
+            return self._archive_postgresql(obj)
+
+        klass = getattr(obj, 'klass', None)
+        if klass is None:
+            klass = obj.__class__
+        class_id = self._prepare_class_id(klass)
+        # Store the blobs before locking the object row, since hashing
+        # and chunking large blobs can take a while.
+        blob_ids = self._prepare_blob_ids(obj)
+
+        # Lock the object row so that concurrent archivers of the same
+        # object allocate version numbers one at a time.
         arc_obj = (session.query(ArchivedObject)
             .filter_by(docid=docid)
+            .with_lockmode('update')
+            .populate_existing()
             .first())
         if arc_obj is None:
             arc_obj = ArchivedObject(
                 docid=docid,
                 created=obj.created,
+                latest_version=0,
             )
             session.add(arc_obj)
+            arc_current = None
         else:
-            max_version = (
-                session.query(func.max(ArchivedState.version_num))
+            arc_current = (
+                session.query(ArchivedCurrent)
                 .filter_by(docid=docid)
-                .scalar())
-
-        arc_current = (
-            session.query(ArchivedCurrent)
-            .filter_by(docid=docid)
-            .first())
+                .first())
+
+        fingerprint = None
+        if self.skip_unchanged:
+            fingerprint = self._fingerprint(obj, class_id, blob_ids)
+            if arc_current is not None:
+                current_fingerprint = (
+                    session.query(ArchivedState.fingerprint)
+                    .filter_by(docid=docid,
+                        version_num=arc_current.version_num)
+                    .scalar())
+                if current_fingerprint == fingerprint:
+                    # Nothing changed since the current version.
+                    return arc_current.version_num
+
+        version_num = self._get_latest_version(arc_obj) + 1
+        arc_obj.latest_version = version_num
         if arc_current is None:
             derived_from_version = None
         else:
             derived_from_version = arc_current.version_num
 
+        values = self._state_values(
+            obj,
+            version_num=version_num,
+            derived_from_version=derived_from_version,
+            class_id=class_id,
+            archive_time=datetime.datetime.utcnow(),
+            fingerprint=fingerprint,
+        )
+        if self.attrs_snapshot_interval and version_num > 1:
+            key = (docid, version_num - 1)
+            prev = load_attrs(session, [key]).get(key)
+            values.update(self._encode_attrs(obj.attrs, version_num, prev))
+        arc_state = ArchivedState(**values)
+        session.add(arc_state)
+
+        for name, blob_id in blob_ids.items():
+            arc_state.blob_links.append(ArchivedBlobLink(
+                docid=docid,
+                version_num=version_num,
+                name=name,
+                blob_id=blob_id,
+            ))
+
+        if arc_current is None:
+            arc_current = ArchivedCurrent(
+                docid=docid,
+                version_num=version_num,
+            )
+            session.add(arc_current)
+        else:
+            arc_current.version_num = version_num
+        session.flush()
+        self._bump_generations([docid])
+        return version_num
+
+    @metricmethod
+    def archive_many(self, objs):
+        """Add a version to the archive of each of several objects.
+
+        This is equivalent to calling archive() for each object,
+        but it looks up the existing objects, versions, and current
+        version pointers with a fixed number of queries and inserts
+        the new rows in batches.  A docid may appear more than once;
+        later objects in the sequence produce later versions.
+
+        Returns the list of new version numbers, in the order of objs.
+        """
+        objs = list(objs)
+        if not objs:
+            return []
+        session = self.session
+        # Write pending ORM changes before bypassing the ORM.
+        session.flush()
+        docids = set(obj.docid for obj in objs)
+        self._note_written(docids)
+        # Store the blobs before locking the object rows.
+        all_blob_ids = self._prepare_blob_ids_many(objs)
+
+        # Lock the object rows (in a consistent order to avoid deadlocks)
+        # and read the latest version numbers.
+        latest_versions = dict(
+            session.query(ArchivedObject.docid, ArchivedObject.latest_version)
+            .filter(ArchivedObject.docid.in_(docids))
+            .order_by(ArchivedObject.docid)
+            .with_lockmode('update')
+            .all())
+        unknown = [docid for (docid, latest) in latest_versions.items()
+            if latest is None]
+        if unknown:
+            # Some rows were written by repozitory 1.3 or earlier.
+            latest_versions.update(
+                session.query(
+                    ArchivedState.docid, func.max(ArchivedState.version_num))
+                .filter(ArchivedState.docid.in_(unknown))
+                .group_by(ArchivedState.docid)
+                .all())
+        existing = list(latest_versions)
+        current_versions = dict(
+            session.query(ArchivedCurrent.docid, ArchivedCurrent.version_num)
+            .filter(ArchivedCurrent.docid.in_(docids))
+            .all())
+        current_fingerprints = {}
+        if self.skip_unchanged and current_versions:
+            current_fingerprints = dict(
+                session.query(ArchivedState.docid, ArchivedState.fingerprint)
+                .join(ArchivedCurrent, and_(
+                    ArchivedCurrent.docid == ArchivedState.docid,
+                    ArchivedCurrent.version_num == ArchivedState.version_num))
+                .filter(ArchivedCurrent.docid.in_(current_versions))
+                .all())
+        had_current = set(current_versions)
+        changed = set()
+        prev_attrs = {}  # {docid: (base_version, attrs)}
+        if self.attrs_snapshot_interval:
+            for (docid, _), prev in load_attrs(session, [
+                    (docid, latest)
+                    for (docid, latest) in latest_versions.items()
+                    if latest]).items():
+                prev_attrs[docid] = prev
+
+        archive_time = datetime.datetime.utcnow()
+        class_ids = {}    # {klass: class_id}
+        new_objects = {}  # {docid: created}
+        state_rows = []
+        link_rows = []
+        res = []
+        for index, obj in enumerate(objs):
+            docid = obj.docid
+            if docid not in latest_versions:
+                latest_versions[docid] = 0
+                new_objects[docid] = obj.created
+
+            klass = getattr(obj, 'klass', None)
+            if klass is None:
+                klass = obj.__class__
+            class_id = class_ids.get(klass)
+            if class_id is None:
+                class_ids[klass] = class_id = self._prepare_class_id(klass)
+            blob_ids = all_blob_ids[index]
+
+            fingerprint = None
+            if self.skip_unchanged:
+                fingerprint = self._fingerprint(obj, class_id, blob_ids)
+                if (docid in current_versions and
+                        current_fingerprints.get(docid) == fingerprint):
+                    # Nothing changed since the current version.
+                    res.append(current_versions[docid])
+                    continue
+                current_fingerprints[docid] = fingerprint
+
+            version_num = latest_versions[docid] + 1
+            values = self._state_values(
+                obj,
+                version_num=version_num,
+                derived_from_version=current_versions.get(docid),
+                class_id=class_id,
+                archive_time=archive_time,
+                fingerprint=fingerprint,
+            )
+            if self.attrs_snapshot_interval:
+                values.update(self._encode_attrs(
+                    obj.attrs, version_num, prev_attrs.get(docid)))
+                prev_attrs[docid] = (
+                    values['attrs_base'] or version_num, obj.attrs)
+            state_rows.append(values)
+            latest_versions[docid] = version_num
+            current_versions[docid] = version_num
+            changed.add(docid)
+            res.append(version_num)
+
+            for name, blob_id in blob_ids.items():
+                link_rows.append({
+                    'docid': docid,
+                    'version_num': version_num,
+                    'name': name,
+                    'blob_id': blob_id,
+                })
+
+        if not changed:
+            return res
+
+        if new_objects:
+            session.execute(ArchivedObject.__table__.insert(), [{
+                'docid': docid,
+                'created': created,
+                'latest_version': latest_versions[docid],
+            } for docid, created in new_objects.items()])
+        existing = [docid for docid in existing if docid in changed]
+        if existing:
+            t = ArchivedObject.__table__
+            stmt = (t.update()
+                .where(t.c.docid == bindparam('b_docid'))
+                .values(latest_version=bindparam('b_latest_version')))
+            session.execute(stmt, [{
+                'b_docid': docid,
+                'b_latest_version': latest_versions[docid],
+            } for docid in existing])
+        session.execute(ArchivedState.__table__.insert(), state_rows)
+        if link_rows:
+            session.execute(ArchivedBlobLink.__table__.insert(), link_rows)
+
+        insert_rows = []
+        update_rows = []
+        for docid in changed:
+            version_num = current_versions[docid]
+            if docid in had_current:
+                update_rows.append(
+                    {'b_docid': docid, 'b_version_num': version_num})
+            else:
+                insert_rows.append(
+                    {'docid': docid, 'version_num': version_num})
+        if insert_rows:
+            session.execute(ArchivedCurrent.__table__.insert(), insert_rows)
+        if update_rows:
+            t = ArchivedCurrent.__table__
+            stmt = (t.update()
+                .where(t.c.docid == bindparam('b_docid'))
+                .values(version_num=bindparam('b_version_num')))
+            session.execute(stmt, update_rows)
+
+        self._bump_generations(changed)
+        mark_changed(session())
+        # The ORM did not see the statements above, so any ArchivedObject
+        # or ArchivedCurrent instances in the session may be out of date.
+        session.expire_all()
+        return res
+
+    def _archive_postgresql(self, obj):
+        """Archive an object using a single statement on PostgreSQL 9.5+.
+
+        Creates the object row if necessary, allocates the version
+        number, inserts the state, and updates the current version
+        pointer in one round trip.  Blob links, if any, require one
+        more statement.
+        """
+        docid = obj.docid
+        session = self.session
         klass = getattr(obj, 'klass', None)
         if klass is None:
             klass = obj.__class__
         class_id = self._prepare_class_id(klass)
+        blob_ids = self._prepare_blob_ids(obj)
 
-        arc_state = ArchivedState(
-            docid=docid,
-            version_num=(max_version or 0) + 1,
-            derived_from_version=derived_from_version,
+        values = self._state_values(
+            obj,
+            version_num=None,
+            derived_from_version=None,
+            class_id=class_id,
             archive_time=datetime.datetime.utcnow(),
+        )
+        # The statement computes the version numbers.  The other
+        # columns are used only in modes that bypass this statement.
+        for name in ('version_num', 'derived_from_version', 'fingerprint',
+                'attrs_base', 'attrs_delta'):
+            del values[name]
+        stmt = _get_postgresql_archive_statement(
+            session.bind.dialect, sorted(values))
+        params = dict(('s_%s' % name, value)
+            for (name, value) in values.items())
+        params['created'] = obj.created
+        version_num = session.execute(stmt, params).scalar()
+
+        if blob_ids:
+            session.execute(ArchivedBlobLink.__table__.insert(), [{
+                'docid': docid,
+                'version_num': version_num,
+                'name': name,
+                'blob_id': blob_id,
+            } for (name, blob_id) in blob_ids.items()])
+
+        mark_changed(session())
+        # Expire the rows the ORM may have loaded before this statement.
+        for cls in (ArchivedObject, ArchivedCurrent):
+            instance = session.identity_map.get(identity_key(cls, docid))
+            if instance is not None:
+                session.expire(instance)
+        return version_num
+
+    def _use_postgresql_fast_path(self, session):
+        if (not self.postgresql_fast_path or
+                self.skip_unchanged or
+                self.attrs_snapshot_interval):
+            return False
+        return _has_postgresql_upsert(session)
+
+    def _note_written(self, docids):
+        """Record that the current transaction changes some objects.
+
+        Versions and histories of those objects are not cached until
+        the transaction ends, since the transaction might be aborted.
+        Cached histories of the objects are discarded if it commits.
+        """
+        txn = transaction.get()
+        written = _written_docids.get(txn)
+        if written is None:
+            _written_docids[txn] = written = set()
+            txn.addAfterCommitHook(_discard_cached_histories, (written,))
+        db_string = self.engine_params.db_string
+        written.update((db_string, docid) for docid in docids)
+
+    def _bump_generations(self, docids, shredded=False):
+        """Change the generation of some objects.
+
+        Tells other processes that the histories of the objects changed.
+        If shredded is true, also increments the shred_count.  Uses one
+        statement on PostgreSQL 9.5+ and for objects that already have a
+        generation; otherwise up to three.
+        """
+        docids = sorted(docids)
+        if not docids:
+            return
+        session = self.session
+        if self.postgresql_fast_path and _has_postgresql_upsert(session):
+            session.execute(_postgresql_bump_generations, {
+                'docids': docids, 'shred_count': int(bool(shredded))})
+            mark_changed(session())
+            return
+        values = {'generation': ArchivedGeneration.generation + 1}
+        if shredded:
+            values['shred_count'] = ArchivedGeneration.shred_count + 1
+        q = session.query(ArchivedGeneration).filter(
+            ArchivedGeneration.docid.in_(docids))
+        count = q.update(values, False)
+        if count < len(docids):
+            if count:
+                existing = set(docid for (docid,) in session.query(
+                        ArchivedGeneration.docid)
+                    .filter(ArchivedGeneration.docid.in_(docids)))
+            else:
+                # None of the rows exist, as for a single new object.
+                existing = ()
+            session.execute(ArchivedGeneration.__table__.insert(), [
+                {'docid': docid, 'generation': 1,
+                    'shred_count': int(bool(shredded))}
+                for docid in docids if docid not in existing])
+        mark_changed(session())
+
+    def _get_history_cache(self):
+        """Get the history cache, or None if caching is disabled."""
+        if self.history_cache_size <= 0:
+            return None
+        return _get_history_cache(
+            self.history_cache_size, self.history_cache_bytes)
+
+    def _get_generation(self, docid):
+        return (self.session.query(ArchivedGeneration.generation)
+            .filter_by(docid=docid)
+            .scalar())
+
+    def _get_cached_history(self, cache, docid, only_current):
+        """Get the history of an object, using the history cache.
+
+        Returns a list of history records.  A cached history is used if
+        it was checked within history_cache_check_interval seconds or
+        the generation of the object has not changed.
+        """
+        db_string = self.engine_params.db_string
+        key = (db_string, docid, only_current)
+        now = time.time()
+        written = _written_docids.get(transaction.get()) or ()
+        if (db_string, docid) in written:
+            # This transaction changed the history.
+            entry = None
+        else:
+            entry = cache.get(key)
+        generation = None
+        if entry is not None:
+            cached_generation, checked, versions = entry
+            if now - checked >= self.history_cache_check_interval:
+                generation = self._get_generation(docid)
+                if generation == cached_generation:
+                    cache.set(key, (generation, now, versions),
+                        sum(cached.size for (cached, _) in versions))
+                else:
+                    entry = None
+        if entry is not None:
+            session = self.session
+            blob_store = self.blob_store
+            return [CachedObjectHistoryRecord(cached, current_version,
+                    session, blob_store)
+                for (cached, current_version) in versions]
+
+        if generation is None:
+            generation = self._get_generation(docid)
+        q = self._history_query().filter(ArchivedState.docid == docid)
+        if only_current:
+            q = q.filter(
+                ArchivedState.version_num == ArchivedCurrent.version_num)
+        q = q.order_by(ArchivedState.version_num.desc())
+        records = self._make_history_records(q.all())
+        if (db_string, docid) not in written:
+            versions = [(CachedVersion(record), record.current_version)
+                for record in records]
+            cache.set(key, (generation, now, versions),
+                sum(cached.size for (cached, _) in versions))
+        return records
+
+    def _get_version_cache(self):
+        """Get the version cache, or None if caching is disabled."""
+        if self.version_cache_size <= 0:
+            return None
+        return _get_version_cache(
+            self.version_cache_size, self.version_cache_bytes)
+
+    def _cache_versions(self, cache, records):
+        """Add history records to the version cache."""
+        db_string = self.engine_params.db_string
+        written = _written_docids.get(transaction.get()) or ()
+        for record in records:
+            if (db_string, record.docid) in written:
+                continue
+            cached = CachedVersion(record)
+            cache.set((db_string, record.docid, record.version_num),
+                cached, cached.size)
+
+    def _get_latest_version(self, arc_obj):
+        """Get the latest version number of an ArchivedObject."""
+        latest = arc_obj.latest_version
+        if latest is None:
+            # This row was written by repozitory 1.3 or earlier.
+            latest = (self.session.query(func.max(ArchivedState.version_num))
+                .filter_by(docid=arc_obj.docid)
+                .scalar()) or 0
+        return latest
+
+    def _state_values(self, obj, version_num, derived_from_version,
+            class_id, archive_time, fingerprint=None):
+        """Return the column values of an ArchivedState for an object."""
+        return dict(
+            fingerprint=fingerprint,
+            attrs_base=None,
+            attrs_delta=None,
+            docid=obj.docid,
+            version_num=version_num,
+            derived_from_version=derived_from_version,
+            archive_time=archive_time,
             class_id=class_id,
             path=unicode(obj.path),
             modified=obj.modified,
@@ -146,165 +807,707 @@ class Archive(object):
             attrs=obj.attrs,
             comment=unicode_or_none(obj.comment),
         )
-        session.add(arc_state)
 
-        blobs = getattr(obj, 'blobs', None)
-        if blobs:
-            for name, value in blobs.items():
-                self._link_blob(arc_state, name, value)
+    def _encode_attrs(self, attrs, version_num, prev):
+        """Choose how to store attrs when attrs_snapshot_interval is set.
 
-        arc_current = (
-            session.query(ArchivedCurrent)
-            .filter_by(docid=docid)
-            .first())
-        if arc_current is None:
-            arc_current = ArchivedCurrent(
-                docid=docid,
-                version_num=arc_state.version_num,
+        prev is (base_version, attrs) for the previous version of the
+        object, or None.  Returns ArchivedState column values.
+        """
+        if (prev is not None and attrs is not None and prev[1] is not None
+                and version_num - prev[0] < self.attrs_snapshot_interval):
+            return dict(
+                attrs=None,
+                attrs_base=prev[0],
+                attrs_delta=make_delta(prev[1], attrs),
             )
-            session.add(arc_current)
-        else:
-            arc_current.version_num = arc_state.version_num
-        session.flush()
-        return arc_state.version_num
+        return dict(attrs=attrs, attrs_base=None, attrs_delta=None)
 
     def _prepare_class_id(self, klass):
         """Add a class or reuse an existing class ID."""
-        session = self.session
         module = unicode(klass.__module__)
         name = unicode(klass.__name__)
+        key = (module, name)
+        cache = _class_ids.get(self.engine_params.db_string)
+        if cache is None:
+            cache = _class_ids.setdefault(self.engine_params.db_string, {})
+        cached = cache.get(key)
+        if cached is not None and cached[0] is klass:
+            return cached[1]
+
         actual = find_class(module, name)
         if actual != klass:
             raise TypeError("Broken class reference: %s != %s" % (
                 actual, klass))
+        session = self.session
         cls = (session.query(ArchivedClass)
             .filter_by(module=module, name=name)
             .first())
+        txn = transaction.get()
+        pending = _pending_class_keys.get(txn)
         if cls is None:
             cls = ArchivedClass(module=module, name=name)
             session.add(cls)
             session.flush()
+            # Cache the new class_id only if the transaction commits.
+            if pending is None:
+                _pending_class_keys[txn] = pending = set()
+            pending.add(key)
+            txn.addAfterCommitHook(self._cache_class_id,
+                (cache, key, klass, cls.class_id))
+        elif pending is None or key not in pending:
+            self._cache_class_id(True, cache, key, klass, cls.class_id)
         return cls.class_id
 
-    def _link_blob(self, arc_state, name, value):
-        """Link a named blob to an object state."""
-        if isinstance(value, basestring):
-            fn = value
-            f = open(fn, 'rb')
+    def _cache_class_id(self, success, cache, key, klass, class_id):
+        if success:
+            if len(cache) >= self.class_id_cache_size:
+                cache.clear()
+            cache[key] = (klass, class_id)
+
+    def _prepare_blob_ids(self, obj):
+        """Prepare the blobs of an object.  Return {name: blob_id}."""
+        return self._prepare_blob_ids_many([obj])[0]
+
+    def _prepare_blob_ids_many(self, objs):
+        """Prepare the blobs of some objects.
+
+        The blobs are staged in windows of hash_threads blobs.  The
+        blobs of a window are hashed concurrently, then looked up or
+        uploaded one at a time and closed before the next window is
+        staged, so at most one window of staged copies exists at once.
+        Returns a list of {name: blob_id}, one for each object.
+        """
+        res = []
+        names = []   # [(index, name)]
+        values = []
+        for index, obj in enumerate(objs):
+            res.append({})
+            blobs = getattr(obj, 'blobs', None)
+            if blobs:
+                for name, value in blobs.items():
+                    names.append((index, unicode(name)))
+                    values.append(value)
+        if not values:
+            return res
+
+        window = max(self.hash_threads, 1)
+        for start in range(0, len(values), window):
+            staged_list = self._stage_blobs(values[start:start + window])
             try:
-                blob_id = self._prepare_blob_id(f)
+                for (index, name), staged in zip(
+                        names[start:start + window], staged_list):
+                    res[index][name] = self._prepare_blob_id(staged)
             finally:
-                f.close()
-        else:
-            f = value
-            f.seek(0)
-            blob_id = self._prepare_blob_id(f)
-
-        a = ArchivedBlobLink(
-            docid=arc_state.docid,
-            version_num=arc_state.version_num,
-            name=unicode(name),
-            blob_id=blob_id,
-        )
-        arc_state.blob_links.append(a)
+                for staged in staged_list:
+                    staged.close()
+        return res
 
-    def _prepare_blob_id(self, f):
-        """Upload a blob or reuse an existing blob containing the same data."""
-        # Compute the length and hashes of the blob data.
-        length = 0
-        md5_calc = hashlib.md5()
-        sha256_calc = hashlib.sha256()
-        while True:
-            data = f.read(self.chunk_size)
-            if not data:
-                break
-            length += len(data)
-            md5_calc.update(data)
-            sha256_calc.update(data)
-        md5 = md5_calc.hexdigest()
-        sha256 = sha256_calc.hexdigest()
-        f.seek(0)
+    def _fingerprint(self, obj, class_id, blob_ids):
+        """Compute a hash of the content of an object version.
 
+        Two versions with the same fingerprint have the same path, title,
+        description, attrs, class, and blobs.
+        """
+        content = json.dumps([
+            unicode(obj.path),
+            unicode_or_none(obj.title),
+            unicode_or_none(obj.description),
+            obj.attrs,
+            class_id,
+            sorted(blob_ids.items()),
+        ], sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(content).hexdigest()
+
+    def _stage_blob(self, value):
+        """Read and hash a blob given a filename, a file, or an iterable.
+
+        Returns a StagedBlob holding a copy of the data, or a TrustedBlob
+        if the value is a DigestedBlob whose digests can be used as is.
+        """
+        if self.blob_digest:
+            algorithms = (self.blob_digest,)
+        else:
+            algorithms = ('md5', 'sha256')
+        if (self.trust_blob_digests
+                and isinstance(value, DigestedBlob)
+                and set(algorithms).issubset(value.digests)
+                and (self.blob_digest or value.length is not None)):
+            return TrustedBlob(value, self.chunk_size)
+        return StagedBlob(value, self.chunk_size, self.blob_spool_size,
+            algorithms)
+
+    def _stage_blobs(self, values):
+        """Stage several blobs, using a thread pool when there are many.
+
+        hashlib releases the GIL while hashing large strings, so the
+        blobs are hashed in parallel.  Returns a list of StagedBlob.
+        """
+        if self.hash_threads <= 1 or len(values) <= 1:
+            results = [self._try_stage_blob(value) for value in values]
+        else:
+            pool = _get_hash_pool(self.hash_threads)
+            results = pool.map(self._try_stage_blob, values, chunksize=1)
+        staged_list = [staged for (staged, _) in results if staged is not None]
+        for _, exc_info in results:
+            if exc_info is not None:
+                for staged in staged_list:
+                    staged.close()
+                raise exc_info[0], exc_info[1], exc_info[2]
+        return staged_list
+
+    def _try_stage_blob(self, value):
+        """Stage a blob.  Return (staged, None) or (None, exc_info)."""
+        try:
+            return self._stage_blob(value), None
+        except Exception:
+            return None, sys.exc_info()
+
+    def _prepare_blob_id(self, staged):
+        """Upload a blob or reuse an existing blob containing the same data."""
         session = self.session
-        arc_blob = (
-            session.query(ArchivedBlobInfo)
-            .filter_by(length=length, md5=md5, sha256=sha256)
-            .first())
+        q = session.query(ArchivedBlobInfo)
+        if self.blob_digest:
+            digest = '%s:%s' % (
+                self.blob_digest, staged.digests[self.blob_digest])
+            q = q.filter_by(digest=digest)
+        else:
+            digest = None
+            q = q.filter_by(length=staged.length,
+                md5=staged.digests['md5'], sha256=staged.digests['sha256'])
+        arc_blob = q.first()
         if arc_blob is not None:
             return arc_blob.blob_id
 
         arc_blob = ArchivedBlobInfo(
             chunk_count=0,
-            length=length,
-            md5=md5,
-            sha256=sha256,
+            length=staged.length or 0,
+            md5=staged.digests.get('md5'),
+            sha256=staged.digests.get('sha256'),
+            digest=digest,
         )
+        if self.blob_store is not None:
+            arc_blob.storage = 'store'
+        elif self.content_defined_chunking:
+            arc_blob.storage = 'shared'
         session.add(arc_blob)
         session.flush()  # Assign arc_blob.blob_id
-        blob_id = arc_blob.blob_id
 
-        # Upload the data.
+        # Upload the data from the staged copy.
+        if arc_blob.storage == 'store':
+            key = blob_store_key(arc_blob)
+            if not self._stored_keys_in_use([key], [arc_blob.blob_id]):
+                # No other blob uses the key, so delete the data if the
+                # transaction is aborted.
+                transaction.get().addAfterAbortHook(
+                    _delete_aborted_blobs, (self.blob_store, [key]))
+            self.blob_store.store(key, staged.iter_chunks())
+            chunk_count = 0
+        elif arc_blob.storage == 'shared':
+            chunk_count = self._upload_shared_chunks(arc_blob.blob_id, staged)
+        else:
+            chunk_count = self._upload_chunks(arc_blob, staged)
+        arc_blob.chunk_count = chunk_count
+        arc_blob.length = staged.length
+        session.flush()
+        return arc_blob.blob_id
+
+    def _compressing(self, data):
+        """Get the codec for a blob given its first chunk.  May be None."""
+        if self.chunk_codec and not looks_compressed(data):
+            # Don't waste time compressing JPEG, ZIP, etc.
+            return self.chunk_codec
+        return None
+
+    def _upload_chunks(self, arc_blob, staged):
+        """Store a blob in chunks of chunk_size.  Return the chunk count."""
+        session = self.session
+        chunk_codec = None
         chunk_index = 0
-        while True:
-            data = f.read(self.chunk_size)
-            if not data:
-                break
+        for data in staged.iter_chunks():
+            if chunk_index == 0:
+                chunk_codec = self._compressing(data)
+            codec = None
+            stored = data
+            if chunk_codec:
+                codec, stored = compress_chunk(chunk_codec, data)
             arc_chunk = ArchivedChunk(
-                blob_id=blob_id,
+                blob_id=arc_blob.blob_id,
                 chunk_index=chunk_index,
                 chunk_length=len(data),
-                data=data,
+                codec=codec,
+                data=stored,
             )
             arc_blob.chunks.append(arc_chunk)
             session.flush()
             chunk_index += 1
+        return chunk_index
+
+    def _upload_shared_chunks(self, blob_id, staged):
+        """Store a blob in content-defined chunks.  Return the chunk count.
+
+        The chunks average chunk_size bytes.  Chunks that are already in
+        the archive are shared rather than stored again.
+        """
+        chunk_codec = None
+        chunk_index = 0
+        batch = []
+        for data in iter_content_chunks(staged.iter_chunks(), self.chunk_size):
+            if chunk_index == 0:
+                chunk_codec = self._compressing(data)
+            batch.append(data)
+            chunk_index += 1
+            if len(batch) >= self._shared_chunk_batch:
+                self._store_shared_chunks(
+                    blob_id, chunk_index - len(batch), batch, chunk_codec)
+                batch = []
+        if batch:
+            self._store_shared_chunks(
+                blob_id, chunk_index - len(batch), batch, chunk_codec)
+        return chunk_index
+
+    def _store_shared_chunks(self, blob_id, first_index, batch, chunk_codec):
+        """Store or reference a batch of shared chunks of a blob."""
+        session = self.session
+        digests = [hashlib.sha256(data).hexdigest() for data in batch]
+        chunk_ids = dict(
+            session.query(
+                ArchivedSharedChunk.sha256, ArchivedSharedChunk.chunk_id)
+            .filter(ArchivedSharedChunk.sha256.in_(set(digests)))
+            .all())
+        refs = {}  # {sha256: number of new references}
+        for sha256 in digests:
+            refs[sha256] = refs.get(sha256, 0) + 1
+
+        # Add references to the existing chunks.
+        by_count = {}  # {ref count: [chunk_id]}
+        for sha256, chunk_id in chunk_ids.items():
+            by_count.setdefault(refs[sha256], []).append(chunk_id)
+        for count, ids in by_count.items():
+            (session.query(ArchivedSharedChunk)
+                .filter(ArchivedSharedChunk.chunk_id.in_(ids))
+                .update({'ref_count': ArchivedSharedChunk.ref_count + count},
+                    synchronize_session=False))
+
+        for data, sha256 in zip(batch, digests):
+            if sha256 not in chunk_ids:
+                codec = None
+                stored = data
+                if chunk_codec:
+                    codec, stored = compress_chunk(chunk_codec, data)
+                arc_chunk = ArchivedSharedChunk(
+                    sha256=sha256,
+                    chunk_length=len(data),
+                    codec=codec,
+                    ref_count=refs[sha256],
+                    data=stored,
+                )
+                session.add(arc_chunk)
+                session.flush()  # Assign arc_chunk.chunk_id
+                chunk_ids[sha256] = arc_chunk.chunk_id
 
-        arc_blob.chunk_count = chunk_index
+        session.add_all([
+            ArchivedBlobChunk(
+                blob_id=blob_id,
+                chunk_index=first_index + i,
+                chunk_id=chunk_ids[sha256],
+            )
+            for i, sha256 in enumerate(digests)])
         session.flush()
-        return arc_blob.blob_id
 
     @metricmethod
-    def history(self, docid, only_current=False):
+    def history(self, docid, only_current=False, load_blobs=False,
+            limit=None, before_version=None, summary=False):
         """Get the history of an object.
 
         Returns a list of IObjectHistoryRecord.
         The most recent version is listed first.
+
+        If load_blobs is true, the blob links of all the versions are
+        loaded with a single query rather than one query per version.
+
+        To get one page of a long history, pass limit (the maximum
+        number of records to return) and before_version (the
+        version_num of the last record on the previous page).
+
+        If summary is true, the attrs, description, and class of each
+        version are not loaded until they are accessed.
         """
-        created = (self.session.query(ArchivedObject.created)
-            .filter_by(docid=docid)
-            .scalar())
-        current_version = (self.session.query(ArchivedCurrent.version_num)
-            .filter_by(docid=docid)
-            .scalar())
-        q = self.session.query(ArchivedState).filter_by(docid=docid)
-        if only_current:
-            q = q.filter_by(version_num=current_version)
-        rows = q.order_by(ArchivedState.version_num.desc()).all()
-        return [ObjectHistoryRecord(row, created, current_version)
-            for row in rows]
+        cache = self._get_history_cache()
+        if (cache is not None and limit is None and before_version is None
+                and not summary):
+            records = self._get_cached_history(cache, docid, only_current)
+        else:
+            q = self._history_query(summary).filter(
+                ArchivedState.docid == docid)
+            if only_current:
+                q = q.filter(
+                    ArchivedState.version_num == ArchivedCurrent.version_num)
+            if before_version is not None:
+                q = q.filter(ArchivedState.version_num < before_version)
+            q = q.order_by(ArchivedState.version_num.desc())
+            if limit is not None:
+                q = q.limit(limit)
+            records = self._make_history_records(q.all(), summary)
+        if load_blobs and records:
+            q = self.session.query(ArchivedBlobLink).filter_by(docid=docid)
+            if only_current:
+                q = q.filter_by(version_num=records[0].version_num)
+            elif limit is not None or before_version is not None:
+                q = q.filter(ArchivedBlobLink.version_num.in_(
+                    [record.version_num for record in records]))
+            self._load_blobs(records, q.all())
+        return records
+
+    def iter_history(self, docid, before_version=None, batch_size=100,
+            summary=False):
+        """Iterate over the history of an object.
+
+        Yields IObjectHistoryRecord, most recent version first, like
+        history(), but fetches the states from the database batch_size
+        rows at a time, so memory use does not depend on the length
+        of the history.
+        """
+        q = self._history_query(summary).filter(
+            ArchivedState.docid == docid)
+        if before_version is not None:
+            q = q.filter(ArchivedState.version_num < before_version)
+        q = (q.order_by(ArchivedState.version_num.desc())
+            .yield_per(batch_size))
+        rows = []
+        for row in q:
+            rows.append(row)
+            if len(rows) >= batch_size:
+                for record in self._make_history_records(rows, summary):
+                    yield record
+                rows = []
+        for record in self._make_history_records(rows, summary):
+            yield record
+
+    @metricmethod
+    def history_many(self, docids, only_current=False):
+        """Get the history of many objects.
+
+        Returns {docid: [IObjectHistoryRecord]}, with the most recent
+        version of each object listed first.  Uses one query per
+        docid_batch_size docids.
+        """
+        docids = list(set(docids))
+        res = dict((docid, []) for docid in docids)
+        batch_size = self.docid_batch_size
+        for i in range(0, len(docids), batch_size):
+            q = self._history_query().filter(
+                ArchivedState.docid.in_(docids[i:i + batch_size]))
+            if only_current:
+                q = q.filter(
+                    ArchivedState.version_num == ArchivedCurrent.version_num)
+            q = q.order_by(
+                ArchivedState.docid, ArchivedState.version_num.desc())
+            for record in self._make_history_records(q.all()):
+                res[record.docid].append(record)
+        return res
+
+    @metricmethod
+    def get_versions(self, pairs):
+        """Get specific versions of many objects.
+
+        pairs is a sequence of (docid, version_num).  Returns a list of
+        IObjectHistoryRecord in the same order, with None in place of
+        versions that do not exist.  Uses one query per
+        docid_batch_size distinct pairs.
+        """
+        pairs = [(docid, version_num) for (docid, version_num) in pairs]
+        unique = list(set(pairs))
+        found = {}  # {(docid, version_num): record}
+        cache = self._get_version_cache()
+        if cache is not None:
+            found.update(self._get_cached_versions(cache, unique))
+            unique = [pair for pair in unique if pair not in found]
+        batch_size = self.docid_batch_size
+        for i in range(0, len(unique), batch_size):
+            version_nums = {}  # {docid: [version_num]}
+            for docid, version_num in unique[i:i + batch_size]:
+                version_nums.setdefault(docid, []).append(version_num)
+            # Row-value IN lists are not portable, so match the pairs
+            # with one term per docid.
+            q = (self._history_query()
+                .filter(or_(*[and_(ArchivedState.docid == docid,
+                        ArchivedState.version_num.in_(nums))
+                    for (docid, nums) in version_nums.iteritems()]))
+                .order_by(
+                    ArchivedState.docid, ArchivedState.version_num.desc()))
+            records = self._make_history_records(q.all())
+            for record in records:
+                found[(record.docid, record.version_num)] = record
+            if cache is not None:
+                self._cache_versions(cache, records)
+        return [found.get(pair) for pair in pairs]
+
+    def _get_cached_versions(self, cache, pairs):
+        """Create history records from the version cache.
+
+        Returns {(docid, version_num): record} for the pairs found in the
+        cache.  The current version numbers are not cached, so they are
+        read from the database along with the shred counts.  A cached
+        version is used only if the object has not been shredded since
+        the version was cached, since shredding an object allows its
+        version numbers to be reused.  Stale versions are rejected
+        from the cache.
+        """
+        db_string = self.engine_params.db_string
+        hits = {}  # {(docid, version_num): CachedVersion}
+        for docid, version_num in pairs:
+            cached = cache.get((db_string, docid, version_num))
+            if cached is not None:
+                hits[(docid, version_num)] = cached
+        if not hits:
+            return {}
+        docids = list(set(docid for (docid, _) in hits))
+        current = {}  # {docid: (version_num, shred_count)}
+        batch_size = self.docid_batch_size
+        for i in range(0, len(docids), batch_size):
+            rows = (self.session.query(ArchivedCurrent.docid,
+                    ArchivedCurrent.version_num,
+                    ArchivedGeneration.shred_count)
+                .outerjoin(ArchivedGeneration,
+                    ArchivedGeneration.docid == ArchivedCurrent.docid)
+                .filter(ArchivedCurrent.docid.in_(docids[i:i + batch_size]))
+                .all())
+            for docid, version_num, shred_count in rows:
+                current[docid] = (version_num, shred_count)
+        res = {}
+        for key, cached in hits.iteritems():
+            current_version, shred_count = current.get(key[0], (None, None))
+            if (current_version is not None
+                    and shred_count == cached.shred_count):
+                res[key] = CachedObjectHistoryRecord(cached, current_version,
+                    self.session, self.blob_store)
+            else:
+                cache.reject((db_string,) + key)
+        return res
+
+    def _history_query(self, summary=False):
+        """Query (ArchivedState, created, current_version, shred_count) rows.
+
+        Joining the object, current version, and generation tables lets
+        history records be created from a single query.
+        """
+        q = (self.session.query(ArchivedState, ArchivedObject.created,
+                ArchivedCurrent.version_num, ArchivedGeneration.shred_count)
+            .join(ArchivedObject,
+                ArchivedObject.docid == ArchivedState.docid)
+            .join(ArchivedCurrent,
+                ArchivedCurrent.docid == ArchivedState.docid)
+            .outerjoin(ArchivedGeneration,
+                ArchivedGeneration.docid == ArchivedState.docid))
+        if summary:
+            q = q.options(defer('attrs'), defer('attrs_delta'),
+                defer('description'), lazyload('class_'))
+        return q
+
+    def _make_history_records(self, rows, summary=False):
+        """Create history records from _history_query() rows.
+
+        The rows must be ordered by docid and then by version_num,
+        most recent first.
+        """
+        blob_store = self.blob_store
+        records = []
+        for state, created, current_version, shred_count in rows:
+            record = ObjectHistoryRecord(state, created, current_version,
+                blob_store, summary)
+            record._shred_count = shred_count
+            records.append(record)
+        if summary:
+            # Don't load the deferred attrs.
+            return records
+        # Reconstruct delta-encoded attrs from the rows just loaded.
+        # Deltas based on versions that were not loaded are
+        # reconstructed in a single query.
+        chained = set()  # set([record index])
+        orphans = []
+        prev = None
+        for index in xrange(len(records) - 1, -1, -1):
+            record = records[index]
+            if record._state.attrs_delta is not None:
+                if (prev is not None and prev.docid == record.docid
+                        and prev.version_num == record.version_num - 1):
+                    chained.add(index)
+                else:
+                    orphans.append(record)
+            prev = record
+        if orphans:
+            loaded = load_attrs(self.session,
+                [(record.docid, record.version_num) for record in orphans])
+            for record in orphans:
+                key = (record.docid, record.version_num)
+                record.attrs = loaded[key][1] or {}
+        for index in xrange(len(records) - 1, -1, -1):
+            if index in chained:
+                record = records[index]
+                record.attrs = apply_delta(
+                    records[index + 1].attrs, record._state.attrs_delta)
+        return records
 
     @metricmethod
-    def get_version(self, docid, version_num):
+    def get_version(self, docid, version_num, load_blobs=False):
         """Return a specific IObjectHistoryRecord for an object.
+
+        If load_blobs is true, the blob links are loaded immediately.
         """
-        created = (self.session.query(ArchivedObject.created)
-            .filter_by(docid=docid)
-            .scalar())
-        current_version = (self.session.query(ArchivedCurrent.version_num)
-            .filter_by(docid=docid)
-            .scalar())
-        row = (self.session.query(ArchivedState)
-            .filter_by(docid=docid, version_num=version_num)
+        record = None
+        cache = self._get_version_cache()
+        if cache is not None:
+            record = self._get_cached_versions(
+                cache, [(docid, version_num)]).get((docid, version_num))
+        if record is None:
+            row = (self._history_query()
+                .filter(ArchivedState.docid == docid)
+                .filter(ArchivedState.version_num == version_num)
+                .one())
+            record = self._make_history_records([row])[0]
+            if cache is not None:
+                self._cache_versions(cache, [record])
+        if load_blobs:
+            self._load_blobs([record], self.session.query(ArchivedBlobLink)
+                .filter_by(docid=docid, version_num=version_num)
+                .all())
+        return record
+
+    @metricmethod
+    def get_version_at(self, docid, when):
+        """Return the IObjectHistoryRecord that was archived last at a time.
+
+        when is a datetime in UTC.  Returns the version of the object
+        with the latest archive_time at or before when, or None if the
+        object had not been archived by then.
+        """
+        row = (self._history_query()
+            .filter(ArchivedState.docid == docid)
+            .filter(ArchivedState.archive_time <= when)
+            .order_by(ArchivedState.archive_time.desc(),
+                ArchivedState.version_num.desc())
+            .first())
+        if row is None:
+            return None
+        return self._make_history_records([row])[0]
+
+    @metricmethod
+    def get_versions_at(self, docids, when):
+        """Return the versions of many objects archived last at a time.
+
+        Returns {docid: IObjectHistoryRecord or None}, like
+        get_version_at() for each docid.  Uses one query per
+        docid_batch_size docids.
+        """
+        docids = list(set(docids))
+        res = dict((docid, None) for docid in docids)
+        batch_size = self.docid_batch_size
+        for i in range(0, len(docids), batch_size):
+            latest = (self.session.query(ArchivedState.docid,
+                    func.max(ArchivedState.archive_time).label('archive_time'))
+                .filter(ArchivedState.docid.in_(docids[i:i + batch_size]))
+                .filter(ArchivedState.archive_time <= when)
+                .group_by(ArchivedState.docid)
+                .subquery())
+            q = (self._history_query()
+                .join(latest, and_(
+                    latest.c.docid == ArchivedState.docid,
+                    latest.c.archive_time == ArchivedState.archive_time))
+                .order_by(
+                    ArchivedState.docid, ArchivedState.version_num.desc()))
+            for record in self._make_history_records(q.all()):
+                if res[record.docid] is None:
+                    # Versions archived at the same time are ordered
+                    # by version_num.
+                    res[record.docid] = record
+        return res
+
+    def _load_blobs(self, records, links):
+        """Provide the blobs of some history records given their links."""
+        by_version = {}  # {(docid, version_num): [ArchivedBlobLink]}
+        for link in links:
+            by_version.setdefault(
+                (link.docid, link.version_num), []).append(link)
+        for record in records:
+            record._set_blob_links(
+                by_version.get((record.docid, record.version_num), ()))
+
+    @metricmethod
+    def read_blob(self, docid, version_num, name, offset=0, length=None):
+        """Read part of a blob linked to a version of an object.
+
+        Returns up to length bytes starting at offset, or the rest of
+        the blob if length is None.
+        """
+        return ''.join(self.iter_blob(docid, version_num, name,
+            offset=offset, length=length))
+
+    def iter_blob(self, docid, version_num, name, offset=0, length=None):
+        """Iterate over part of a blob linked to a version of an object.
+
+        Yields the bytes from offset to offset + length (or to the end
+        of the blob if length is None) in strings of up to a chunk each.
+        Looks up the blob and the lengths of its chunks, then reads only
+        the chunks that overlap the range, a few per query.  Suitable as
+        a WSGI app_iter for HTTP range requests.
+        """
+        if offset < 0 or (length is not None and length < 0):
+            raise ValueError("offset and length must not be negative")
+        blob = (self.session.query(ArchivedBlobInfo)
+            .join(ArchivedBlobLink,
+                ArchivedBlobLink.blob_id == ArchivedBlobInfo.blob_id)
+            .filter(ArchivedBlobLink.docid == docid)
+            .filter(ArchivedBlobLink.version_num == version_num)
+            .filter(ArchivedBlobLink.name == unicode(name))
             .one())
-        return ObjectHistoryRecord(row, created, current_version)
+        end = blob.length
+        if length is not None:
+            end = min(end, offset + length)
+        if offset >= end:
+            return iter(())
+        if blob.storage == 'store':
+            return self._iter_stored_blob(blob, offset, end)
+        return self._iter_chunked_blob(blob, offset, end)
+
+    def _iter_stored_blob(self, blob, offset, end):
+        reader = StoredBlobReader(blob, self.blob_store)
+        try:
+            reader.seek(offset)
+            pos = offset
+            while pos < end:
+                data = reader.read(min(self.chunk_size, end - pos))
+                if not data:
+                    break
+                pos += len(data)
+                yield data
+        finally:
+            reader.close()
+
+    def _iter_chunked_blob(self, blob, offset, end):
+        session = self.session
+        offsets = []
+        pos = 0
+        for _, chunk_length in _chunk_lengths_query(
+                session, blob.blob_id, blob.storage):
+            offsets.append(pos)
+            pos += chunk_length
+        first = bisect.bisect_right(offsets, offset) - 1
+        last = bisect.bisect_right(offsets, end - 1) - 1
+        for chunk_index, data in _iter_chunk_data(
+                session, blob.blob_id, blob.storage, first, last):
+            start = offsets[chunk_index]
+            yield data[max(offset - start, 0):end - start]
 
     @metricmethod
     def reverted(self, docid, version_num):
         """Tell the database that an object has been reverted."""
         session = self.session
+        self._note_written([docid])
         row = session.query(ArchivedCurrent).filter_by(docid=docid).one()
         row.version_num = version_num
         session.flush()
+        self._bump_generations([docid])
 
     @metricmethod
     def archive_container(self, container, user):
@@ -592,6 +1795,11 @@ class Archive(object):
         """
         session = self.session
         conflicting_item = None
+        if docids:
+            self._note_written(docids)
+            self._bump_generations(docids, shredded=True)
+            transaction.get().addAfterCommitHook(_discard_cached_versions,
+                (self.engine_params.db_string, tuple(docids)))
 
         if container_ids:
             # Verify none of the containers contain any objects
@@ -665,6 +1873,8 @@ class Archive(object):
                 (session.query(ArchivedChunk)
                     .filter(ArchivedChunk.blob_id.in_(orphaned_blob_ids))
                     .delete(False))
+                self._release_shared_chunks(orphaned_blob_ids)
+                self._delete_stored_blobs(orphaned_blob_ids)
                 (session.query(ArchivedBlobInfo)
                     .filter(ArchivedBlobInfo.blob_id.in_(orphaned_blob_ids))
                     .delete(False))
@@ -674,76 +1884,487 @@ class Archive(object):
         # using delete(False).
         session.expire_all()
 
+    def _delete_stored_blobs(self, blob_ids):
+        """Delete blobs from the blob store after the transaction commits.
+
+        Keys still used by other blobs are kept.  A blob archived before
+        blob_digest was set and one archived after it can share a key.
+        """
+        rows = (self.session.query(ArchivedBlobInfo)
+            .filter(ArchivedBlobInfo.blob_id.in_(blob_ids))
+            .filter(ArchivedBlobInfo.storage == 'store')
+            .all())
+        if not rows:
+            return
+        if self.blob_store is None:
+            raise ValueError("Blobs are in a blob store, but "
+                "the archive has no blob_store")
+        keys = set(blob_store_key(row) for row in rows)
+        keys.difference_update(self._stored_keys_in_use(keys, blob_ids))
+        if not keys:
+            return
+        keys = sorted(keys)
+        transaction.get().addAfterCommitHook(
+            _delete_stored_blobs, (self.blob_store, keys))
+
+    def _stored_keys_in_use(self, keys, blob_ids):
+        """Get the blob store keys used by blobs not listed in blob_ids."""
+        hexes = [key[7:] for key in keys if key.startswith('sha256:')]
+        cond = ArchivedBlobInfo.digest.in_(keys)
+        if hexes:
+            cond = or_(cond, and_(ArchivedBlobInfo.digest == None,
+                ArchivedBlobInfo.sha256.in_(hexes)))
+        rows = (self.session.query(ArchivedBlobInfo)
+            .filter(ArchivedBlobInfo.storage == 'store')
+            .filter(~ArchivedBlobInfo.blob_id.in_(blob_ids))
+            .filter(cond)
+            .all())
+        return set(blob_store_key(row) for row in rows)
+
+    def _release_shared_chunks(self, blob_ids):
+        """Remove the references from blobs to shared chunks.
+
+        Deletes the shared chunks that are no longer referenced.
+        """
+        session = self.session
+        rows = (session.query(ArchivedBlobChunk.chunk_id, func.count())
+            .filter(ArchivedBlobChunk.blob_id.in_(blob_ids))
+            .group_by(ArchivedBlobChunk.chunk_id)
+            .all())
+        if not rows:
+            return
+        by_count = {}  # {ref count: [chunk_id]}
+        for chunk_id, count in rows:
+            by_count.setdefault(count, []).append(chunk_id)
+        for count, ids in by_count.items():
+            (session.query(ArchivedSharedChunk)
+                .filter(ArchivedSharedChunk.chunk_id.in_(ids))
+                .update({'ref_count': ArchivedSharedChunk.ref_count - count},
+                    synchronize_session=False))
+        (session.query(ArchivedBlobChunk)
+            .filter(ArchivedBlobChunk.blob_id.in_(blob_ids))
+            .delete(False))
+        (session.query(ArchivedSharedChunk)
+            .filter(ArchivedSharedChunk.chunk_id.in_(
+                [chunk_id for (chunk_id, _) in rows]))
+            .filter(ArchivedSharedChunk.ref_count <= 0)
+            .delete(False))
+
+
+_unloaded = object()
+
 
 class ObjectHistoryRecord(object):
     implements(IObjectHistoryRecord)
 
+    _attrs = None
     _blobs = None
     _klass = None
+    _class_key = None  # (module, name)
+    _description = _unloaded
+    _shred_count = None  # The shred_count of the object when loaded
 
-    def __init__(self, state, created, current_version):
+    def __init__(self, state, created, current_version, blob_store=None,
+            summary=False):
         self._state = state
+        self._blob_store = blob_store
         self.current_version = current_version
         self.derived_from_version = state.derived_from_version
         self.created = created
         self.modified = state.modified
         self.title = state.title
-        self.description = state.description
         self.docid = state.docid
         self.path = state.path
-        self.attrs = state.attrs or {}
         self.version_num = state.version_num
         self.archive_time = state.archive_time
         self.user = state.user
         self.comment = state.comment
+        if not summary:
+            # Copy the loaded columns, since the state expires when the
+            # transaction commits.  Summary records load them on demand.
+            self._description = state.description
+            if state.attrs_delta is None:
+                self._attrs = state.attrs or {}
+            cls = state.class_
+            self._class_key = (cls.module, cls.name)
+
+    @property
+    def description(self):
+        description = self._description
+        if description is _unloaded:
+            self._description = description = self._state.description
+        return description
+
+    @property
+    def attrs(self):
+        attrs = self._attrs
+        if attrs is None:
+            state = self._state
+            if state.attrs_delta is None:
+                attrs = state.attrs or {}
+            else:
+                # Reconstruct the attrs from a delta.
+                key = (self.docid, self.version_num)
+                session = object_session(state)
+                attrs = load_attrs(session, [key])[key][1] or {}
+            self._attrs = attrs
+        return attrs
+
+    @attrs.setter
+    def attrs(self, value):
+        self._attrs = value
 
     @property
     def blobs(self):
         blobs = self._blobs
         if blobs is None:
-            blobs = {}
-            for link in self._state.blob_links:
-                blobs[link.name] = BlobReader(link.blob)
-            self._blobs = blobs
+            self._set_blob_links(self._state.blob_links)
+            blobs = self._blobs
         return blobs
 
+    def _set_blob_links(self, links):
+        blobs = {}
+        for link in links:
+            blob = link.blob
+            if blob.storage == 'store':
+                blobs[link.name] = StoredBlobReader(blob, self._blob_store)
+            else:
+                blobs[link.name] = BlobReader(blob)
+        self._blobs = blobs
+
     @property
     def klass(self):
         res = self._klass
         if res is None:
-            cls = self._state.class_
-            self._klass = res = find_class(cls.module, cls.name)
+            key = self._class_key
+            if key is None:
+                cls = self._state.class_
+                key = (cls.module, cls.name)
+            self._klass = res = find_class(*key)
         return res
 
 
+class CachedVersion(object):
+    """The immutable data of a version, kept in the version cache.
+
+    Shared by all threads, so it holds no database session.  The attrs
+    are kept as JSON so that each record gets its own copy.  shred_count
+    is the shred_count of the object when the version was loaded.  size
+    is an estimate of the memory used by the data.
+    """
+
+    _fields = ('docid', 'version_num', 'derived_from_version', 'created',
+        'modified', 'title', 'path', 'archive_time', 'user', 'comment')
+
+    def __init__(self, record):
+        size = 256
+        for name in self._fields:
+            value = getattr(record, name)
+            setattr(self, name, value)
+            if isinstance(value, basestring):
+                size += len(value)
+        self.description = record.description
+        size += len(self.description or '')
+        # Decoding unicode (like JSONType does) produces unicode strings.
+        self.attrs_json = unicode(json.dumps(record.attrs), 'ascii')
+        size += len(self.attrs_json)
+        self.class_key = record._class_key
+        self.shred_count = record._shred_count
+        self.size = size
+
+
+class CachedObjectHistoryRecord(ObjectHistoryRecord):
+    """A history record created from a CachedVersion."""
+
+    def __init__(self, cached, current_version, session, blob_store=None):
+        self._cached = cached
+        self._session = session
+        self._blob_store = blob_store
+        self.current_version = current_version
+        for name in CachedVersion._fields:
+            setattr(self, name, getattr(cached, name))
+        self._description = cached.description
+        self._class_key = cached.class_key
+        self._shred_count = cached.shred_count
+
+    @property
+    def attrs(self):
+        attrs = self._attrs
+        if attrs is None:
+            self._attrs = attrs = json.loads(self._cached.attrs_json)
+        return attrs
+
+    @attrs.setter
+    def attrs(self, value):
+        self._attrs = value
+
+    @property
+    def blobs(self):
+        blobs = self._blobs
+        if blobs is None:
+            self._set_blob_links(self._session.query(ArchivedBlobLink)
+                .filter_by(docid=self.docid, version_num=self.version_num)
+                .all())
+            blobs = self._blobs
+        return blobs
+
+
+def _chunk_lengths_query(session, blob_id, storage):
+    """Query the (chunk_index, chunk_length) of the chunks of a blob."""
+    if storage == 'shared':
+        return (session.query(
+                ArchivedBlobChunk.chunk_index,
+                ArchivedSharedChunk.chunk_length)
+            .join(ArchivedSharedChunk, ArchivedSharedChunk.chunk_id ==
+                ArchivedBlobChunk.chunk_id)
+            .filter(ArchivedBlobChunk.blob_id == blob_id)
+            .order_by(ArchivedBlobChunk.chunk_index))
+    return (session.query(
+            ArchivedChunk.chunk_index, ArchivedChunk.chunk_length)
+        .filter(ArchivedChunk.blob_id == blob_id)
+        .order_by(ArchivedChunk.chunk_index))
+
+
+def _chunk_data_query(session, blob_id, storage, first=None, last=None):
+    """Query the (chunk_index, codec, data) of the chunks of a blob.
+
+    If first and last are given, only the chunks with indexes from first
+    to last (inclusive) are included.
+    """
+    if storage == 'shared':
+        chunk_index = ArchivedBlobChunk.chunk_index
+        q = (session.query(
+                chunk_index,
+                ArchivedSharedChunk.codec,
+                ArchivedSharedChunk.data)
+            .join(ArchivedSharedChunk, ArchivedSharedChunk.chunk_id ==
+                ArchivedBlobChunk.chunk_id)
+            .filter(ArchivedBlobChunk.blob_id == blob_id))
+    else:
+        chunk_index = ArchivedChunk.chunk_index
+        q = (session.query(
+                chunk_index, ArchivedChunk.codec, ArchivedChunk.data)
+            .filter(ArchivedChunk.blob_id == blob_id))
+    if first is not None:
+        q = q.filter(chunk_index.between(first, last))
+    return q.order_by(chunk_index)
+
+
+def _iter_chunk_data(session, blob_id, storage, first, last):
+    """Yield the (chunk_index, data) of the chunks first to last.
+
+    Fetches _chunk_fetch_window chunks per query.  Streaming from a server-side
+    cursor would not bound memory use, since psycopg2 result proxies
+    read ahead up to 1000 rows.
+    """
+    window = _chunk_fetch_window
+    for start in range(first, last + 1, window):
+        rows = _chunk_data_query(session, blob_id, storage,
+            start, min(start + window - 1, last)).all()
+        for chunk_index, codec, data in rows:
+            yield chunk_index, decompress_chunk(codec, data)
+
+
 class BlobReader(object):
-    """Reads a blob file on demand and delegates to the open file."""
+    """A read-only, seekable file that reads a blob from the database.
 
-    _file = None
-    _max_stringio = 1048576  # If blobs are larger than this, use a temp file.
+    Chunks are fetched one at a time as reading progresses, so seeking
+    to the middle of a large blob and reading a few bytes loads only
+    the chunks that contain those bytes.  At most _window chunks are
+    kept in memory.
+    """
+
+    _window = 2  # Number of recently read chunks to keep in memory
+    closed = False
 
     def __init__(self, blob):
-        self._blob = blob
+        self._session = object_session(blob)
+        self.blob_id = blob.blob_id
+        self.storage = blob.storage
+        self.length = blob.length
+        self._pos = 0
+        self._offsets = None  # [offset of each chunk]
+        self._chunks = {}  # {chunk_index: data}
+        self._recent = []  # [chunk_index], least recently read first
+
+    def _get_offsets(self):
+        offsets = self._offsets
+        if offsets is None:
+            offsets = []
+            pos = 0
+            for _, chunk_length in _chunk_lengths_query(
+                    self._session, self.blob_id, self.storage):
+                offsets.append(pos)
+                pos += chunk_length
+            self._offsets = offsets
+        return offsets
+
+    def _get_chunk(self, chunk_index):
+        data = self._chunks.get(chunk_index)
+        recent = self._recent
+        if data is None:
+            _, codec, data = _chunk_data_query(self._session, self.blob_id,
+                self.storage, chunk_index, chunk_index).one()
+            data = decompress_chunk(codec, data)
+            self._chunks[chunk_index] = data
+            if len(recent) >= self._window:
+                del self._chunks[recent.pop(0)]
+        else:
+            recent.remove(chunk_index)
+        recent.append(chunk_index)
+        return data
+
+    def _check_open(self):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+
+    def read(self, size=-1):
+        self._check_open()
+        pos = self._pos
+        if size is None or size < 0:
+            size = self.length - pos
+        offsets = self._get_offsets()
+        res = []
+        while size > 0 and pos < self.length:
+            chunk_index = bisect.bisect_right(offsets, pos) - 1
+            data = self._get_chunk(chunk_index)
+            start = pos - offsets[chunk_index]
+            piece = data[start:start + size]
+            if not piece:
+                break
+            res.append(piece)
+            pos += len(piece)
+            size -= len(piece)
+        self._pos = pos
+        return ''.join(res)
+
+    def readline(self, size=-1):
+        self._check_open()
+        res = []
+        while size is None or size < 0 or size > 0:
+            start = self._pos
+            data = self.read(self._peek_size(size))
+            if not data:
+                break
+            end = data.find('\n')
+            if end >= 0:
+                data = data[:end + 1]
+                self._pos = start + len(data)
+                res.append(data)
+                break
+            res.append(data)
+            if size is not None and size >= 0:
+                size -= len(data)
+        return ''.join(res)
+
+    def _peek_size(self, size):
+        """Get the size to read when looking for the end of a line."""
+        offsets = self._get_offsets()
+        pos = self._pos
+        if pos >= self.length:
+            return 0
+        chunk_index = bisect.bisect_right(offsets, pos) - 1
+        if chunk_index + 1 < len(offsets):
+            end = offsets[chunk_index + 1]
+        else:
+            end = self.length
+        peek = end - pos
+        if size is not None and 0 <= size < peek:
+            return size
+        return peek
+
+    def readlines(self, sizehint=None):
+        return list(self)
+
+    def iter_chunks(self):
+        """Iterate over the data of the whole blob, one chunk at a time.
+
+        The chunks are fetched a few at a time without an intermediate
+        file, so memory use does not depend on the size of the blob.
+        Suitable as a WSGI app_iter.  Does not change the position of
+        the file.
+        """
+        self._check_open()
+        last = len(self._get_offsets()) - 1
+        for _, data in _iter_chunk_data(
+                self._session, self.blob_id, self.storage, 0, last):
+            yield data
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def seek(self, offset, whence=0):
+        self._check_open()
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self.length
+        if offset < 0:
+            raise IOError("Invalid seek position")
+        self._pos = offset
+
+    def tell(self):
+        self._check_open()
+        return self._pos
+
+    def close(self):
+        self.closed = True
+        self._chunks.clear()
+        del self._recent[:]
+
+    def write(self, data):
+        raise IOError("BlobReader is not writable")
+
+    def writelines(self, data):
+        raise IOError("BlobReader is not writable")
+
+
+class StoredBlobReader(object):
+    """Opens a blob in a blob store on demand and delegates to the file."""
+
+    _file = None
+
+    def __init__(self, blob, blob_store):
+        self._key = blob_store_key(blob)
+        self._blob_store = blob_store
+        self.length = blob.length
 
     def _get_file(self):
         f = self._file
         if f is None:
-            length = self._blob.length
-            if length <= self._max_stringio:
-                # The blob fits in memory.
-                f = StringIO()
-            else:
-                # Write the blob to a temporary file.
-                f = tempfile.TemporaryFile()
-            for chunk in self._blob.chunks:
-                f.write(chunk.data)
-            f.seek(0)
-            self._file = f
+            if self._blob_store is None:
+                raise IOError("The blob is in a blob store, but "
+                    "the archive has no blob_store")
+            self._file = f = self._blob_store.open(self._key)
         return f
 
     def __getattr__(self, name):
         return getattr(self._get_file(), name)
 
+    def iter_chunks(self, chunk_size=1048576):
+        """Iterate over the data of the whole blob in pieces.
+
+        Opens the blob again, so the position of the file is unchanged.
+        """
+        if self._blob_store is None:
+            raise IOError("The blob is in a blob store, but "
+                "the archive has no blob_store")
+        f = self._blob_store.open(self._key)
+        try:
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                yield data
+        finally:
+            f.close()
+
     def write(self, data):
         raise IOError("BlobReader is not writable")
 
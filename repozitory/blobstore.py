@@ -0,0 +1,76 @@
+
+"""Storage of blob data outside the database.
+
+When an Archive has a blob_store, the data of new blobs is stored in
+the blob store and the database holds only the ArchivedBlobInfo row.
+Blobs are identified in the blob store by a key of the form
+'<algorithm>:<hex digest>'.
+"""
+
+from repozitory.interfaces import IBlobStore
+from zope.interface import implements
+import errno
+import os
+import re
+import tempfile
+
+_key_re = re.compile(r'^([a-z0-9_]+):([0-9a-f]{8,})$')
+
+
+class FilesystemBlobStore(object):
+    """Stores blobs as files in a directory.
+
+    The files are sharded by digest into subdirectories, such as
+    <directory>/sha256/ab/cd/abcd...  Each file is written to a
+    temporary file first and then renamed, so readers never see a
+    partially written blob.  If fsync is true, the data is flushed to
+    disk before the rename.
+    """
+    implements(IBlobStore)
+
+    def __init__(self, directory, fsync=True):
+        self.directory = directory
+        self.fsync = fsync
+
+    def path(self, key):
+        """Get the filename of a blob."""
+        match = _key_re.match(key)
+        if match is None:
+            raise ValueError("Invalid blob key: %r" % key)
+        algorithm, hexdigest = match.groups()
+        return os.path.join(self.directory, algorithm,
+            hexdigest[:2], hexdigest[2:4], hexdigest)
+
+    def store(self, key, chunks):
+        path = self.path(key)
+        dirname = os.path.dirname(path)
+        try:
+            os.makedirs(dirname)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                for data in chunks:
+                    f.write(data)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            finally:
+                f.close()
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def delete(self, key):
+        try:
+            os.unlink(self.path(key))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
@@ -0,0 +1,123 @@
+
+"""A thread-safe LRU cache bounded by entry count and total size.
+
+Archive uses it to keep immutable version data in memory, shared by all
+the threads of a process.  The cache reports hits, misses, and evictions
+through perfmetrics' statsd client, if one is configured.
+"""
+
+from collections import OrderedDict
+from perfmetrics import statsd_client
+import threading
+
+
+class LRUCache(object):
+    """Maps keys to values, discarding the least recently used first.
+
+    The cache holds at most max_entries values, with a total size of
+    at most max_bytes.  The size of each value is provided by the
+    caller when storing it.  The hits, misses, and evictions attributes
+    count cache activity; the same counts are sent to statsd as
+    <metric_prefix>.hits, <metric_prefix>.misses, and
+    <metric_prefix>.evictions.
+    """
+
+    def __init__(self, max_entries, max_bytes, metric_prefix=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.metric_prefix = metric_prefix
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()  # {key: (value, size)}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _incr(self, name, count=1):
+        if self.metric_prefix:
+            client = statsd_client()
+            if client is not None:
+                client.incr('%s.%s' % (self.metric_prefix, name), count)
+
+    def get(self, key, default=None):
+        """Get a value and mark it as the most recently used."""
+        self._lock.acquire()
+        try:
+            item = self._data.pop(key, None)
+            if item is not None:
+                self._data[key] = item
+                self.hits += 1
+            else:
+                self.misses += 1
+        finally:
+            self._lock.release()
+        if item is None:
+            self._incr('misses')
+            return default
+        self._incr('hits')
+        return item[0]
+
+    def set(self, key, value, size):
+        """Add or replace a value.
+
+        Evicts the least recently used values as needed to stay within
+        the limits.  Values larger than max_bytes are not stored.
+        """
+        if size > self.max_bytes:
+            return
+        evicted = 0
+        self._lock.acquire()
+        try:
+            data = self._data
+            old = data.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            data[key] = (value, size)
+            self.size += size
+            while len(data) > self.max_entries or self.size > self.max_bytes:
+                _, (_, old_size) = data.popitem(last=False)
+                self.size -= old_size
+                evicted += 1
+            self.evictions += evicted
+        finally:
+            self._lock.release()
+        if evicted:
+            self._incr('evictions', evicted)
+
+    def reject(self, key):
+        """Remove a stale value that get() returned.
+
+        The lookup is counted as a miss instead of a hit.
+        """
+        self._lock.acquire()
+        try:
+            item = self._data.pop(key, None)
+            if item is not None:
+                self.size -= item[1]
+            self.hits -= 1
+            self.misses += 1
+        finally:
+            self._lock.release()
+        self._incr('hits', -1)
+        self._incr('misses')
+
+    def discard_matching(self, func):
+        """Remove the values whose key matches a predicate."""
+        self._lock.acquire()
+        try:
+            data = self._data
+            for key in [key for key in data if func(key)]:
+                self.size -= data.pop(key)[1]
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+            self.size = 0
+        finally:
+            self._lock.release()
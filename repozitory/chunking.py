@@ -0,0 +1,81 @@
+
+"""Content-defined chunking of blob data.
+
+Fixed-size chunks can only be shared between identical blobs, since
+inserting or removing a single byte shifts every chunk boundary that
+follows.  Content-defined chunking instead places a boundary wherever
+a rolling hash of the last few dozen bytes matches a pattern, so the
+boundaries move along with the content and an edit changes only the
+chunks around it.  This module uses a Gear rolling hash, as in FastCDC.
+
+The hash is computed in pure Python, one byte at a time, so chunking
+runs at roughly 10 MB per second and holds the GIL while it runs.
+"""
+
+import hashlib
+import struct
+
+
+def _make_gear_table():
+    # 256 pseudo-random 32 bit integers.  The table must never change,
+    # since stored chunks are matched by their content.
+    table = []
+    for i in range(256):
+        digest = hashlib.md5(chr(i)).digest()
+        table.append(struct.unpack('>I', digest[:4])[0])
+    return tuple(table)
+
+_gear = _make_gear_table()
+
+
+def iter_content_chunks(strings, avg_size, min_size=None, max_size=None):
+    """Split the concatenation of some strings into content-defined chunks.
+
+    Yields strings of between min_size and max_size bytes (except the
+    last, which may be shorter).  The chunks are about avg_size bytes
+    on average.  min_size defaults to avg_size / 4 and max_size defaults
+    to avg_size * 4.
+    """
+    if min_size is None:
+        min_size = max(avg_size // 4, 1)
+    if max_size is None:
+        max_size = avg_size * 4
+    # A boundary occurs when the top bits of the hash are all zero,
+    # that is, when the hash is at most limit.  The bottom bits depend
+    # on only the last few bytes, so they are not used.
+    bits = max(1, (max(avg_size - min_size, 2) - 1).bit_length())
+    limit = (1 << (32 - bits)) - 1
+    gear = _gear
+
+    chunk = bytearray()
+    h = 0
+    for data in strings:
+        data = bytearray(data)
+        i = 0
+        n = len(data)
+        while i < n:
+            size = len(chunk)
+            if size < min_size:
+                # Don't look for a boundary in the first min_size bytes.
+                take = min(min_size - size, n - i)
+                chunk += data[i:i + take]
+                i += take
+                continue
+            end = min(n, i + max_size - size)
+            j = i
+            found = False
+            # Iterating over a slice is faster than indexing.
+            for byte in data[i:end]:
+                h = ((h << 1) + gear[byte]) & 0xffffffff
+                j += 1
+                if h <= limit:
+                    found = True
+                    break
+            chunk += data[i:j]
+            i = j
+            if found or len(chunk) >= max_size:
+                yield str(chunk)
+                chunk = bytearray()
+                h = 0
+    if chunk:
+        yield str(chunk)
@@ -0,0 +1,78 @@
+
+"""Compression of blob chunks.
+
+Each ArchivedChunk row records the name of the codec that compressed
+its data, or None if the data is stored as is.  Applications can add
+codecs with register_codec().
+"""
+
+import zlib
+
+_codecs = {}  # {name: (compress, decompress)}
+
+# Data that starts with one of these prefixes is already compressed.
+_compressed_signatures = (
+    '\xff\xd8\xff',         # JPEG
+    '\x89PNG\r\n\x1a\n',    # PNG
+    'GIF87a',
+    'GIF89a',
+    'PK\x03\x04',           # ZIP, including OpenDocument and OOXML
+    '\x1f\x8b',             # gzip
+    'BZh',                  # bzip2
+    '\xfd7zXZ\x00',         # xz
+    '7z\xbc\xaf\x27\x1c',   # 7-Zip
+    'Rar!\x1a\x07',
+    'OggS',
+    'ID3',                  # MP3
+    'RIFF',                 # WebP, AVI, WAV
+    '\x1aE\xdf\xa3',        # Matroska, WebM
+)
+
+
+def register_codec(name, compress, decompress):
+    """Register a chunk codec.
+
+    compress and decompress are functions that accept a string and
+    return a string.  Once chunks have been stored with a codec, the
+    codec must remain registered to read them.
+    """
+    _codecs[name] = (compress, decompress)
+
+
+register_codec('zlib', zlib.compress, zlib.decompress)
+
+
+def looks_compressed(data):
+    """Return True if data starts with the signature of a compressed format.
+    """
+    if data.startswith(_compressed_signatures):
+        return True
+    # MP4, QuickTime, and HEIF files start with a box of type 'ftyp'.
+    return data[4:8] == 'ftyp'
+
+
+def compress_chunk(codec, data):
+    """Compress a chunk of data.
+
+    Returns (codec, data).  The returned codec is None if compression
+    would not save space, in which case the data is returned as is.
+    """
+    try:
+        compress = _codecs[codec][0]
+    except KeyError:
+        raise ValueError("Unknown chunk codec: %s" % codec)
+    compressed = compress(data)
+    if len(compressed) >= len(data):
+        return None, data
+    return codec, compressed
+
+
+def decompress_chunk(codec, data):
+    """Decompress a chunk of data stored with the given codec (or None)."""
+    if codec is None:
+        return data
+    try:
+        decompress = _codecs[codec][1]
+    except KeyError:
+        raise ValueError("Unknown chunk codec: %s" % codec)
+    return decompress(data)
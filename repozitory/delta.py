@@ -0,0 +1,84 @@
+
+"""Delta encoding of the attrs of archived states.
+
+When Archive.attrs_snapshot_interval is set, most ArchivedState rows
+store only the changes to attrs since the previous version (in the
+attrs_delta column) rather than the complete attrs.  Each such row also
+records in attrs_base the version number of the nearest earlier row
+that holds a complete snapshot of attrs, so any version can be
+reconstructed from a bounded range of rows.
+"""
+
+from repozitory.schema import ArchivedState
+from sqlalchemy import and_
+from sqlalchemy import func
+from sqlalchemy import or_
+from sqlalchemy.orm import aliased
+
+
+def make_delta(old, new):
+    """Compute the changes from one attrs dict to another.
+
+    The changes are returned as a JSON-compatible dict.
+    """
+    delta = {}
+    changed = dict((key, value) for (key, value) in new.iteritems()
+        if key not in old or old[key] != value)
+    if changed:
+        delta['set'] = changed
+    removed = [key for key in old if key not in new]
+    if removed:
+        delta['del'] = sorted(removed)
+    return delta
+
+
+def apply_delta(attrs, delta):
+    """Apply changes computed by make_delta().  Returns a new dict."""
+    res = dict(attrs or ())
+    for key in delta.get('del', ()):
+        res.pop(key, None)
+    res.update(delta.get('set', ()))
+    return res
+
+
+def load_attrs(session, keys):
+    """Reconstruct the attrs of some states.
+
+    keys is a sequence of (docid, version_num).  Fetches each state and
+    the states it is based on in a single query.  Returns
+    {(docid, version_num): (base_version, attrs)}, where base_version is
+    the version that holds the complete snapshot of attrs.
+    """
+    keys = list(keys)
+    if not keys:
+        return {}
+    target = aliased(ArchivedState)
+    rows = (session.query(
+            target.docid,
+            target.version_num,
+            ArchivedState.version_num,
+            ArchivedState.attrs,
+            ArchivedState.attrs_delta,
+        )
+        .join(ArchivedState, and_(
+            ArchivedState.docid == target.docid,
+            ArchivedState.version_num >= func.coalesce(
+                target.attrs_base, target.version_num),
+            ArchivedState.version_num <= target.version_num,
+        ))
+        .filter(or_(*[
+            and_(target.docid == docid, target.version_num == version_num)
+            for (docid, version_num) in keys]))
+        .order_by(target.docid, target.version_num,
+            ArchivedState.version_num)
+        .all())
+
+    res = {}
+    for docid, version_num, row_version, attrs, delta in rows:
+        key = (docid, version_num)
+        if delta is None:
+            res[key] = (row_version, attrs)
+        else:
+            base_version, base_attrs = res.get(key, (row_version, None))
+            res[key] = (base_version, apply_delta(base_attrs, delta))
+    return res
@@ -59,10 +59,26 @@ class IArchive(Interface):
         The obj parameter must provide the IObjectVersion interface.
         The object does not need to have been in the archive previously.
 
-        Returns the new version number.
+        Returns the new version number.  If the archive is configured
+        to skip unchanged versions and the object is identical to its
+        current version, no version is added and the current version
+        number is returned.
         """
 
-    def history(docid, only_current=False):
+    def archive_many(objs):
+        """Add a version to the archive of each of several objects.
+
+        Each object must provide the IObjectVersion interface.  This is
+        equivalent to calling archive() for each object in turn, but
+        requires far fewer database round trips.  A docid may appear
+        more than once; later objects produce later versions.
+
+        Returns a list of the new version numbers, in the order
+        of the objects.
+        """
+
+    def history(docid, only_current=False, load_blobs=False,
+            limit=None, before_version=None, summary=False):
         """Get the history of an object.
 
         Returns a list of objects that provide IObjectHistoryRecord.
@@ -72,10 +88,90 @@ class IArchive(Interface):
         is returned in the list.  (The most current history record
         might not be the most recent version number if the object
         has been reverted.)
+
+        If load_blobs is true, the blobs of all the returned records
+        are looked up in a single query.  Otherwise, the blobs of each
+        record are looked up when the record's blobs are first accessed.
+
+        If limit is not None, at most limit records are returned.  If
+        before_version is not None, only versions numbered below
+        before_version are returned.  Together, these parameters fetch
+        one page of a long history at a time: pass the version_num of
+        the last record of a page as before_version to get the next.
+
+        If summary is true, the attrs, description, and klass of the
+        records are loaded from the database only when accessed, which
+        makes listings of version metadata faster.
+        """
+
+    def iter_history(docid, before_version=None, batch_size=100,
+            summary=False):
+        """Iterate over the history of an object.
+
+        Yields objects that provide IObjectHistoryRecord, most recent
+        version first.  The records are fetched from the database in
+        batches of batch_size, so the memory used does not depend on
+        the length of the history.  The summary parameter is the same
+        as for history().
         """
 
-    def get_version(docid, version_num):
+    def history_many(docids, only_current=False):
+        """Get the history of many objects.
+
+        Returns a dict that maps each of the docids to a list of
+        objects that provide IObjectHistoryRecord, like history().
+        The list is empty for docids that are not in the archive.
+        The number of queries depends only on the number of docids
+        divided by the docid_batch_size attribute of the archive.
+        """
+
+    def get_version(docid, version_num, load_blobs=False):
         """Return a specific IObjectHistoryRecord for a document.
+
+        If load_blobs is true, the blobs are looked up immediately.
+        """
+
+    def get_versions(pairs):
+        """Return specific IObjectHistoryRecords for many documents.
+
+        pairs is a sequence of (docid, version_num).  Returns a list
+        containing an IObjectHistoryRecord for each pair, in the same
+        order, or None where the version does not exist.  The versions
+        are fetched with one query per docid_batch_size pairs.
+        """
+
+    def get_version_at(docid, when):
+        """Return the version of a document that was current at a time.
+
+        when is a datetime in UTC.  Returns the IObjectHistoryRecord
+        with the latest archive_time at or before when, or None if the
+        document had not been archived by then.  Reverting a document
+        does not change its archive times, so reverts are not taken
+        into account.
+        """
+
+    def get_versions_at(docids, when):
+        """Return the versions of many documents current at a time.
+
+        Returns a dict that maps each docid to the IObjectHistoryRecord
+        get_version_at() would return, or None.  The versions are
+        fetched with one query per docid_batch_size docids.
+        """
+
+    def read_blob(docid, version_num, name, offset=0, length=None):
+        """Read part of a blob linked to a version of an object.
+
+        Returns a string containing up to length bytes of the blob,
+        starting at offset.  If length is None, reads to the end of the
+        blob.
+        """
+
+    def iter_blob(docid, version_num, name, offset=0, length=None):
+        """Iterate over part of a blob linked to a version of an object.
+
+        Like read_blob(), but yields the data in pieces of up to one
+        chunk each, reading only the chunks that overlap the requested
+        range.  The result is suitable as a WSGI app_iter.
         """
 
     def reverted(docid, version_num):
@@ -160,6 +256,26 @@ class IArchive(Interface):
         """
 
 
+class IBlobStore(Interface):
+    """Stores the data of blobs outside the database.
+
+    Blobs are identified by a key of the form '<algorithm>:<hex digest>'.
+    """
+
+    def store(key, chunks):
+        """Store a blob, given an iterable of strings.
+
+        Readers must never see a partially stored blob.  Storing a blob
+        that already exists replaces it.
+        """
+
+    def open(key):
+        """Open a stored blob for reading.  Returns a file object."""
+
+    def delete(key):
+        """Delete a stored blob.  Does nothing if the blob does not exist."""
+
+
 class IObjectVersion(IDCDescriptiveProperties, IDCTimes):
     """The content of an object for version control.
 
@@ -191,9 +307,11 @@ class IObjectVersion(IDCDescriptiveProperties, IDCTimes):
     blobs = Attribute(
         """A map of binary large objects linked to this state.  May be None.
 
-        Each key is a unicode string.  Each value is either a
-        filename or an open file object (such as a StringIO).
-        Open file objects must be seekable.
+        Each key is a unicode string.  Each value is a filename,
+        an open file object (such as a StringIO), or an iterable of
+        strings (such as a generator).  Seekable files are read from
+        the beginning; other files, such as WSGI input streams, are read
+        from their current position.  Each blob is read only once.
         """)
 
     klass = Attribute(
@@ -213,7 +331,9 @@ class IObjectHistoryRecord(IObjectVersion):
 
     The IArchive.history() method returns objects that provide this
     interface.  All blobs returned by the history() method are open
-    files (not filenames).
+    files (not filenames).  Each blob file also has an iter_chunks()
+    method that yields the data of the whole blob in pieces, streaming
+    from the database a few chunks at a time.
     """
 
     version_num = Attribute("The version number of the object; starts with 1.")
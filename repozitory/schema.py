@@ -7,6 +7,7 @@ from sqlalchemy.orm import relationship
 from sqlalchemy.schema import Column
 from sqlalchemy.schema import ForeignKey
 from sqlalchemy.schema import ForeignKeyConstraint
+from sqlalchemy.schema import Index
 from sqlalchemy.types import BigInteger
 from sqlalchemy.types import DateTime
 from sqlalchemy.types import Integer
@@ -23,6 +24,9 @@ class ArchivedObject(Base):
     docid = Column(BigInteger, primary_key=True, nullable=False,
         autoincrement=False)
     created = Column(DateTime, nullable=False, index=True)
+    # latest_version is the highest version_num in archived_state.
+    # It is None only in rows written by repozitory 1.3 or earlier.
+    latest_version = Column(Integer, nullable=True)
 
 
 class ArchivedClass(Base):
@@ -58,10 +62,24 @@ class ArchivedState(Base):
 
     description = Column(Unicode, nullable=True)
     attrs = Column(JSONType, nullable=True)
+    # When attrs_delta is not None, attrs is None and attrs_delta holds
+    # the changes to attrs since the previous version.  attrs_base is
+    # the version of the last complete attrs snapshot.
+    # See repozitory.delta.
+    attrs_base = Column(Integer, nullable=True)
+    attrs_delta = Column(JSONType, nullable=True)
+
+    # fingerprint is a SHA-256 hash of the content of the state.  It is
+    # set only when the archive is configured to skip unchanged versions.
+    fingerprint = Column(String, nullable=True)
 
     obj = relationship(ArchivedObject)
     class_ = relationship(ArchivedClass, lazy='joined')
 
+# Finds the version of an object that was current at a given time.
+Index('ix_archived_state_docid_archive_time',
+    ArchivedState.docid, ArchivedState.archive_time)
+
 
 class ArchivedCurrent(Base):
     """Reference to the current version of an object."""
@@ -80,6 +98,22 @@ class ArchivedCurrent(Base):
     state = relationship(ArchivedState)
 
 
+class ArchivedGeneration(Base):
+    """A counter that changes whenever the history of an object changes.
+
+    Processes that cache histories compare generations to detect changes
+    made by other processes.  The row is kept when the object is
+    shredded, so a generation number is never reused.  shred_count
+    counts the times the object has been shredded; past versions can
+    change only then, since shredding allows version numbers to be
+    reused.
+    """
+    __tablename__ = 'archived_generation'
+    docid = Column(BigInteger, primary_key=True, nullable=False)
+    generation = Column(Integer, nullable=False)
+    shred_count = Column(Integer, nullable=False, default=0)
+
+
 class ArchivedBlobInfo(Base):
     """Info about a chunked blob.
 
@@ -90,9 +124,17 @@ class ArchivedBlobInfo(Base):
     blob_id = Column(Integer, primary_key=True, nullable=False)
     chunk_count = Column(Integer, nullable=False)
     length = Column(BigInteger, nullable=False)
-    # Blobs are matched by both MD5 and SHA-256.
-    md5 = Column(String, nullable=False, index=True)
-    sha256 = Column(String, nullable=False)
+    # By default, blobs are matched by both MD5 and SHA-256.
+    md5 = Column(String, nullable=True, index=True)
+    sha256 = Column(String, nullable=True)
+    # When Archive.blob_digest is set, blobs are matched by digest instead.
+    # The digest is stored as '<algorithm>:<hex digest>'.
+    digest = Column(String, nullable=True, index=True)
+    # storage tells where the blob data is stored.  When it is None,
+    # the data is in archived_chunk.  When it is 'shared', the data is
+    # in content-defined chunks listed in archived_blob_chunk.  When it
+    # is 'store', the data is in the blob store of the archive.
+    storage = Column(String, nullable=True)
 
 
 class ArchivedChunk(Base):
@@ -102,13 +144,44 @@ class ArchivedChunk(Base):
         primary_key=True, nullable=False, index=True)
     chunk_index = Column(Integer, primary_key=True, nullable=False,
         autoincrement=False)
+    # chunk_length is the length of the uncompressed data.
     chunk_length = Column(Integer, nullable=False)
+    # codec is the name of the codec that compressed the data, or None
+    # if the data is not compressed.  See repozitory.compression.
+    codec = Column(String, nullable=True)
     data = deferred(Column(LargeBinary, nullable=False))
 
     blob = relationship(ArchivedBlobInfo,
         backref=backref('chunks', order_by=chunk_index))
 
 
+class ArchivedSharedChunk(Base):
+    """A content-defined chunk of data shared by any number of blobs.
+
+    Chunks are matched by the SHA-256 of the uncompressed data.
+    ref_count is the number of archived_blob_chunk rows that refer to
+    the chunk.
+    """
+    __tablename__ = 'archived_shared_chunk'
+    chunk_id = Column(Integer, primary_key=True, nullable=False)
+    sha256 = Column(String, nullable=False, unique=True)
+    chunk_length = Column(Integer, nullable=False)
+    codec = Column(String, nullable=True)
+    ref_count = Column(Integer, nullable=False)
+    data = deferred(Column(LargeBinary, nullable=False))
+
+
+class ArchivedBlobChunk(Base):
+    """Maps a blob stored in shared chunks to its chunks."""
+    __tablename__ = 'archived_blob_chunk'
+    blob_id = Column(Integer, ForeignKey('archived_blob_info.blob_id'),
+        primary_key=True, nullable=False)
+    chunk_index = Column(Integer, primary_key=True, nullable=False,
+        autoincrement=False)
+    chunk_id = Column(Integer, ForeignKey('archived_shared_chunk.chunk_id'),
+        nullable=False, index=True)
+
+
 class ArchivedBlobLink(Base):
     """A binary file linked to a version of an object."""
     __tablename__ = 'archived_blob_link'
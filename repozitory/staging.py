@@ -0,0 +1,184 @@
+
+"""Single-pass ingest of blob data.
+
+Archive reads each blob only once.  As the data is read, it is hashed
+and copied to a staging file.  After the hashes are known, Archive
+either discards the staged copy (when the archive already contains a
+blob with the same data) or uploads the data from the staged copy.
+This avoids reading the original blob twice and makes it possible to
+archive blobs that can only be read once, such as WSGI input streams
+and generators.
+"""
+
+import hashlib
+import tempfile
+
+try:  # pragma: no cover
+    import pyblake2
+except ImportError:
+    pyblake2 = None
+
+
+def new_hash(name):
+    """Create a hash object given an algorithm name such as 'sha256'.
+
+    BLAKE2 algorithms are also available in Python 2 when the pyblake2
+    package is installed.
+    """
+    try:
+        return hashlib.new(name)
+    except ValueError:
+        func = getattr(pyblake2, name, None)
+        if func is None:
+            raise ValueError("Unsupported hash algorithm: %s" % name)
+        return func()
+
+
+class DigestedBlob(object):
+    """A blob accompanied by digests that the caller has already computed.
+
+    Use as a value in IObjectVersion.blobs.  data is a filename, file,
+    or iterable, as for any other blob.  digests maps hash algorithm
+    names (such as 'sha256') to hex digests.  length, if known, is the
+    length of the data in bytes.
+    """
+
+    def __init__(self, data, digests, length=None):
+        self.data = data
+        self.digests = digests
+        self.length = length
+
+
+def iter_blob_data(value, chunk_size):
+    """Iterate over the data of a blob in strings of up to chunk_size bytes.
+
+    The value may be a filename, a file-like object (seekable or not),
+    an iterable of strings such as a generator, or a DigestedBlob.
+    Seekable files are read from the beginning.
+    """
+    if isinstance(value, DigestedBlob):
+        value = value.data
+    if isinstance(value, basestring):
+        f = open(value, 'rb')
+        try:
+            for data in _iter_file(f, chunk_size):
+                yield data
+        finally:
+            f.close()
+    elif hasattr(value, 'read'):
+        seek = getattr(value, 'seek', None)
+        if seek is not None:
+            try:
+                seek(0)
+            except (IOError, OSError):
+                # Not seekable, such as a pipe.  Read from where it is.
+                pass
+        for data in _iter_file(value, chunk_size):
+            yield data
+    else:
+        for data in value:
+            if data:
+                yield data
+
+
+def _iter_file(f, chunk_size):
+    while True:
+        data = f.read(chunk_size)
+        if not data:
+            break
+        yield data
+
+
+def _rechunk(strings, chunk_size):
+    """Regroup an iterable of strings into chunks of chunk_size bytes."""
+    buf = []
+    size = 0
+    for data in strings:
+        buf.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            data = ''.join(buf)
+            while len(data) >= chunk_size:
+                yield data[:chunk_size]
+                data = data[chunk_size:]
+            buf = [data] if data else []
+            size = len(data)
+    if size:
+        yield ''.join(buf)
+
+
+class StagedBlob(object):
+    """Blob data that has been hashed and copied to a staging file.
+
+    The digests attribute maps each of the requested hash algorithm
+    names to a hex digest.  Blobs larger than spool_size are staged on
+    disk.  If the value is a DigestedBlob, the digests it provides are
+    verified.
+    """
+
+    def __init__(self, value, chunk_size, spool_size,
+            algorithms=('md5', 'sha256')):
+        self.chunk_size = chunk_size
+        self.file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        length = 0
+        hashes = [(name, new_hash(name)) for name in algorithms]
+        write = self.file.write
+        try:
+            for data in iter_blob_data(value, chunk_size):
+                length += len(data)
+                for _, h in hashes:
+                    h.update(data)
+                write(data)
+        except:
+            self.close()
+            raise
+        self.length = length
+        self.digests = dict((name, h.hexdigest()) for (name, h) in hashes)
+
+        if isinstance(value, DigestedBlob):
+            for name, digest in value.digests.items():
+                expect = self.digests.get(name)
+                if expect is not None and expect != digest.lower():
+                    self.close()
+                    raise ValueError("The %s digest of the blob is %s, "
+                        "not %s" % (name, expect, digest))
+            if value.length is not None and value.length != length:
+                self.close()
+                raise ValueError("The length of the blob is %d, not %d" %
+                    (length, value.length))
+
+    def iter_chunks(self):
+        """Iterate over the staged data in chunks of chunk_size bytes."""
+        f = self.file
+        f.seek(0)
+        return _iter_file(f, self.chunk_size)
+
+    def close(self):
+        self.file.close()
+
+
+class TrustedBlob(object):
+    """A DigestedBlob whose digests are trusted without hashing.
+
+    Provides the same attributes as StagedBlob, but reads the data only
+    if iter_chunks() is called.  The length attribute is None if the
+    caller did not provide it, until iter_chunks() has been consumed.
+    """
+
+    def __init__(self, value, chunk_size):
+        self.value = value
+        self.chunk_size = chunk_size
+        self.length = value.length
+        self.digests = dict((name, digest.lower())
+            for (name, digest) in value.digests.items())
+
+    def iter_chunks(self):
+        length = 0
+        for data in _rechunk(
+                iter_blob_data(self.value, self.chunk_size), self.chunk_size):
+            length += len(data)
+            yield data
+        self.length = length
+
+    def close(self):
+        pass
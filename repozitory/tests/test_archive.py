@@ -239,6 +239,420 @@ class ArchiveTest(unittest.TestCase):
         self.assertEqual(rows[0].version_num, 1)
         self.assertEqual(rows[0].name, 'readme.txt')
 
+    def test_archive_with_generator_blob(self):
+        archive = self._make_default()
+        archive.chunk_size = 3
+        obj = self._make_dummy_object_version()
+        obj.blobs = {'x': (s for s in ['ab', 'cde', '', 'f'])}
+        archive.archive(obj)
+
+        from repozitory.schema import ArchivedChunk
+        rows = (archive.session.query(ArchivedChunk)
+            .order_by(ArchivedChunk.chunk_index)
+            .all())
+        self.assertEqual([row.data for row in rows], ['abc', 'def'])
+
+        records = archive.history(obj.docid)
+        self.assertEqual(records[0].blobs['x'].read(), 'abcdef')
+
+    def test_archive_with_unseekable_blob_reads_once(self):
+        f = UnseekableFile('42')
+        obj = self._make_dummy_object_version()
+        obj.blobs = {'readme.txt': f}
+        archive = self._make_default()
+        archive.archive(obj)
+        self.assertEqual(f.reads, 2)  # The data, then the end of the file
+
+        from repozitory.schema import ArchivedChunk
+        rows = archive.session.query(ArchivedChunk).all()
+        self.assertEqual([row.data for row in rows], ['42'])
+
+    def test_archive_hashes_blobs_concurrently(self):
+        import threading
+        cond = threading.Condition()
+        started = []
+
+        def gen(data):
+            # Wait until both blobs are being read at once.
+            cond.acquire()
+            try:
+                started.append(data)
+                cond.notifyAll()
+                while len(started) < 2:
+                    cond.wait(5)
+                    if len(started) < 2:
+                        raise AssertionError('Blobs read serially')
+            finally:
+                cond.release()
+            yield data
+
+        archive = self._make_default()
+        archive.hash_threads = 2
+        obj = self._make_dummy_object_version()
+        obj.blobs = {'a': gen('42'), 'b': gen('43')}
+        archive.archive(obj)
+        self.assertEqual(sorted(started), ['42', '43'])
+
+        records = archive.history(obj.docid)
+        blobs = records[0].blobs
+        self.assertEqual(blobs['a'].read(), '42')
+        self.assertEqual(blobs['b'].read(), '43')
+
+    def test_archive_with_broken_blob_in_thread_pool(self):
+        def gen():
+            yield '42'
+            raise ValueError('broken')
+
+        archive = self._make_default()
+        archive.hash_threads = 2
+        obj = self._make_dummy_object_version()
+        obj.blobs = {'a': StringIO('42'), 'b': gen()}
+        self.assertRaises(ValueError, archive.archive, obj)
+
+    def test_archive_many_hashes_blobs_of_all_objects(self):
+        archive = self._make_default()
+        archive.hash_threads = 3
+        objs = []
+        for docid in (4, 5, 6):
+            obj = self._make_dummy_object_version(docid)
+            obj.blobs = {'x': StringIO(str(docid)), 'y': StringIO('same')}
+            objs.append(obj)
+        archive.archive_many(objs)
+
+        from repozitory.schema import ArchivedBlobInfo
+        self.assertEqual(archive.session.query(ArchivedBlobInfo).count(), 4)
+        for docid in (4, 5, 6):
+            blobs = archive.history(docid)[0].blobs
+            self.assertEqual(blobs['x'].read(), str(docid))
+            self.assertEqual(blobs['y'].read(), 'same')
+
+    def test_archive_many_stages_blobs_in_windows(self):
+        archive = self._make_default()
+        archive.hash_threads = 2
+        stage_blobs = archive._stage_blobs
+        windows = []
+
+        def _stage_blobs(values):
+            for staged_list in windows:
+                for staged in staged_list:
+                    self.assertTrue(staged.file.closed)
+            staged_list = stage_blobs(values)
+            windows.append(staged_list)
+            return staged_list
+        archive._stage_blobs = _stage_blobs
+        objs = []
+        for docid in (4, 5, 6):
+            obj = self._make_dummy_object_version(docid)
+            obj.blobs = {'x': StringIO(str(docid))}
+            objs.append(obj)
+        archive.archive_many(objs)
+        self.assertEqual([len(staged_list) for staged_list in windows], [2, 1])
+        for docid in (4, 5, 6):
+            blobs = archive.history(docid)[0].blobs
+            self.assertEqual(blobs['x'].read(), str(docid))
+
+    def test_archive_with_blob_digest(self):
+        archive = self._make_default()
+        archive.blob_digest = 'sha1'
+        obj = self._make_dummy_object_version()
+        obj.blobs = {'a': StringIO('42'), 'b': StringIO('42')}
+        archive.archive(obj)
+
+        from repozitory.schema import ArchivedBlobInfo
+        rows = archive.session.query(ArchivedBlobInfo).all()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0].digest,
+            'sha1:92cfceb39d57d914ed8b14d0e37643de0797ae56')
+        self.assertEqual(rows[0].md5, None)
+        self.assertEqual(rows[0].sha256, None)
+        self.assertEqual(rows[0].length, 2)
+
+    def test_archive_with_trusted_digest_skips_reading(self):
+        from repozitory.staging import DigestedBlob
+        archive = self._make_default()
+        archive.blob_digest = 'sha256'
+        archive.trust_blob_digests = True
+        sha256 = ('73475cb40a568e8da8a045ced110137e'
+            '159f890ac4da883b6b17dc651b3a8049')
+        obj = self._make_dummy_object_version()
+        obj.blobs = {'a': DigestedBlob(StringIO('42'), {'sha256': sha256})}
+        archive.archive(obj)
+
+        f = UnseekableFile('42')
+        obj.blobs = {'a': DigestedBlob(f, {'sha256': sha256})}
+        archive.archive(obj)
+        self.assertEqual(f.reads, 0)
+
+        from repozitory.schema import ArchivedBlobInfo
+        rows = archive.session.query(ArchivedBlobInfo).all()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0].length, 2)
+        self.assertEqual(rows[0].sha256, sha256)
+        records = archive.history(obj.docid)
+        self.assertEqual(records[0].blobs['a'].read(), '42')
+
+    def test_archive_with_untrusted_digest_verifies(self):
+        from repozitory.staging import DigestedBlob
+        archive = self._make_default()
+        obj = self._make_dummy_object_version()
+        obj.blobs = {'a': DigestedBlob(StringIO('42'), {'sha256': 'bad'})}
+        self.assertRaises(ValueError, archive.archive, obj)
+
+    def test_archive_trusted_without_length_hashes(self):
+        # MD5 and SHA-256 matching also requires the length.
+        from repozitory.staging import DigestedBlob
+        archive = self._make_default()
+        archive.trust_blob_digests = True
+        f = UnseekableFile('42')
+        obj = self._make_dummy_object_version()
+        obj.blobs = {'a': DigestedBlob(f, {
+            'md5': 'a1d0c6e83f027327d8461063f4ac58a6',
+            'sha256': '73475cb40a568e8da8a045ced110137e'
+                '159f890ac4da883b6b17dc651b3a8049'})}
+        archive.archive(obj)
+        self.assertEqual(f.reads, 2)
+
+    def test_archive_with_chunk_codec(self):
+        archive = self._make_default()
+        archive.chunk_codec = 'zlib'
+        archive.chunk_size = 1000
+        obj = self._make_dummy_object_version()
+        expect_blob = 'abc,def\n' * 200
+        obj.blobs = {'x': StringIO(expect_blob), 'y': StringIO('42')}
+        archive.archive(obj)
+
+        from repozitory.schema import ArchivedBlobInfo
+        from repozitory.schema import ArchivedChunk
+        rows = (archive.session.query(ArchivedChunk)
+            .join(ArchivedBlobInfo)
+            .order_by(ArchivedBlobInfo.length.desc(),
+                ArchivedChunk.chunk_index)
+            .all())
+        self.assertEqual([row.codec for row in rows], ['zlib', 'zlib', None])
+        self.assertEqual([row.chunk_length for row in rows], [1000, 600, 2])
+        self.assertTrue(len(rows[0].data) < 1000)
+        self.assertEqual(rows[2].data, '42')
+
+        blobs = archive.history(obj.docid)[0].blobs
+        self.assertEqual(blobs['x'].read(), expect_blob)
+        self.assertEqual(blobs['y'].read(), '42')
+
+    def test_archive_with_chunk_codec_skips_compressed_data(self):
+        archive = self._make_default()
+        archive.chunk_codec = 'zlib'
+        obj = self._make_dummy_object_version()
+        expect_blob = 'PK\x03\x04' + '\x00' * 1000
+        obj.blobs = {'x': StringIO(expect_blob)}
+        archive.archive(obj)
+
+        from repozitory.schema import ArchivedChunk
+        rows = archive.session.query(ArchivedChunk).all()
+        self.assertEqual(rows[0].codec, None)
+        self.assertEqual(rows[0].data, expect_blob)
+
+    def _archive_with_content_defined_chunking(self, archive):
+        import random
+        r = random.Random(42)
+        data = ''.join(chr(r.randrange(256)) for _ in xrange(20000))
+        archive.content_defined_chunking = True
+        archive.chunk_size = 256
+        obj = self._make_dummy_object_version()
+        obj.blobs = {'x': StringIO(data)}
+        archive.archive(obj)
+        edited = data[:10000] + 'edited' + data[10000:]
+        obj.blobs = {'x': StringIO(edited)}
+        archive.archive(obj)
+        return data, edited
+
+    def test_archive_with_content_defined_chunking(self):
+        archive = self._make_default()
+        data, edited = self._archive_with_content_defined_chunking(
+            archive)
+
+        from repozitory.schema import ArchivedBlobChunk
+        from repozitory.schema import ArchivedBlobInfo
+        from repozitory.schema import ArchivedChunk
+        from repozitory.schema import ArchivedSharedChunk
+        session = archive.session
+        self.assertEqual(session.query(ArchivedChunk).count(), 0)
+        blobs = session.query(ArchivedBlobInfo).all()
+        self.assertEqual([blob.storage for blob in blobs],
+            ['shared', 'shared'])
+        links = session.query(ArchivedBlobChunk).count()
+        chunks = session.query(ArchivedSharedChunk).all()
+        # Only the chunks around the edit are stored again.
+        chunk_count = sum(blob.chunk_count for blob in blobs)
+        self.assertEqual(links, chunk_count)
+        self.assertTrue(len(chunks) <= blobs[0].chunk_count + 3)
+        self.assertEqual(sum(chunk.ref_count for chunk in chunks),
+            chunk_count)
+
+        records = archive.history(4)
+        self.assertEqual(records[0].blobs['x'].read(), edited)
+        self.assertEqual(records[1].blobs['x'].read(), data)
+
+    def test_shred_releases_shared_chunks(self):
+        archive = self._make_default()
+        self._archive_with_content_defined_chunking(archive)
+        obj = self._make_dummy_object_version(5)
+        obj.blobs = {'y': StringIO('42')}
+        archive.archive(obj)
+        archive.shred([4])
+
+        from repozitory.schema import ArchivedBlobChunk
+        from repozitory.schema import ArchivedSharedChunk
+        session = archive.session
+        self.assertEqual(session.query(ArchivedBlobChunk).count(), 1)
+        rows = session.query(ArchivedSharedChunk).all()
+        self.assertEqual([(row.data, row.ref_count) for row in rows],
+            [('42', 1)])
+
+    def test_archive_stores_blobs_before_locking_object(self):
+        def first(text):
+            return min(i for (i, statement) in enumerate(statements)
+                if text in statement)
+
+        archive = self._make_default()
+        statements = self._count_statements(archive)
+        obj = self._make_dummy_object_version()
+        obj.blobs = {'x': StringIO('42')}
+        archive.archive(obj)
+        self.assertTrue(first('INSERT INTO archived_blob_info') <
+            first('archived_object '))
+
+        del statements[:]
+        obj.blobs = {'x': StringIO('43')}
+        archive.archive_many([obj])
+        self.assertTrue(first('INSERT INTO archived_blob_info') <
+            first('archived_object '))
+
+    def test_archive_with_blob_store(self):
+        import os
+        import shutil
+        import tempfile
+        import transaction
+        from repozitory.blobstore import FilesystemBlobStore
+        tempdir = tempfile.mkdtemp()
+        try:
+            archive = self._make_default()
+            archive.blob_store = FilesystemBlobStore(tempdir, fsync=False)
+            obj = self._make_dummy_object_version()
+            obj.blobs = {'x': StringIO('42')}
+            archive.archive(obj)
+
+            from repozitory.schema import ArchivedBlobInfo
+            from repozitory.schema import ArchivedChunk
+            session = archive.session
+            self.assertEqual(session.query(ArchivedChunk).count(), 0)
+            row = session.query(ArchivedBlobInfo).one()
+            self.assertEqual(row.storage, 'store')
+            self.assertEqual(row.chunk_count, 0)
+            self.assertEqual(row.length, 2)
+            path = archive.blob_store.path('sha256:' + row.sha256)
+            self.assertEqual(open(path, 'rb').read(), '42')
+
+            f = archive.history(4)[0].blobs['x']
+            self.assertEqual(f.read(), '42')
+            self.assertEqual(f.name, path)
+            f.close()
+
+            archive.shred([4])
+            self.assertTrue(os.path.exists(path))
+            transaction.commit()
+            self.assertFalse(os.path.exists(path))
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_shred_keeps_blob_store_key_used_by_legacy_blob(self):
+        import os
+        import shutil
+        import tempfile
+        import transaction
+        from repozitory.blobstore import FilesystemBlobStore
+        tempdir = tempfile.mkdtemp()
+        try:
+            archive = self._make_default()
+            archive.blob_store = FilesystemBlobStore(tempdir, fsync=False)
+            obj = self._make_dummy_object_version()
+            obj.docid = 1
+            obj.blobs = {'x': StringIO('42')}
+            archive.archive(obj)
+            archive.blob_digest = 'sha256'
+            obj.docid = 2
+            obj.blobs = {'x': StringIO('42')}
+            archive.archive(obj)
+            transaction.commit()
+
+            from repozitory.schema import ArchivedBlobInfo
+            rows = archive.session.query(ArchivedBlobInfo).all()
+            self.assertEqual(len(rows), 2)
+            path = archive.blob_store.path('sha256:' + rows[0].sha256)
+
+            archive.shred([2])
+            transaction.commit()
+            self.assertTrue(os.path.exists(path))
+            f = archive.history(1)[0].blobs['x']
+            self.assertEqual(f.read(), '42')
+            f.close()
+
+            archive.shred([1])
+            transaction.commit()
+            self.assertFalse(os.path.exists(path))
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_abort_deletes_new_blobs_from_blob_store(self):
+        import os
+        import shutil
+        import tempfile
+        import transaction
+        from repozitory.blobstore import FilesystemBlobStore
+        tempdir = tempfile.mkdtemp()
+        try:
+            archive = self._make_default()
+            archive.blob_store = FilesystemBlobStore(tempdir, fsync=False)
+            obj = self._make_dummy_object_version()
+            obj.blobs = {'x': StringIO('42')}
+            archive.archive(obj)
+            transaction.commit()
+
+            # Only the blob stored by the aborted transaction is deleted.
+            obj.blobs = {'x': StringIO('42'), 'y': StringIO('43')}
+            archive.archive(obj)
+            transaction.abort()
+            files = []
+            for dirpath, dirnames, filenames in os.walk(tempdir):
+                files.extend(filenames)
+            self.assertEqual(len(files), 1)
+            self.assertEqual(archive.history(4)[0].blobs['x'].read(), '42')
+
+            archive.shred([4])
+            transaction.commit()
+            obj.blobs = {'y': StringIO('43')}
+            archive.archive(obj)
+            transaction.abort()
+            for dirpath, dirnames, filenames in os.walk(tempdir):
+                self.assertEqual(filenames, [])
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_history_of_stored_blob_without_blob_store(self):
+        import shutil
+        import tempfile
+        from repozitory.blobstore import FilesystemBlobStore
+        tempdir = tempfile.mkdtemp()
+        try:
+            archive = self._make_default()
+            archive.blob_store = FilesystemBlobStore(tempdir, fsync=False)
+            obj = self._make_dummy_object_version()
+            obj.blobs = {'x': StringIO('42')}
+            archive.archive(obj)
+            del archive.blob_store
+            f = archive.history(4)[0].blobs['x']
+            self.assertRaises(IOError, getattr, f, 'read')
+        finally:
+            shutil.rmtree(tempdir)
+
     def test_archive_deduplicates_blobs(self):
         obj = self._make_dummy_object_version()
         obj.blobs = {'readme.txt': StringIO('42')}
@@ -299,6 +713,325 @@ class ArchiveTest(unittest.TestCase):
         with self.assertRaises(TypeError):
             archive.archive(obj)
 
+    def test_archive_maintains_latest_version(self):
+        archive = self._make_default()
+        obj = self._make_dummy_object_version()
+        archive.archive(obj)
+        archive.archive(obj)
+        archive.reverted(4, 1)
+        self.assertEqual(archive.archive(obj), 3)
+        from repozitory.schema import ArchivedObject
+        row = archive.session.query(ArchivedObject).one()
+        self.assertEqual(row.latest_version, 3)
+
+    def test_archive_without_latest_version(self):
+        # Objects archived by repozitory 1.3 have no latest_version.
+        archive = self._make_default()
+        obj = self._make_dummy_object_version()
+        archive.archive(obj)
+        archive.archive(obj)
+        from repozitory.schema import ArchivedObject
+        row = archive.session.query(ArchivedObject).one()
+        row.latest_version = None
+        archive.session.flush()
+        self.assertEqual(archive.archive(obj), 3)
+        self.assertEqual(row.latest_version, 3)
+
+    def test_archive_many_without_latest_version(self):
+        archive = self._make_default()
+        obj = self._make_dummy_object_version()
+        archive.archive(obj)
+        from repozitory.schema import ArchivedObject
+        row = archive.session.query(ArchivedObject).one()
+        row.latest_version = None
+        archive.session.flush()
+        self.assertEqual(archive.archive_many([obj, obj]), [2, 3])
+        row = archive.session.query(ArchivedObject).one()
+        self.assertEqual(row.latest_version, 3)
+
+    def test_archive_with_skip_unchanged(self):
+        archive = self._make_default()
+        archive.skip_unchanged = True
+        obj = self._make_dummy_object_version()
+        obj.blobs = {'readme.txt': StringIO('42')}
+        self.assertEqual(archive.archive(obj), 1)
+        # Changes to modified, user, and comment do not count.
+        obj.modified = datetime.datetime(2011, 4, 8)
+        obj.user = 'other'
+        obj.comment = 'no change'
+        obj.blobs = {'readme.txt': StringIO('42')}
+        self.assertEqual(archive.archive(obj), 1)
+        obj.blobs = {'readme.txt': StringIO('43')}
+        self.assertEqual(archive.archive(obj), 2)
+        obj.attrs = {'a': 2}
+        self.assertEqual(archive.archive(obj), 3)
+        self.assertEqual(archive.archive(obj), 3)
+
+        from repozitory.schema import ArchivedState
+        rows = (archive.session.query(ArchivedState)
+            .order_by(ArchivedState.version_num)
+            .all())
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(len(set(row.fingerprint for row in rows)), 3)
+        from repozitory.schema import ArchivedObject
+        row = archive.session.query(ArchivedObject).one()
+        self.assertEqual(row.latest_version, 3)
+
+    def test_archive_with_skip_unchanged_after_revert(self):
+        archive = self._make_default()
+        archive.skip_unchanged = True
+        obj = self._make_dummy_object_version()
+        archive.archive(obj)
+        obj.title = u'Changed'
+        archive.archive(obj)
+        archive.reverted(4, 1)
+        # The object now differs from the current version.
+        self.assertEqual(archive.archive(obj), 3)
+        obj.title = DummyObjectVersion.title
+        archive.reverted(4, 1)
+        self.assertEqual(archive.archive(obj), 1)
+
+    def test_archive_without_skip_unchanged(self):
+        archive = self._make_default()
+        obj = self._make_dummy_object_version()
+        self.assertEqual(archive.archive(obj), 1)
+        self.assertEqual(archive.archive(obj), 2)
+        from repozitory.schema import ArchivedState
+        rows = archive.session.query(ArchivedState).all()
+        self.assertEqual([row.fingerprint for row in rows], [None, None])
+
+    def test_archive_many_with_skip_unchanged(self):
+        archive = self._make_default()
+        archive.skip_unchanged = True
+        obj4 = self._make_dummy_object_version()
+        archive.archive(obj4)
+        obj6 = self._make_dummy_object_version(6)
+        obj6b = self._make_dummy_object_version(6)
+        obj6b.title = u'Changed'
+        versions = archive.archive_many([obj4, obj6, obj6, obj6b, obj6b])
+        self.assertEqual(versions, [1, 1, 1, 2, 2])
+        self.assertEqual(archive.archive_many([obj4]), [1])
+        from repozitory.schema import ArchivedState
+        self.assertEqual(archive.session.query(ArchivedState).count(), 3)
+
+    def _archive_attrs_sequence(self, archive):
+        obj = self._make_dummy_object_version()
+        expect = []
+        for i in range(7):
+            obj.attrs = {'i': i, 'big': u'x' * 100}
+            if i == 2:
+                obj.attrs['extra'] = True
+            if i == 5:
+                obj.attrs = None
+            archive.archive(obj)
+            expect.append(obj.attrs or {})
+        return expect
+
+    def test_archive_with_attrs_snapshot_interval(self):
+        archive = self._make_default()
+        archive.attrs_snapshot_interval = 3
+        expect = self._archive_attrs_sequence(archive)
+
+        from repozitory.schema import ArchivedState
+        rows = (archive.session.query(ArchivedState)
+            .order_by(ArchivedState.version_num)
+            .all())
+        self.assertEqual([row.attrs_base for row in rows],
+            [None, 1, 1, None, 4, None, None])
+        self.assertEqual(rows[1].attrs, None)
+        self.assertEqual(rows[1].attrs_delta, {'set': {'i': 1}})
+        self.assertEqual(rows[3].attrs_delta, None)
+        self.assertEqual(rows[3].attrs, expect[3])
+
+        records = archive.history(4)
+        self.assertEqual([r.attrs for r in reversed(records)], expect)
+        for version_num in range(1, 8):
+            self.assertEqual(archive.get_version(4, version_num).attrs,
+                expect[version_num - 1])
+        archive.reverted(4, 3)
+        records = archive.history(4, only_current=True)
+        self.assertEqual(records[0].attrs, expect[2])
+
+    def test_archive_many_with_attrs_snapshot_interval(self):
+        archive = self._make_default()
+        archive.attrs_snapshot_interval = 3
+        obj = self._make_dummy_object_version()
+        archive.archive(obj)
+        objs = []
+        for i in range(4):
+            obj = self._make_dummy_object_version()
+            obj.attrs = {'a': 1, 'b': [2], 'i': i}
+            objs.append(obj)
+        self.assertEqual(archive.archive_many(objs), [2, 3, 4, 5])
+
+        from repozitory.schema import ArchivedState
+        rows = (archive.session.query(ArchivedState)
+            .order_by(ArchivedState.version_num)
+            .all())
+        self.assertEqual([row.attrs_base for row in rows],
+            [None, 1, 1, None, 4])
+        self.assertEqual(archive.get_version(4, 3).attrs, objs[1].attrs)
+        self.assertEqual(archive.get_version(4, 5).attrs, objs[3].attrs)
+
+    def test_postgresql_archive_statement(self):
+        from repozitory.archive import _get_postgresql_archive_statement
+        from sqlalchemy.dialects.postgresql.base import PGDialect
+        dialect = PGDialect()
+        names = ['attrs', 'docid', 'user']
+        stmt = _get_postgresql_archive_statement(dialect, names)
+        self.assertTrue(
+            _get_postgresql_archive_statement(dialect, names) is stmt)
+        sql = unicode(stmt.compile(dialect=dialect))
+        self.assertTrue('ON CONFLICT (docid)' in sql)
+        self.assertTrue(
+            'derived_from_version, "attrs", "docid", "user")' in sql)
+
+    def test_use_postgresql_fast_path(self):
+        class DummyDialect(object):
+            name = 'postgresql'
+            server_version_info = (9, 5, 3)
+
+        class DummyEngine(object):
+            dialect = DummyDialect()
+
+        class DummySession(object):
+            bind = DummyEngine()
+            connected = False
+
+            def connection(self):
+                self.connected = True
+
+        archive = self._make_default()
+        session = DummySession()
+        self.assertTrue(archive._use_postgresql_fast_path(session))
+        self.assertTrue(session.connected)
+        session.bind.dialect.server_version_info = (9, 4, 10)
+        self.assertFalse(archive._use_postgresql_fast_path(session))
+        session.bind.dialect.name = 'sqlite'
+        session.bind.dialect.server_version_info = (3, 8)
+        self.assertFalse(archive._use_postgresql_fast_path(session))
+        session.bind.dialect.name = 'postgresql'
+        session.bind.dialect.server_version_info = (10, 1)
+        self.assertTrue(archive._use_postgresql_fast_path(session))
+        archive.skip_unchanged = True
+        self.assertFalse(archive._use_postgresql_fast_path(session))
+
+    def test_archive_caches_class_id_after_commit(self):
+        import transaction
+        from repozitory.archive import _class_ids
+        archive = self._make_default()
+        obj = self._make_dummy_object_version()
+        archive.archive(obj)
+        self.assertEqual(_class_ids.get('sqlite:///'), {})
+        transaction.commit()
+        key = (u'repozitory.tests.test_archive', u'DummyObjectVersion')
+        cache = _class_ids['sqlite:///']
+        self.assertEqual(cache[key][0], DummyObjectVersion)
+        class_id = cache[key][1]
+
+        # Use the cache without importing the class again.
+        import repozitory.archive
+        orig_find_class = repozitory.archive.find_class
+        repozitory.archive.find_class = None
+        try:
+            self.assertEqual(archive._prepare_class_id(DummyObjectVersion),
+                class_id)
+        finally:
+            repozitory.archive.find_class = orig_find_class
+
+    def test_archive_does_not_cache_class_id_after_abort(self):
+        import transaction
+        from repozitory.archive import _class_ids
+        archive = self._make_default()
+        obj = self._make_dummy_object_version()
+        archive.archive(obj)
+        archive.archive(self._make_dummy_object_version(5))
+        transaction.abort()
+        self.assertEqual(_class_ids.get('sqlite:///'), {})
+
+        # The class is added again after the abort.
+        archive.archive(obj)
+        transaction.commit()
+        from repozitory.schema import ArchivedClass
+        rows = archive.session.query(ArchivedClass).all()
+        self.assertEqual(len(rows), 1)
+        key = (u'repozitory.tests.test_archive', u'DummyObjectVersion')
+        self.assertEqual(_class_ids['sqlite:///'][key],
+            (DummyObjectVersion, rows[0].class_id))
+
+    def test_class_id_cache_size(self):
+        import transaction
+        from repozitory.archive import _class_ids
+        archive = self._make_default()
+        archive.class_id_cache_size = 1
+        archive.archive(self._make_dummy_object_version())
+        obj = self._make_dummy_object_version(5)
+        obj.klass = DummyContainerVersion
+        archive.archive(obj)
+        transaction.commit()
+        self.assertEqual(len(_class_ids['sqlite:///']), 1)
+
+    def test_archive_many_empty(self):
+        archive = self._make_default()
+        self.assertEqual(archive.archive_many([]), [])
+
+    def test_archive_many_new_and_existing_objects(self):
+        archive = self._make_default()
+        obj4 = self._make_dummy_object_version()
+        archive.archive(obj4)
+        archive.reverted(4, 1)
+        obj4.title = u'Changed'
+        obj4.blobs = {'readme.txt': StringIO('42')}
+        obj6 = self._make_dummy_object_version(6)
+        obj6b = self._make_dummy_object_version(6)
+        obj6b.comment = u'second'
+
+        versions = archive.archive_many([obj4, obj6, obj6b])
+        self.assertEqual(versions, [2, 1, 2])
+
+        from repozitory.schema import ArchivedObject
+        rows = (archive.session.query(ArchivedObject)
+            .order_by(ArchivedObject.docid)
+            .all())
+        self.assertEqual([row.docid for row in rows], [4, 6])
+
+        from repozitory.schema import ArchivedCurrent
+        rows = (archive.session.query(ArchivedCurrent)
+            .order_by(ArchivedCurrent.docid)
+            .all())
+        self.assertEqual([(row.docid, row.version_num) for row in rows],
+            [(4, 2), (6, 2)])
+
+        records = archive.history(6)
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0].comment, u'second')
+        self.assertEqual(records[0].derived_from_version, 1)
+        self.assertEqual(records[1].derived_from_version, None)
+        self.assertEqual(records[1].attrs, {'a': 1, 'b': [2]})
+        self.assertEqual(records[1].klass, DummyObjectVersion)
+
+        record = archive.get_version(4, 2)
+        self.assertEqual(record.title, u'Changed')
+        self.assertEqual(record.derived_from_version, 1)
+        self.assertEqual(record.blobs['readme.txt'].read(), '42')
+
+    def test_archive_many_then_archive(self):
+        archive = self._make_default()
+        obj = self._make_dummy_object_version()
+        self.assertEqual(archive.archive_many([obj]), [1])
+        self.assertEqual(archive.archive(obj), 2)
+        self.assertEqual(archive.history(4)[0].current_version, 2)
+
+    def test_archive_many_broken_class(self):
+        class Unpickleable:
+            pass
+
+        obj = self._make_dummy_object_version()
+        obj.klass = Unpickleable
+        archive = self._make_default()
+        with self.assertRaises(TypeError):
+            archive.archive_many([obj])
+
     def test_history_item_implements_IObjectHistoryRecord(self):
         obj = self._make_dummy_object_version()
         obj.comment = 'change 1'
@@ -374,8 +1107,8 @@ class ArchiveTest(unittest.TestCase):
         self.assertTrue(records[0].blobs)
         self.assertEqual(records[0].blobs.keys(), ['x'])
         blob = records[0].blobs['x']
-        self.assertEqual(blob.getvalue(), '42')  # StringIO has getvalue()
         self.assertEqual(blob.read(), '42')
+        self.assertEqual(blob.tell(), 2)
         with self.assertRaises(IOError):
             blob.write('x')
         with self.assertRaises(IOError):
@@ -400,7 +1133,6 @@ class ArchiveTest(unittest.TestCase):
         self.assertTrue(records[0].blobs)
         self.assertEqual(records[0].blobs.keys(), ['x'])
         blob = records[0].blobs['x']
-        blob._max_stringio = 100
         self.assertFalse(hasattr(blob, 'getvalue'))
         self.assertEqual(blob.read(), 'data' * 1000)
         with self.assertRaises(IOError):
@@ -429,6 +1161,758 @@ class ArchiveTest(unittest.TestCase):
         self.assertEqual(len(actual_blob), len(expect_blob))
         self.assertEqual(actual_blob, expect_blob)
 
+    def _archive_blob(self, data, **kw):
+        archive = self._make_default()
+        archive.chunk_size = 10
+        for name, value in kw.items():
+            setattr(archive, name, value)
+        obj = self._make_dummy_object_version()
+        obj.blobs = {'x': StringIO(data)}
+        archive.archive(obj)
+        return archive
+
+    def _archive_blob_for_reader(self, data, **kw):
+        archive = self._archive_blob(data, **kw)
+        return archive.history(4)[0].blobs['x']
+
+    def _count_statements(self, archive):
+        from sqlalchemy import event
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(archive.session.bind, 'before_cursor_execute',
+            before_cursor_execute)
+        return statements
+
+    def test_blob_reader_seek_loads_one_chunk(self):
+        data = ''.join(chr(65 + i % 26) for i in range(1000))
+        blob = self._archive_blob_for_reader(data)
+        blob.seek(505)
+        self.assertEqual(blob.read(3), data[505:508])
+        self.assertEqual(blob._chunks.keys(), [50])
+        self.assertEqual(blob.tell(), 508)
+        blob.seek(-5, 1)
+        self.assertEqual(blob.read(10), data[503:513])
+        self.assertEqual(sorted(blob._chunks.keys()), [50, 51])
+        blob.seek(-2, 2)
+        self.assertEqual(blob.read(), data[-2:])
+        self.assertEqual(blob.read(), '')
+
+    def test_blob_reader_keeps_a_window_of_chunks(self):
+        data = ''.join(chr(65 + i % 26) for i in range(1000))
+        blob = self._archive_blob_for_reader(data)
+        self.assertEqual(blob.read(), data)
+        self.assertEqual(sorted(blob._chunks.keys()), [98, 99])
+        blob.seek(0)
+        self.assertEqual(blob.read(25), data[:25])
+        self.assertEqual(sorted(blob._chunks.keys()), [1, 2])
+
+    def test_blob_reader_lines(self):
+        data = 'first line\nsecond longer line\n\nlast'
+        blob = self._archive_blob_for_reader(data)
+        self.assertEqual(blob.readline(), 'first line\n')
+        self.assertEqual(blob.readline(3), 'sec')
+        self.assertEqual(blob.readline(), 'ond longer line\n')
+        self.assertEqual(list(blob), ['\n', 'last'])
+        blob.seek(0)
+        self.assertEqual(blob.readlines(), data.splitlines(True))
+
+    def test_blob_reader_with_compressed_shared_chunks(self):
+        data = 'abc' * 500
+        blob = self._archive_blob_for_reader(data,
+            chunk_codec='zlib', content_defined_chunking=True)
+        blob.seek(1000)
+        self.assertEqual(blob.read(10), data[1000:1010])
+        blob.seek(0)
+        self.assertEqual(blob.read(), data)
+
+    def test_blob_reader_iter_chunks(self):
+        data = 'abc,def\n' * 50
+        blob = self._archive_blob_for_reader(data, chunk_codec='zlib')
+        blob.seek(5)
+        chunks = list(blob.iter_chunks())
+        self.assertEqual(len(chunks), 40)
+        self.assertEqual(''.join(chunks), data)
+        self.assertEqual(blob.tell(), 5)
+        self.assertEqual(blob._chunks, {})
+
+    def test_iter_chunks_fetches_bounded_windows(self):
+        from repozitory import archive as archive_module
+        data = ''.join(chr(65 + i % 26) for i in range(100))
+        archive = self._archive_blob(data)
+        blob = archive.history(4)[0].blobs['x']
+        chunk_data_query = archive_module._chunk_data_query
+        windows = []
+
+        def _chunk_data_query(session, blob_id, storage, first, last):
+            windows.append((first, last))
+            return chunk_data_query(session, blob_id, storage, first, last)
+        archive_module._chunk_data_query = _chunk_data_query
+        try:
+            chunks = blob.iter_chunks()
+            self.assertEqual(chunks.next(), data[:10])
+            self.assertEqual(windows, [(0, 3)])
+            self.assertEqual(''.join(chunks), data[10:])
+            self.assertEqual(windows, [(0, 3), (4, 7), (8, 9)])
+            del windows[:]
+            pieces = list(archive.iter_blob(4, 1, 'x', 15, 60))
+            self.assertEqual(''.join(pieces), data[15:75])
+            self.assertEqual(windows, [(1, 4), (5, 7)])
+        finally:
+            archive_module._chunk_data_query = chunk_data_query
+
+    def test_stored_blob_reader_iter_chunks(self):
+        import shutil
+        import tempfile
+        from repozitory.blobstore import FilesystemBlobStore
+        tempdir = tempfile.mkdtemp()
+        try:
+            blob = self._archive_blob_for_reader('abcdefg',
+                blob_store=FilesystemBlobStore(tempdir, fsync=False))
+            self.assertEqual(list(blob.iter_chunks(3)), ['abc', 'def', 'g'])
+            self.assertEqual(blob.read(), 'abcdefg')
+            blob.close()
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_blob_reader_close(self):
+        blob = self._archive_blob_for_reader('42')
+        blob.close()
+        self.assertRaises(ValueError, blob.read)
+        self.assertRaises(ValueError, blob.seek, 0)
+
+    def test_blob_reader_empty(self):
+        blob = self._archive_blob_for_reader('')
+        self.assertEqual(blob.read(), '')
+        self.assertEqual(blob.readline(), '')
+
+    def test_read_blob_range(self):
+        data = ''.join(chr(65 + i % 26) for i in range(1000))
+        archive = self._archive_blob(data)
+        self.assertEqual(archive.read_blob(4, 1, 'x', 505, 20),
+            data[505:525])
+        self.assertEqual(archive.read_blob(4, 1, 'x', 990), data[990:])
+        self.assertEqual(archive.read_blob(4, 1, 'x', 995, 100), data[995:])
+        self.assertEqual(archive.read_blob(4, 1, 'x'), data)
+        self.assertEqual(archive.read_blob(4, 1, 'x', 1000), '')
+        self.assertEqual(archive.read_blob(4, 1, 'x', 10, 0), '')
+        self.assertRaises(ValueError, archive.read_blob, 4, 1, 'x', -1)
+
+    def test_iter_blob_fetches_overlapping_chunks_in_one_query(self):
+        archive = self._make_default()
+        archive.chunk_size = 10
+        statements = self._count_statements(archive)
+        data = ''.join(chr(65 + i % 26) for i in range(1000))
+        obj = self._make_dummy_object_version()
+        obj.blobs = {'x': StringIO(data)}
+        archive.archive(obj)
+        del statements[:]
+
+        pieces = list(archive.iter_blob(4, 1, 'x', 505, 20))
+        self.assertEqual(pieces, [data[505:510], data[510:520],
+            data[520:525]])
+        data_statements = [statement for statement in statements
+            if 'archived_chunk.data' in statement]
+        self.assertEqual(len(data_statements), 1)
+
+    def test_history_load_blobs_uses_one_query(self):
+        archive = self._make_default()
+        statements = self._count_statements(archive)
+        obj = self._make_dummy_object_version()
+        for i in range(5):
+            obj.blobs = {'x': StringIO('x%d' % i), 'y': StringIO('y')}
+            archive.archive(obj)
+        obj.blobs = None
+        archive.archive(obj)
+        del statements[:]
+
+        records = archive.history(4, load_blobs=True)
+        count = len(statements)
+        self.assertEqual(len(records), 6)
+        self.assertEqual(records[0].blobs, {})
+        for i, record in enumerate(reversed(records[1:])):
+            self.assertEqual(sorted(record.blobs), ['x', 'y'])
+            self.assertEqual(record.blobs['x'].read(), 'x%d' % i)
+        blob_statements = [statement for statement in statements[:count]
+            if 'FROM archived_blob_link' in statement]
+        self.assertEqual(len(blob_statements), 1)
+        # No more link queries after the records were created.
+        self.assertFalse([statement for statement in statements[count:]
+            if 'FROM archived_blob_link' in statement])
+
+    def test_history_only_current_load_blobs(self):
+        archive = self._make_default()
+        obj = self._make_dummy_object_version()
+        obj.blobs = {'x': StringIO('old')}
+        archive.archive(obj)
+        obj.blobs = {'x': StringIO('new')}
+        archive.archive(obj)
+        archive.reverted(4, 1)
+        records = archive.history(4, only_current=True, load_blobs=True)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0].blobs['x'].read(), 'old')
+
+    def _archive_versions(self, archive, count, **kw):
+        for attr, value in kw.items():
+            setattr(archive, attr, value)
+        obj = self._make_dummy_object_version()
+        for i in range(count):
+            obj.comment = u'v%d' % (i + 1)
+            obj.attrs = {'n': i + 1, 'fixed': 'x'}
+            archive.archive(obj)
+
+    def test_history_pages(self):
+        archive = self._make_default()
+        self._archive_versions(archive, 7, attrs_snapshot_interval=3)
+        page = archive.history(4, limit=3)
+        self.assertEqual([r.version_num for r in page], [7, 6, 5])
+        page = archive.history(4, limit=3, before_version=5)
+        self.assertEqual([r.version_num for r in page], [4, 3, 2])
+        self.assertEqual([r.attrs['n'] for r in page], [4, 3, 2])
+        self.assertEqual(page[0].current_version, 7)
+        page = archive.history(4, limit=3, before_version=2)
+        self.assertEqual([r.version_num for r in page], [1])
+        self.assertEqual(archive.history(4, limit=3, before_version=1), [])
+
+    def test_history_page_load_blobs(self):
+        archive = self._make_default()
+        obj = self._make_dummy_object_version()
+        for i in range(4):
+            obj.blobs = {'x': StringIO('x%d' % (i + 1))}
+            archive.archive(obj)
+        page = archive.history(4, limit=2, before_version=4,
+            load_blobs=True)
+        self.assertEqual([r.version_num for r in page], [3, 2])
+        self.assertEqual([r.blobs['x'].read() for r in page], ['x3', 'x2'])
+
+    def test_iter_history(self):
+        archive = self._make_default()
+        self._archive_versions(archive, 7, attrs_snapshot_interval=3)
+        records = list(archive.iter_history(4, batch_size=2))
+        self.assertEqual([r.version_num for r in records],
+            [7, 6, 5, 4, 3, 2, 1])
+        self.assertEqual([r.attrs['n'] for r in records],
+            [7, 6, 5, 4, 3, 2, 1])
+        self.assertEqual([r.comment for r in records][:2], [u'v7', u'v6'])
+        records = list(archive.iter_history(4, before_version=3))
+        self.assertEqual([r.version_num for r in records], [2, 1])
+        self.assertEqual(list(archive.iter_history(5)), [])
+
+    def test_history_summary_defers_heavy_columns(self):
+        archive = self._make_default()
+        statements = self._count_statements(archive)
+        obj = self._make_dummy_object_version()
+        obj.description = u'Long description'
+        archive.archive(obj)
+        obj.attrs = {'a': 2, 'b': [2]}
+        archive.archive(obj)
+        archive.session.expunge_all()
+        del statements[:]
+
+        records = archive.history(4, summary=True)
+        self.assertEqual([r.version_num for r in records], [2, 1])
+        self.assertEqual(records[0].user, u'tester')
+        self.assertEqual(records[0].comment, u'I like version control.')
+        self.assertEqual(len(statements), 1)
+        self.assertFalse('archived_state.attrs AS' in statements[-1])
+        self.assertFalse('attrs_delta' in statements[-1])
+        self.assertFalse('description' in statements[-1])
+        self.assertFalse('archived_class' in statements[-1])
+
+        self.assertEqual(records[1].description, u'Long description')
+        self.assertEqual(records[1].attrs, {'a': 1, 'b': [2]})
+        self.assertEqual(records[0].attrs, {'a': 2, 'b': [2]})
+        self.assertEqual(records[0].klass, DummyObjectVersion)
+
+    def test_history_and_get_version_use_one_query(self):
+        archive = self._make_default()
+        statements = self._count_statements(archive)
+        obj = self._make_dummy_object_version()
+        archive.archive(obj)
+        archive.archive(obj)
+        archive.reverted(4, 1)
+        archive.session.expunge_all()
+        del statements[:]
+
+        records = archive.history(4)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual([r.version_num for r in records], [2, 1])
+        self.assertEqual([r.current_version for r in records], [1, 1])
+        self.assertEqual(records[0].created, obj.created)
+        del statements[:]
+
+        records = archive.history(4, only_current=True)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual([r.version_num for r in records], [1])
+        del statements[:]
+
+        record = archive.get_version(4, 2)
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(record.version_num, 2)
+        self.assertEqual(record.current_version, 1)
+        self.assertEqual(record.created, obj.created)
+
+    def test_history_many(self):
+        archive = self._make_default()
+        self._archive_versions(archive, 3, attrs_snapshot_interval=2)
+        obj = self._make_dummy_object_version()
+        obj.docid = 5
+        archive.archive(obj)
+        res = archive.history_many([4, 5, 6, 4])
+        self.assertEqual(sorted(res), [4, 5, 6])
+        self.assertEqual([r.version_num for r in res[4]], [3, 2, 1])
+        self.assertEqual([r.attrs['n'] for r in res[4]], [3, 2, 1])
+        self.assertEqual([r.version_num for r in res[5]], [1])
+        self.assertEqual(res[5][0].docid, 5)
+        self.assertEqual(res[6], [])
+
+    def test_history_many_only_current_in_batches(self):
+        archive = self._make_default()
+        archive.docid_batch_size = 2
+        statements = self._count_statements(archive)
+        obj = self._make_dummy_object_version()
+        for docid in range(1, 6):
+            obj.docid = docid
+            archive.archive(obj)
+            archive.archive(obj)
+        archive.reverted(3, 1)
+        del statements[:]
+        res = archive.history_many(range(1, 6), only_current=True)
+        self.assertEqual(len(statements), 3)
+        self.assertEqual(dict((docid, [r.version_num for r in records])
+            for (docid, records) in res.items()),
+            {1: [2], 2: [2], 3: [1], 4: [2], 5: [2]})
+        self.assertEqual(res[3][0].current_version, 1)
+
+    def test_get_versions(self):
+        archive = self._make_default()
+        statements = self._count_statements(archive)
+        self._archive_versions(archive, 4, attrs_snapshot_interval=3)
+        obj = self._make_dummy_object_version()
+        obj.docid = 5
+        archive.archive(obj)
+        archive.reverted(4, 2)
+        del statements[:]
+        records = archive.get_versions(
+            [(5, 1), (4, 3), (4, 9), (4, 2), (6, 1), (4, 3)])
+        # One query for the states and one to reconstruct the attrs of
+        # version 2, a delta based on a version that was not requested.
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(
+            [r and (r.docid, r.version_num) for r in records],
+            [(5, 1), (4, 3), None, (4, 2), None, (4, 3)])
+        self.assertEqual(records[1].attrs['n'], 3)
+        self.assertEqual(records[3].attrs['n'], 2)
+        self.assertEqual(records[1].current_version, 2)
+        self.assertEqual(records[0].current_version, 1)
+        self.assertEqual(archive.get_versions([]), [])
+
+    def test_get_versions_in_batches(self):
+        archive = self._make_default()
+        archive.docid_batch_size = 2
+        self._archive_versions(archive, 5)
+        pairs = [(4, n) for n in (5, 1, 3, 2, 4)]
+        records = archive.get_versions(pairs)
+        self.assertEqual([r.version_num for r in records], [5, 1, 3, 2, 4])
+        self.assertEqual([r.attrs['n'] for r in records], [5, 1, 3, 2, 4])
+
+    def _make_caching(self, **kw):
+        import transaction
+        archive = self._make_default()
+        for name, value in kw.items():
+            setattr(archive, name, value)
+        obj = self._make_dummy_object_version()
+        archive.archive(obj)
+        obj.attrs = {'a': 2}
+        archive.archive(obj)
+        transaction.commit()
+        return archive
+
+    def test_get_version_from_cache(self):
+        archive = self._make_caching(version_cache_size=10)
+        statements = self._count_statements(archive)
+        record = archive.get_version(4, 1)
+        self.assertEqual(record.attrs, {'a': 1, 'b': [2]})
+        del statements[:]
+        record = archive.get_version(4, 1)
+        self.assertEqual(len(statements), 1)
+        self.assertTrue('archived_state' not in statements[0])
+        self.assertEqual(record.version_num, 1)
+        self.assertEqual(record.current_version, 2)
+        self.assertEqual(record.attrs, {'a': 1, 'b': [2]})
+        self.assertEqual(record.title, u'Cool Object')
+        self.assertEqual(record.description, None)
+        self.assertEqual(record.comment, u'I like version control.')
+        self.assertEqual(record.created, datetime.datetime(2011, 4, 6))
+        self.assertEqual(record.klass, DummyObjectVersion)
+        self.assertEqual(record.blobs, {})
+
+        # The current version is not cached.
+        archive.reverted(4, 1)
+        self.assertEqual(archive.get_version(4, 2).current_version, 1)
+
+    def test_version_cache_copies_attrs(self):
+        archive = self._make_caching(version_cache_size=10)
+        archive.get_version(4, 1).attrs['a'] = 'MUTATED'
+        record = archive.get_version(4, 1)
+        self.assertEqual(record.attrs, {'a': 1, 'b': [2]})
+        record.attrs['a'] = 'MUTATED'
+        self.assertEqual(archive.get_version(4, 1).attrs, {'a': 1, 'b': [2]})
+
+    def test_version_cache_keeps_unicode_attrs(self):
+        import transaction
+        archive = self._make_default()
+        archive.version_cache_size = 10
+        obj = self._make_dummy_object_version()
+        obj.attrs = {'s': u'text', 'l': [u'item']}
+        archive.archive(obj)
+        transaction.commit()
+        miss = archive.get_version(4, 1).attrs
+        hit = archive.get_version(4, 1).attrs
+        self.assertEqual(type(miss['s']), unicode)
+        self.assertEqual(type(hit['s']), unicode)
+        self.assertEqual(type(hit['l'][0]), unicode)
+        self.assertEqual(hit, miss)
+
+    def test_version_cache_detects_recreated_objects(self):
+        import transaction
+        from repozitory.schema import ArchivedGeneration
+        from repozitory.schema import ArchivedState
+        archive = self._make_caching(version_cache_size=10)
+        archive.get_version(4, 1)
+        # Simulate another process shredding and re-creating the object.
+        session = archive.session
+        session.query(ArchivedState).filter_by(docid=4, version_num=1).update(
+            {'title': u'Recreated'}, False)
+        session.query(ArchivedGeneration).filter_by(docid=4).update(
+            {'shred_count': ArchivedGeneration.shred_count + 1}, False)
+        transaction.commit()
+        cache = archive._get_version_cache()
+        hits, misses = cache.hits, cache.misses
+        self.assertEqual(archive.get_version(4, 1).title, u'Recreated')
+        self.assertEqual((cache.hits, cache.misses), (hits, misses + 1))
+        self.assertEqual(archive.get_versions([(4, 1)])[0].title,
+            u'Recreated')
+
+    def test_version_cache_survives_new_versions(self):
+        import transaction
+        archive = self._make_caching(version_cache_size=10)
+        archive.get_version(4, 1)
+        obj = self._make_dummy_object_version()
+        archive.archive(obj)
+        archive.reverted(4, 2)
+        transaction.commit()
+        cache = archive._get_version_cache()
+        hits = cache.hits
+        record = archive.get_version(4, 1)
+        self.assertEqual(cache.hits, hits + 1)
+        self.assertEqual(record.current_version, 2)
+        self.assertEqual(record.attrs, {'a': 1, 'b': [2]})
+
+    def test_version_cache_after_shred(self):
+        import transaction
+        archive = self._make_caching(version_cache_size=10)
+        archive.get_version(4, 1)
+        archive.shred([4])
+        transaction.commit()
+        obj = self._make_dummy_object_version()
+        obj.title = u'Recreated'
+        archive.archive(obj)
+        transaction.commit()
+        self.assertEqual(archive.get_version(4, 1).title, u'Recreated')
+
+    def test_get_versions_uses_cache(self):
+        from repozitory.archive import _get_version_cache
+        archive = self._make_caching(version_cache_size=10)
+        cache = _get_version_cache(10, archive.version_cache_bytes)
+        archive.get_versions([(4, 2)])
+        self.assertEqual(len(cache), 1)
+        records = archive.get_versions([(4, 1), (4, 2), (4, 3)])
+        self.assertEqual([r and r.version_num for r in records], [1, 2, None])
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.hits, 1)
+
+    def test_cached_version_blobs(self):
+        import transaction
+        archive = self._make_default()
+        archive.version_cache_size = 10
+        obj = self._make_dummy_object_version()
+        obj.blobs = {'x': StringIO('abc')}
+        archive.archive(obj)
+        transaction.commit()
+        archive.get_version(4, 1)
+        record = archive.get_version(4, 1, load_blobs=True)
+        self.assertEqual(record.blobs['x'].read(), 'abc')
+        record = archive.get_version(4, 1)
+        self.assertEqual(record.blobs['x'].read(), 'abc')
+
+    def test_version_cache_skips_uncommitted_versions(self):
+        from repozitory.archive import _get_version_cache
+        archive = self._make_default()
+        archive.version_cache_size = 10
+        obj = self._make_dummy_object_version()
+        archive.archive(obj)
+        archive.get_version(4, 1)
+        cache = _get_version_cache(10, archive.version_cache_bytes)
+        self.assertEqual(len(cache), 0)
+
+    def test_version_cache_discards_shredded_objects(self):
+        import transaction
+        from repozitory.archive import _get_version_cache
+        archive = self._make_caching(version_cache_size=10)
+        archive.get_versions([(4, 1), (4, 2)])
+        cache = _get_version_cache(10, archive.version_cache_bytes)
+        self.assertEqual(len(cache), 2)
+        archive.shred([4])
+        self.assertEqual(archive.get_versions([(4, 1)]), [None])
+        transaction.commit()
+        self.assertEqual(len(cache), 0)
+
+    def test_version_cache_byte_limit(self):
+        from repozitory.archive import _get_version_cache
+        archive = self._make_caching(version_cache_size=10)
+        archive.version_cache_bytes = 500
+        archive.get_versions([(4, 1), (4, 2)])
+        cache = _get_version_cache(10, 500)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.evictions, 1)
+
+    def _get_generation(self, archive, docid):
+        from repozitory.schema import ArchivedGeneration
+        return (archive.session.query(ArchivedGeneration.generation)
+            .filter_by(docid=docid)
+            .scalar())
+
+    def test_writes_change_generation(self):
+        archive = self._make_default()
+        obj = self._make_dummy_object_version()
+        self.assertEqual(self._get_generation(archive, 4), None)
+        archive.archive(obj)
+        self.assertEqual(self._get_generation(archive, 4), 1)
+        archive.archive(obj)
+        self.assertEqual(self._get_generation(archive, 4), 2)
+        archive.reverted(4, 1)
+        self.assertEqual(self._get_generation(archive, 4), 3)
+        obj2 = self._make_dummy_object_version()
+        obj2.docid = 5
+        archive.archive_many([obj, obj2])
+        self.assertEqual(self._get_generation(archive, 4), 4)
+        self.assertEqual(self._get_generation(archive, 5), 1)
+        archive.shred([4])
+        self.assertEqual(self._get_generation(archive, 4), 5)
+
+    def test_bump_generations_statements(self):
+        from repozitory.schema import ArchivedGeneration
+        archive = self._make_default()
+        statements = self._count_statements(archive)
+        upsert = archive.session.bind.dialect.name == 'postgresql'
+
+        def bump(docids, **kw):
+            del statements[:]
+            archive._bump_generations(docids, **kw)
+            return len([statement for statement in statements
+                if 'archived_generation' in statement])
+
+        self.assertEqual(bump([7]), 1 if upsert else 2)
+        self.assertEqual(bump([7]), 1)
+        self.assertEqual(bump([7, 8], shredded=True), 1 if upsert else 3)
+        rows = (archive.session.query(ArchivedGeneration)
+            .order_by(ArchivedGeneration.docid)
+            .all())
+        self.assertEqual([(row.docid, row.generation, row.shred_count)
+            for row in rows], [(7, 3, 1), (8, 1, 1)])
+
+    def test_history_cache_copies_attrs(self):
+        archive = self._make_caching(history_cache_size=10)
+        archive.history(4)[0].attrs['a'] = 'MUTATED'
+        records = archive.history(4)
+        self.assertEqual(records[0].attrs, {'a': 2})
+        records[0].attrs['a'] = 'MUTATED'
+        self.assertEqual(archive.history(4)[0].attrs, {'a': 2})
+
+    def test_history_cache_keeps_unicode_attrs(self):
+        import transaction
+        archive = self._make_default()
+        archive.history_cache_size = 10
+        obj = self._make_dummy_object_version()
+        obj.attrs = {'s': u'text'}
+        archive.archive(obj)
+        transaction.commit()
+        miss = archive.history(4)[0].attrs
+        hit = archive.history(4)[0].attrs
+        self.assertEqual(type(miss['s']), unicode)
+        self.assertEqual(type(hit['s']), unicode)
+
+    def test_history_from_cache_checks_generation(self):
+        archive = self._make_caching(history_cache_size=10)
+        statements = self._count_statements(archive)
+        records = archive.history(4)
+        del statements[:]
+        records = archive.history(4)
+        self.assertEqual(len(statements), 1)
+        self.assertTrue('archived_generation' in statements[0])
+        self.assertEqual([r.version_num for r in records], [2, 1])
+        self.assertEqual([r.current_version for r in records], [2, 2])
+        self.assertEqual(records[0].attrs, {'a': 2})
+        self.assertEqual(records[1].klass, DummyObjectVersion)
+        records = archive.history(4, only_current=True)
+        self.assertEqual([r.version_num for r in records], [2])
+
+    def test_history_from_cache_within_check_interval(self):
+        archive = self._make_caching(history_cache_size=10,
+            history_cache_check_interval=60)
+        statements = self._count_statements(archive)
+        archive.history(4)
+        del statements[:]
+        records = archive.history(4)
+        self.assertEqual(statements, [])
+        self.assertEqual([r.version_num for r in records], [2, 1])
+
+    def test_history_cache_invalidated_by_writes(self):
+        import transaction
+        archive = self._make_caching(history_cache_size=10,
+            history_cache_check_interval=60)
+        archive.history(4)
+        archive.reverted(4, 1)
+        # Not cached while the transaction is in progress.
+        records = archive.history(4)
+        self.assertEqual([r.current_version for r in records], [1, 1])
+        transaction.commit()
+        records = archive.history(4)
+        self.assertEqual([r.current_version for r in records], [1, 1])
+        archive.archive(self._make_dummy_object_version())
+        transaction.commit()
+        self.assertEqual([r.version_num for r in archive.history(4)],
+            [3, 2, 1])
+        archive.shred([4])
+        transaction.commit()
+        self.assertEqual(archive.history(4), [])
+
+    def test_history_cache_detects_changes_by_other_processes(self):
+        import transaction
+        from repozitory.schema import ArchivedCurrent
+        from repozitory.schema import ArchivedGeneration
+        archive = self._make_caching(history_cache_size=10)
+        archive.history(4)
+        # Simulate another process reverting the object.
+        session = archive.session
+        session.query(ArchivedCurrent).filter_by(docid=4).update(
+            {'version_num': 1}, False)
+        session.query(ArchivedGeneration).filter_by(docid=4).update(
+            {'generation': ArchivedGeneration.generation + 1}, False)
+        transaction.commit()
+        records = archive.history(4)
+        self.assertEqual([r.current_version for r in records], [1, 1])
+
+    def _archive_at(self, archive, docid, times):
+        from repozitory.schema import ArchivedState
+        obj = self._make_dummy_object_version()
+        obj.docid = docid
+        for when in times:
+            version_num = archive.archive(obj)
+            (archive.session.query(ArchivedState)
+                .filter_by(docid=docid, version_num=version_num)
+                .update({'archive_time': when}, False))
+
+    def test_get_version_at(self):
+        archive = self._make_default()
+        t = datetime.datetime
+        self._archive_at(archive, 4,
+            [t(2012, 1, 1), t(2012, 2, 1), t(2012, 3, 1)])
+        self.assertEqual(archive.get_version_at(4, t(2011, 12, 31)), None)
+        record = archive.get_version_at(4, t(2012, 2, 1))
+        self.assertEqual(record.version_num, 2)
+        self.assertEqual(record.current_version, 3)
+        self.assertEqual(
+            archive.get_version_at(4, t(2012, 2, 15)).version_num, 2)
+        self.assertEqual(
+            archive.get_version_at(4, t(2013, 1, 1)).version_num, 3)
+        self.assertEqual(archive.get_version_at(5, t(2013, 1, 1)), None)
+
+    def test_get_versions_at(self):
+        archive = self._make_default()
+        archive.docid_batch_size = 2
+        statements = self._count_statements(archive)
+        t = datetime.datetime
+        self._archive_at(archive, 4, [t(2012, 1, 1), t(2012, 3, 1)])
+        self._archive_at(archive, 5, [t(2012, 2, 1), t(2012, 2, 1)])
+        self._archive_at(archive, 6, [t(2012, 4, 1)])
+        del statements[:]
+        res = archive.get_versions_at([4, 5, 7], t(2012, 2, 15))
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(dict((docid, record and record.version_num)
+            for (docid, record) in res.items()), {4: 1, 5: 2, 7: None})
+        res = archive.get_versions_at([4, 5, 6], t(2013, 1, 1))
+        self.assertEqual([res[docid].version_num for docid in (4, 5, 6)],
+            [2, 2, 1])
+
+    def test_records_usable_after_commit(self):
+        import transaction
+        archive = self._make_default()
+        archive.attrs_snapshot_interval = 2
+        obj = self._make_dummy_object_version()
+        obj.description = u'Described'
+        archive.archive(obj)
+        obj.attrs = {'a': 2}
+        archive.archive(obj)
+        transaction.commit()
+        records = archive.history(4)
+        record = archive.get_version(4, 1)
+        obj.docid = 5
+        archive.archive(obj)
+        transaction.commit()
+        self.assertEqual([r.description for r in records],
+            [u'Described', u'Described'])
+        self.assertEqual([r.attrs for r in records],
+            [{'a': 2}, {'a': 1, 'b': [2]}])
+        self.assertEqual(records[0].klass, DummyObjectVersion)
+        self.assertEqual(record.description, u'Described')
+        self.assertEqual(record.attrs, {'a': 1, 'b': [2]})
+        self.assertEqual(record.klass, DummyObjectVersion)
+
+    def test_iter_history_summary(self):
+        archive = self._make_default()
+        self._archive_versions(archive, 3, attrs_snapshot_interval=2)
+        records = list(archive.iter_history(4, summary=True))
+        self.assertEqual([r.attrs['n'] for r in records], [3, 2, 1])
+
+    def test_get_version_load_blobs(self):
+        archive = self._make_default()
+        obj = self._make_dummy_object_version()
+        obj.blobs = {'x': StringIO('abc')}
+        archive.archive(obj)
+        record = archive.get_version(4, 1, load_blobs=True)
+        self.assertTrue(record._blobs is not None)
+        self.assertEqual(record.blobs['x'].read(), 'abc')
+
+    def test_read_blob_range_of_compressed_shared_chunks(self):
+        data = 'abc' * 500
+        archive = self._archive_blob(data,
+            chunk_codec='zlib', content_defined_chunking=True)
+        self.assertEqual(archive.read_blob(4, 1, 'x', 1000, 10),
+            data[1000:1010])
+
+    def test_read_blob_range_from_blob_store(self):
+        import shutil
+        import tempfile
+        from repozitory.blobstore import FilesystemBlobStore
+        tempdir = tempfile.mkdtemp()
+        try:
+            data = ''.join(chr(65 + i % 26) for i in range(1000))
+            archive = self._archive_blob(data,
+                blob_store=FilesystemBlobStore(tempdir, fsync=False))
+            self.assertEqual(list(archive.iter_blob(4, 1, 'x', 505, 15)),
+                [data[505:515], data[515:520]])
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_read_blob_not_found(self):
+        from sqlalchemy.orm.exc import NoResultFound
+        archive = self._archive_blob('42')
+        self.assertRaises(NoResultFound, archive.read_blob, 4, 1, 'y')
+
     def test_history_only_current(self):
         archive = self._make_default()
         obj = self._make_dummy_object_version()
@@ -1338,3 +2822,24 @@ class DummyObjectVersion:
 
     def __init__(self, docid):
         self.docid = docid
+
+
+class UnseekableFile(object):
+    """A file that can only be read once, like a WSGI input stream."""
+
+    def __init__(self, data):
+        self._f = StringIO(data)
+        self.reads = 0
+
+    def read(self, size=-1):
+        self.reads += 1
+        return self._f.read(size)
+
+
+class DummyContainerVersion:
+    path = '/my/container'
+
+    def __init__(self, container_id):
+        self.container_id = container_id
+        self.map = {}
+        self.ns_map = {}
@@ -0,0 +1,74 @@
+"""Tests of repozitory.blobstore"""
+
+import os
+import shutil
+import tempfile
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    # Python 2.7+
+    import unittest
+
+
+class FilesystemBlobStoreTest(unittest.TestCase):
+
+    key = 'sha256:abcdef0123456789'
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _make(self, fsync=False):
+        from repozitory.blobstore import FilesystemBlobStore
+        return FilesystemBlobStore(self.dir, fsync=fsync)
+
+    def test_verifyImplements_IBlobStore(self):
+        from zope.interface.verify import verifyClass
+        from repozitory.interfaces import IBlobStore
+        from repozitory.blobstore import FilesystemBlobStore
+        verifyClass(IBlobStore, FilesystemBlobStore)
+
+    def test_path_is_sharded(self):
+        store = self._make()
+        self.assertEqual(store.path(self.key), os.path.join(
+            self.dir, 'sha256', 'ab', 'cd', 'abcdef0123456789'))
+
+    def test_path_rejects_invalid_keys(self):
+        store = self._make()
+        self.assertRaises(ValueError, store.path, 'sha256:../../etc')
+        self.assertRaises(ValueError, store.path, 'abcdef0123456789')
+
+    def test_store_and_open(self):
+        store = self._make(fsync=True)
+        store.store(self.key, iter(['ab', 'cd']))
+        f = store.open(self.key)
+        try:
+            self.assertEqual(f.read(), 'abcd')
+        finally:
+            f.close()
+        # Replace the blob.
+        store.store(self.key, iter(['ef']))
+        f = store.open(self.key)
+        try:
+            self.assertEqual(f.read(), 'ef')
+        finally:
+            f.close()
+
+    def test_store_failure_leaves_no_file(self):
+        def gen():
+            yield 'ab'
+            raise ValueError('broken')
+        store = self._make()
+        self.assertRaises(ValueError, store.store, self.key, gen())
+        dirname = os.path.dirname(store.path(self.key))
+        self.assertEqual(os.listdir(dirname), [])
+
+    def test_delete(self):
+        store = self._make()
+        store.store(self.key, iter(['ab']))
+        store.delete(self.key)
+        self.assertFalse(os.path.exists(store.path(self.key)))
+        store.delete(self.key)
@@ -0,0 +1,109 @@
+"""Tests of repozitory.cache"""
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    # Python 2.7+
+    import unittest
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def _make(self, max_entries=3, max_bytes=100, metric_prefix=None):
+        from repozitory.cache import LRUCache
+        return LRUCache(max_entries, max_bytes, metric_prefix)
+
+    def test_get_and_set(self):
+        cache = self._make()
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('a', 5), 5)
+        cache.set('a', 1, 10)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.size, 10)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_replace(self):
+        cache = self._make()
+        cache.set('a', 1, 10)
+        cache.set('a', 2, 20)
+        self.assertEqual(cache.get('a'), 2)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.size, 20)
+
+    def test_evicts_least_recently_used_entry(self):
+        cache = self._make(max_entries=2)
+        cache.set('a', 1, 1)
+        cache.set('b', 2, 1)
+        cache.get('a')
+        cache.set('c', 3, 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_evicts_to_stay_within_max_bytes(self):
+        cache = self._make(max_entries=10, max_bytes=100)
+        cache.set('a', 1, 40)
+        cache.set('b', 2, 40)
+        cache.set('c', 3, 40)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.size, 80)
+        self.assertEqual(cache.evictions, 1)
+
+    def test_does_not_store_oversized_values(self):
+        cache = self._make(max_bytes=100)
+        cache.set('a', 1, 10)
+        cache.set('b', 2, 101)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+
+    def test_reject(self):
+        cache = self._make()
+        cache.set('a', 1, 10)
+        self.assertEqual(cache.get('a'), 1)
+        cache.reject('a')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+    def test_discard_matching(self):
+        cache = self._make()
+        cache.set(('x', 1), 1, 10)
+        cache.set(('y', 1), 2, 20)
+        cache.set(('x', 2), 3, 30)
+        cache.discard_matching(lambda key: key[0] == 'x')
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.size, 20)
+        self.assertEqual(cache.get(('y', 1)), 2)
+
+    def test_clear(self):
+        cache = self._make()
+        cache.set('a', 1, 10)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_sends_metrics(self):
+        from perfmetrics import statsd_client_stack
+        client = DummyStatsdClient()
+        cache = self._make(max_entries=1, metric_prefix='test.cache')
+        statsd_client_stack.push(client)
+        try:
+            cache.get('a')
+            cache.set('a', 1, 1)
+            cache.get('a')
+            cache.set('b', 2, 1)
+        finally:
+            statsd_client_stack.pop()
+        self.assertEqual(client.counts, [('test.cache.misses', 1),
+            ('test.cache.hits', 1), ('test.cache.evictions', 1)])
+
+
+class DummyStatsdClient(object):
+
+    def __init__(self):
+        self.counts = []
+
+    def incr(self, stat, count=1):
+        self.counts.append((stat, count))
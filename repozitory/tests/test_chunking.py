@@ -0,0 +1,50 @@
+"""Tests of repozitory.chunking"""
+
+import random
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    # Python 2.7+
+    import unittest
+
+
+def random_data(size, seed=42):
+    r = random.Random(seed)
+    return ''.join(chr(r.randrange(256)) for _ in xrange(size))
+
+
+class IterContentChunksTest(unittest.TestCase):
+
+    def _call(self, strings, avg_size=256, **kw):
+        from repozitory.chunking import iter_content_chunks
+        return list(iter_content_chunks(strings, avg_size, **kw))
+
+    def test_empty(self):
+        self.assertEqual(self._call([]), [])
+        self.assertEqual(self._call(['']), [])
+
+    def test_chunk_sizes(self):
+        data = random_data(50000)
+        chunks = self._call([data])
+        self.assertEqual(''.join(chunks), data)
+        for chunk in chunks[:-1]:
+            self.assertTrue(64 <= len(chunk) <= 1024)
+        avg = len(data) / len(chunks)
+        self.assertTrue(128 < avg < 512, avg)
+
+    def test_independent_of_input_pieces(self):
+        data = random_data(20000)
+        pieces = [data[i:i + 77] for i in range(0, len(data), 77)]
+        self.assertEqual(self._call(pieces), self._call([data]))
+
+    def test_boundaries_follow_content(self):
+        data = random_data(20000)
+        chunks = self._call([data])
+        edited = self._call([data[:5000] + 'x' + data[5000:]])
+        shared = set(chunks).intersection(edited)
+        self.assertTrue(len(shared) >= len(chunks) - 3)
+
+    def test_max_size(self):
+        chunks = self._call(['\0' * 5000], min_size=10, max_size=100)
+        self.assertEqual([len(chunk) for chunk in chunks], [100] * 50)
@@ -0,0 +1,53 @@
+"""Tests of repozitory.compression"""
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    # Python 2.7+
+    import unittest
+
+
+class CompressionTest(unittest.TestCase):
+
+    def test_zlib_round_trip(self):
+        from repozitory.compression import compress_chunk
+        from repozitory.compression import decompress_chunk
+        data = 'abc,def\n' * 100
+        codec, stored = compress_chunk('zlib', data)
+        self.assertEqual(codec, 'zlib')
+        self.assertTrue(len(stored) < len(data))
+        self.assertEqual(decompress_chunk(codec, stored), data)
+
+    def test_incompressible_data_is_stored_as_is(self):
+        from repozitory.compression import compress_chunk
+        self.assertEqual(compress_chunk('zlib', 'x'), (None, 'x'))
+
+    def test_uncompressed(self):
+        from repozitory.compression import decompress_chunk
+        self.assertEqual(decompress_chunk(None, 'x'), 'x')
+
+    def test_unknown_codec(self):
+        from repozitory.compression import compress_chunk
+        from repozitory.compression import decompress_chunk
+        self.assertRaises(ValueError, compress_chunk, 'nonesuch', 'x')
+        self.assertRaises(ValueError, decompress_chunk, 'nonesuch', 'x')
+
+    def test_register_codec(self):
+        from repozitory.compression import _codecs
+        from repozitory.compression import compress_chunk
+        from repozitory.compression import decompress_chunk
+        from repozitory.compression import register_codec
+        register_codec('test', lambda data: data[:1], lambda data: data * 3)
+        try:
+            self.assertEqual(compress_chunk('test', 'aaa'), ('test', 'a'))
+            self.assertEqual(decompress_chunk('test', 'a'), 'aaa')
+        finally:
+            del _codecs['test']
+
+    def test_looks_compressed(self):
+        from repozitory.compression import looks_compressed
+        self.assertTrue(looks_compressed('\xff\xd8\xff\xe0\x00\x10JFIF'))
+        self.assertTrue(looks_compressed('PK\x03\x04\x14\x00'))
+        self.assertTrue(looks_compressed('\x00\x00\x00\x18ftypmp42'))
+        self.assertFalse(looks_compressed('<html>'))
+        self.assertFalse(looks_compressed(''))
@@ -0,0 +1,42 @@
+"""Tests of repozitory.delta"""
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    # Python 2.7+
+    import unittest
+
+
+class MakeDeltaTest(unittest.TestCase):
+
+    def _call(self, old, new):
+        from repozitory.delta import make_delta
+        return make_delta(old, new)
+
+    def test_no_change(self):
+        self.assertEqual(self._call({'a': 1}, {'a': 1}), {})
+
+    def test_changes(self):
+        delta = self._call({'a': 1, 'b': 2, 'c': 3}, {'a': 1, 'b': 5, 'd': 4})
+        self.assertEqual(delta, {'set': {'b': 5, 'd': 4}, 'del': ['c']})
+
+
+class ApplyDeltaTest(unittest.TestCase):
+
+    def _call(self, attrs, delta):
+        from repozitory.delta import apply_delta
+        return apply_delta(attrs, delta)
+
+    def test_empty_delta(self):
+        attrs = {'a': 1}
+        res = self._call(attrs, {})
+        self.assertEqual(res, {'a': 1})
+        self.assertFalse(res is attrs)
+
+    def test_changes(self):
+        res = self._call({'a': 1, 'b': 2, 'c': 3},
+            {'set': {'b': 5, 'd': 4}, 'del': ['c']})
+        self.assertEqual(res, {'a': 1, 'b': 5, 'd': 4})
+
+    def test_none(self):
+        self.assertEqual(self._call(None, {'set': {'a': 1}}), {'a': 1})
@@ -0,0 +1,129 @@
+"""Tests of repozitory.staging"""
+
+from StringIO import StringIO
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    # Python 2.7+
+    import unittest
+
+
+class IterBlobDataTest(unittest.TestCase):
+
+    def _call(self, value, chunk_size=3):
+        from repozitory.staging import iter_blob_data
+        return list(iter_blob_data(value, chunk_size))
+
+    def test_seekable_file_is_read_from_start(self):
+        f = StringIO('abcdefg')
+        f.read()
+        self.assertEqual(self._call(f), ['abc', 'def', 'g'])
+
+    def test_unseekable_file(self):
+        f = UnseekableFile('abcd')
+        f.read(1)
+        self.assertEqual(self._call(f), ['bcd'])
+
+    def test_filename(self):
+        import tempfile
+        f = tempfile.NamedTemporaryFile()
+        f.write('abcd')
+        f.flush()
+        self.assertEqual(self._call(f.name), ['abc', 'd'])
+
+    def test_iterable_skips_empty_strings(self):
+        self.assertEqual(self._call(iter(['ab', '', 'cdefg'])),
+            ['ab', 'cdefg'])
+
+
+class StagedBlobTest(unittest.TestCase):
+
+    def _make(self, value, chunk_size=3, spool_size=1024):
+        from repozitory.staging import StagedBlob
+        return StagedBlob(value, chunk_size, spool_size)
+
+    def test_hashes_and_length(self):
+        staged = self._make(StringIO('42'))
+        self.assertEqual(staged.length, 2)
+        self.assertEqual(staged.digests, {
+            'md5': 'a1d0c6e83f027327d8461063f4ac58a6',
+            'sha256': '73475cb40a568e8da8a045ced110137e159f890ac4da883b'
+                '6b17dc651b3a8049',
+        })
+
+    def test_other_algorithm(self):
+        from repozitory.staging import StagedBlob
+        staged = StagedBlob(StringIO('42'), 3, 1024, algorithms=('sha1',))
+        self.assertEqual(staged.digests,
+            {'sha1': '92cfceb39d57d914ed8b14d0e37643de0797ae56'})
+
+    def test_digested_blob_is_verified(self):
+        from repozitory.staging import DigestedBlob
+        staged = self._make(DigestedBlob(StringIO('42'),
+            {'md5': 'A1D0C6E83F027327D8461063F4AC58A6', 'sha1': 'x'}, 2))
+        self.assertEqual(staged.length, 2)
+        self.assertRaises(ValueError, self._make,
+            DigestedBlob(StringIO('43'),
+                {'md5': 'a1d0c6e83f027327d8461063f4ac58a6'}))
+        self.assertRaises(ValueError, self._make,
+            DigestedBlob(StringIO('42'), {}, 3))
+
+    def test_iter_chunks_rechunks_data(self):
+        staged = self._make(iter(['a', 'bcdef', 'gh']))
+        self.assertEqual(list(staged.iter_chunks()), ['abc', 'def', 'gh'])
+        # The staged data can be read again.
+        self.assertEqual(list(staged.iter_chunks()), ['abc', 'def', 'gh'])
+
+    def test_large_blob_is_staged_on_disk(self):
+        staged = self._make(StringIO('x' * 100), spool_size=10)
+        self.assertTrue(staged.file._rolled)
+        self.assertEqual(''.join(staged.iter_chunks()), 'x' * 100)
+
+    def test_close_on_error(self):
+        def gen():
+            yield 'abc'
+            raise ValueError('broken')
+        self.assertRaises(ValueError, self._make, gen())
+
+
+class TrustedBlobTest(unittest.TestCase):
+
+    def _make(self, value, chunk_size=3):
+        from repozitory.staging import TrustedBlob
+        return TrustedBlob(value, chunk_size)
+
+    def test_data_read_on_demand(self):
+        from repozitory.staging import DigestedBlob
+        read = []
+
+        def gen():
+            read.append(True)
+            yield 'ab'
+            yield 'cdefg'
+
+        blob = self._make(DigestedBlob(gen(), {'sha256': 'ABC'}))
+        self.assertEqual(blob.digests, {'sha256': 'abc'})
+        self.assertEqual(blob.length, None)
+        self.assertEqual(read, [])
+        self.assertEqual(list(blob.iter_chunks()), ['abc', 'def', 'g'])
+        self.assertEqual(blob.length, 7)
+
+
+class NewHashTest(unittest.TestCase):
+
+    def test_unsupported(self):
+        from repozitory.staging import new_hash
+        self.assertRaises(ValueError, new_hash, 'nonesuch')
+
+
+class UnseekableFile(object):
+
+    def __init__(self, data):
+        self._f = StringIO(data)
+
+    def read(self, size=-1):
+        return self._f.read(size)
+
+    def seek(self, pos):
+        raise IOError('Illegal seek')
@@ -0,0 +1,163 @@
+"""Tests of repozitory.upgrade"""
+
+import datetime
+import os
+import shutil
+import tempfile
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    # Python 2.7+
+    import unittest
+
+
+class UpgradeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        from sqlalchemy.engine import create_engine
+        self.engine = create_engine(
+            'sqlite:///%s' % os.path.join(self.dir, 'test.db'))
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.dir)
+
+    def _call(self):
+        from repozitory.upgrade import upgrade
+        upgrade(self.engine)
+
+    def _make_1_3_database(self):
+        # Create the tables as repozitory 1.3 did.
+        from repozitory.schema import ArchivedObject
+        from repozitory.schema import Base
+        Base.metadata.create_all(self.engine)
+        conn = self.engine.connect()
+        conn.execute('DROP TABLE archived_object')
+        conn.execute('CREATE TABLE archived_object ('
+            'docid BIGINT NOT NULL PRIMARY KEY, created DATETIME NOT NULL)')
+        conn.execute('DROP TABLE archived_state')
+        conn.execute('CREATE TABLE archived_state ('
+            'docid BIGINT NOT NULL, version_num INTEGER NOT NULL, '
+            'derived_from_version INTEGER, class_id INTEGER NOT NULL, '
+            'path VARCHAR NOT NULL, modified DATETIME NOT NULL, '
+            'title VARCHAR, archive_time DATETIME NOT NULL, '
+            'user VARCHAR NOT NULL, comment VARCHAR, description VARCHAR, '
+            'attrs TEXT, PRIMARY KEY (docid, version_num))')
+        conn.execute(ArchivedObject.__table__.insert(), [
+            {'docid': 4, 'created': datetime.datetime(2011, 4, 6)},
+            {'docid': 5, 'created': datetime.datetime(2011, 4, 6)},
+        ])
+        conn.execute('INSERT INTO archived_class (class_id, module, name) '
+            "VALUES (1, 'm', 'n')")
+        for docid, version_num in [(4, 1), (4, 2), (4, 3), (5, 1)]:
+            conn.execute('INSERT INTO archived_state (docid, version_num, '
+                'class_id, path, modified, archive_time, user) '
+                "VALUES (?, ?, 1, '/', '2011-04-07 00:00:00.000000', "
+                "'2011-04-07 00:00:00.000000', 'u')", docid, version_num)
+        conn.close()
+
+    def test_upgrade_empty_database(self):
+        from repozitory.schema import Base
+        Base.metadata.create_all(self.engine)
+        self._call()
+        from repozitory.upgrade import column_names
+        from repozitory.schema import ArchivedObject
+        conn = self.engine.connect()
+        self.assertTrue('latest_version' in
+            column_names(conn, ArchivedObject.__table__))
+        conn.close()
+
+    def test_upgrade_adds_latest_version(self):
+        self._make_1_3_database()
+        self._call()
+        conn = self.engine.connect()
+        rows = conn.execute('SELECT docid, latest_version '
+            'FROM archived_object ORDER BY docid').fetchall()
+        conn.close()
+        self.assertEqual([tuple(row) for row in rows], [(4, 3), (5, 1)])
+
+    def test_upgrade_twice(self):
+        self._make_1_3_database()
+        self._call()
+        self._call()
+        conn = self.engine.connect()
+        rows = conn.execute('SELECT docid, latest_version '
+            'FROM archived_object ORDER BY docid').fetchall()
+        conn.close()
+        self.assertEqual([tuple(row) for row in rows], [(4, 3), (5, 1)])
+
+    def test_upgrade_adds_fingerprint(self):
+        self._make_1_3_database()
+        self._call()
+        from repozitory.upgrade import column_names
+        from repozitory.schema import ArchivedState
+        conn = self.engine.connect()
+        self.assertTrue('fingerprint' in
+            column_names(conn, ArchivedState.__table__))
+        conn.close()
+
+    def test_upgrade_adds_archive_time_index(self):
+        self._make_1_3_database()
+        from repozitory.upgrade import index_names
+        from repozitory.schema import ArchivedState
+        conn = self.engine.connect()
+        self.assertFalse('ix_archived_state_docid_archive_time' in
+            index_names(conn, ArchivedState.__table__))
+        conn.close()
+        self._call()
+        self._call()
+        conn = self.engine.connect()
+        self.assertTrue('ix_archived_state_docid_archive_time' in
+            index_names(conn, ArchivedState.__table__))
+        conn.close()
+
+    def test_upgrade_adds_chunk_codec(self):
+        self._make_1_3_database()
+        conn = self.engine.connect()
+        conn.execute('DROP TABLE archived_chunk')
+        conn.execute('CREATE TABLE archived_chunk ('
+            'blob_id INTEGER NOT NULL, chunk_index INTEGER NOT NULL, '
+            'chunk_length INTEGER NOT NULL, data BLOB NOT NULL, '
+            'PRIMARY KEY (blob_id, chunk_index))')
+        conn.close()
+        self._call()
+        from repozitory.upgrade import column_names
+        from repozitory.schema import ArchivedChunk
+        conn = self.engine.connect()
+        self.assertTrue('codec' in
+            column_names(conn, ArchivedChunk.__table__))
+        conn.close()
+
+    def test_upgrade_allows_blobs_without_md5(self):
+        self._make_1_3_database()
+        conn = self.engine.connect()
+        conn.execute('DROP TABLE archived_blob_info')
+        conn.execute('CREATE TABLE archived_blob_info ('
+            'blob_id INTEGER NOT NULL PRIMARY KEY, '
+            'chunk_count INTEGER NOT NULL, length BIGINT NOT NULL, '
+            'md5 VARCHAR NOT NULL, sha256 VARCHAR NOT NULL)')
+        conn.execute('INSERT INTO archived_blob_info '
+            "VALUES (3, 1, 2, 'm', 's')")
+        conn.close()
+        self._call()
+
+        from repozitory.schema import ArchivedBlobInfo
+        from repozitory.upgrade import column_nullable
+        conn = self.engine.connect()
+        table = ArchivedBlobInfo.__table__
+        self.assertTrue(column_nullable(conn, table.c.md5))
+        self.assertTrue(column_nullable(conn, table.c.sha256))
+        conn.execute(table.insert(), {'blob_id': 4, 'chunk_count': 0,
+            'length': 0, 'digest': 'sha1:x'})
+        rows = conn.execute('SELECT blob_id, md5, digest '
+            'FROM archived_blob_info ORDER BY blob_id').fetchall()
+        self.assertEqual([tuple(row) for row in rows],
+            [(3, 'm', None), (4, None, 'sha1:x')])
+        indexes = conn.execute("SELECT name FROM sqlite_master "
+            "WHERE type = 'index' AND tbl_name = 'archived_blob_info' "
+            "ORDER BY name").fetchall()
+        self.assertEqual([row[0] for row in indexes], [
+            'ix_archived_blob_info_digest', 'ix_archived_blob_info_md5'])
+        conn.close()
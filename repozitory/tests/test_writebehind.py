@@ -0,0 +1,201 @@
+"""Tests of repozitory.writebehind"""
+
+from StringIO import StringIO
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    # Python 2.7+
+    import unittest
+
+
+class QueuedArchiverTest(unittest.TestCase):
+
+    def setUp(self):
+        import transaction
+        transaction.abort()
+        self.archivers = []
+
+    def tearDown(self):
+        import transaction
+        transaction.abort()
+        for archiver in self.archivers:
+            archiver.close(1)
+
+    def _make(self, archive, *args, **kw):
+        from repozitory.writebehind import QueuedArchiver
+        archiver = QueuedArchiver(archive, *args, **kw)
+        self.archivers.append(archiver)
+        return archiver
+
+    def test_archive_after_commit(self):
+        import transaction
+        archive = DummyArchive()
+        archiver = self._make(archive)
+        obj = DummyObjectVersion(4)
+        self.assertEqual(archiver.archive(obj), None)
+        obj.title = u'Changed'
+        self.assertEqual(archive.archived, [])
+        transaction.commit()
+        self.assertTrue(archiver.wait_for(4, 5))
+        self.assertEqual(len(archive.archived), 1)
+        snapshot = archive.archived[0]
+        self.assertEqual(snapshot.docid, 4)
+        self.assertEqual(snapshot.title, u'Changed')
+        self.assertEqual(snapshot.klass, DummyObjectVersion)
+        self.assertEqual(archive.committed, [True])
+        self.assertEqual(archiver.failures, 0)
+
+    def test_abort_discards(self):
+        import transaction
+        archive = DummyArchive()
+        archiver = self._make(archive, maxsize=1, timeout=0)
+        archiver.archive(DummyObjectVersion(4))
+        transaction.abort()
+        self.assertTrue(archiver.flush(5))
+        self.assertEqual(archive.archived, [])
+
+    def test_failed_commit_releases_room(self):
+        import transaction
+        archive = DummyArchive()
+        archiver = self._make(archive, maxsize=1, timeout=0)
+        archiver.archive(DummyObjectVersion(4))
+        txn = transaction.get()
+        txn.addBeforeCommitHook(fail)
+        self.assertRaises(ValueError, txn.commit)
+        transaction.abort()
+        archiver.archive(DummyObjectVersion(5))
+        transaction.commit()
+        self.assertTrue(archiver.flush(5))
+        self.assertEqual([obj.docid for obj in archive.archived], [5])
+
+    def test_backpressure(self):
+        import transaction
+        from Queue import Full
+        archive = DummyArchive()
+        archive.gate.clear()
+        archiver = self._make(archive, maxsize=1, timeout=0.01)
+        archiver.archive(DummyObjectVersion(4))
+        transaction.commit()
+        archiver.archive(DummyObjectVersion(5))
+        self.assertRaises(Full, transaction.commit)
+        transaction.abort()
+        self.assertFalse(archiver.wait_for(4, 0.01))
+        self.assertTrue(archiver.wait_for(5, 0.01))
+        archive.gate.set()
+        self.assertTrue(archiver.wait_for(4, 5))
+        self.assertEqual([obj.docid for obj in archive.archived], [4])
+
+    def test_failure_is_counted(self):
+        import transaction
+        archive = DummyArchive()
+        archive.error = ValueError('broken')
+        archiver = self._make(archive)
+        archiver.archive(DummyObjectVersion(4))
+        transaction.commit()
+        self.assertTrue(archiver.wait_for(4, 5))
+        self.assertEqual(archiver.failures, 1)
+        self.assertEqual(archive.committed, [False])
+
+    def test_copies_blobs(self):
+        import transaction
+        archive = DummyArchive()
+        archiver = self._make(archive)
+        obj = DummyObjectVersion(4)
+        f = StringIO('abc')
+        f.read()
+        obj.blobs = {u'x': f}
+        archiver.archive(obj)
+        transaction.commit()
+        f.seek(0)
+        f.truncate()
+        self.assertTrue(archiver.flush(5))
+        self.assertEqual(archive.blob_data, [{u'x': 'abc'}])
+
+    def test_close(self):
+        import transaction
+        archive = DummyArchive()
+        archiver = self._make(archive)
+        archiver.archive(DummyObjectVersion(4))
+        transaction.commit()
+        self.assertTrue(archiver.close(5))
+        self.assertEqual(len(archive.archived), 1)
+        self.assertFalse(archiver._thread.isAlive())
+        self.assertRaises(ValueError, archiver.archive,
+            DummyObjectVersion(5))
+        self.assertTrue(archiver.close())
+
+    def test_with_real_archive(self):
+        import transaction
+        from repozitory.archive import Archive
+        from repozitory.archive import EngineParams
+        from repozitory.archive import forget_sessions
+        tempdir = tempfile.mkdtemp()
+        try:
+            archive = Archive(EngineParams(
+                'sqlite:///%s' % os.path.join(tempdir, 'test.db')))
+            archiver = self._make(archive)
+            obj = DummyObjectVersion(4)
+            obj.blobs = {u'x': StringIO('abc')}
+            archiver.archive(obj)
+            archiver.archive(obj)
+            transaction.commit()
+            self.assertTrue(archiver.close(5))
+            self.assertEqual(archiver.failures, 0)
+            records = archive.history(4)
+            self.assertEqual([r.version_num for r in records], [2, 1])
+            self.assertEqual(records[0].blobs[u'x'].read(), 'abc')
+            transaction.abort()
+        finally:
+            forget_sessions()
+            shutil.rmtree(tempdir)
+
+
+def fail():
+    raise ValueError('commit failed')
+
+
+class DummyArchive(object):
+
+    error = None
+
+    def __init__(self):
+        self.archived = []
+        self.committed = []
+        self.blob_data = []
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def archive(self, obj):
+        import transaction
+        transaction.get().addAfterCommitHook(self.committed.append)
+        transaction.get().addAfterAbortHook(self.aborted)
+        self.gate.wait()
+        if self.error is not None:
+            raise self.error
+        self.archived.append(obj)
+        self.blob_data.append(
+            dict((name, f.read()) for (name, f) in obj.blobs.items()))
+
+    def aborted(self, *args):
+        self.committed.append(False)
+
+
+class DummyObjectVersion:
+    path = '/my/object'
+    created = datetime.datetime(2011, 4, 6)
+    modified = datetime.datetime(2011, 4, 7)
+    title = u'Cool Object'
+    description = None
+    attrs = {'a': 1, 'b': [2]}
+    blobs = None
+    user = 'tester'
+    comment = None
+
+    def __init__(self, docid):
+        self.docid = docid
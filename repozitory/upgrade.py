@@ -0,0 +1,166 @@
+
+from repozitory.schema import ArchivedBlobInfo
+from repozitory.schema import ArchivedChunk
+from repozitory.schema import ArchivedObject
+from repozitory.schema import ArchivedState
+from sqlalchemy import func
+from sqlalchemy.engine.reflection import Inspector
+from sqlalchemy.schema import MetaData
+from sqlalchemy.schema import Table
+from sqlalchemy.sql.expression import select
+from sqlalchemy.sql.expression import text
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def upgrade(engine):
+    """Upgrade a database created by an older version of repozitory.
+
+    Adds the columns that did not exist in older versions and fills them
+    in.  Does nothing if the database is already up to date.
+    """
+    conn = engine.connect()
+    try:
+        trans = conn.begin()
+        try:
+            _upgrade(conn)
+        except:
+            trans.rollback()
+            raise
+        else:
+            trans.commit()
+    finally:
+        conn.close()
+
+
+def _upgrade(conn):
+    obj_t = ArchivedObject.__table__
+    state_t = ArchivedState.__table__
+
+    if 'latest_version' not in column_names(conn, obj_t):
+        add_column(conn, obj_t.c.latest_version)
+        latest = (select([func.max(state_t.c.version_num)])
+            .where(state_t.c.docid == obj_t.c.docid)
+            .as_scalar())
+        conn.execute(obj_t.update().values(latest_version=latest))
+
+    state_columns = column_names(conn, state_t)
+    for name in ('fingerprint', 'attrs_base', 'attrs_delta'):
+        if name not in state_columns:
+            add_column(conn, state_t.c[name])
+    state_indexes = index_names(conn, state_t)
+    for index in state_t.indexes:
+        if index.name == 'ix_archived_state_docid_archive_time':
+            if index.name not in state_indexes:
+                log.warning("Adding index %s", index.name)
+                index.create(conn)
+
+    blob_t = ArchivedBlobInfo.__table__
+    blob_columns = column_names(conn, blob_t)
+    if 'digest' not in blob_columns:
+        add_column(conn, blob_t.c.digest)
+        for index in blob_t.indexes:
+            if 'digest' in index.columns:
+                index.create(conn)
+    if 'storage' not in blob_columns:
+        add_column(conn, blob_t.c.storage)
+    chunk_t = ArchivedChunk.__table__
+    if 'codec' not in column_names(conn, chunk_t):
+        add_column(conn, chunk_t.c.codec)
+
+    # md5 and sha256 are not computed when blobs are matched by digest.
+    for name in ('md5', 'sha256'):
+        column = blob_t.c[name]
+        if not column_nullable(conn, column):
+            drop_not_null(conn, column)
+
+
+def column_names(conn, table):
+    """Get the names of the columns that exist in a database table."""
+    preparer = conn.dialect.identifier_preparer
+    res = conn.execute('SELECT * FROM %s WHERE 1 = 0' %
+        preparer.format_table(table))
+    try:
+        return set(res.keys())
+    finally:
+        res.close()
+
+
+def index_names(conn, table):
+    """Get the names of the indexes that exist on a database table."""
+    return set(index['name']
+        for index in Inspector.from_engine(conn).get_indexes(table.name))
+
+
+def add_column(conn, column):
+    """Add a nullable column to an existing table."""
+    dialect = conn.dialect
+    preparer = dialect.identifier_preparer
+    log.warning("Adding column %s.%s", column.table.name, column.name)
+    conn.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+        preparer.format_table(column.table),
+        preparer.format_column(column),
+        column.type.compile(dialect=dialect),
+    ))
+
+
+def column_nullable(conn, column):
+    """Return True if a database column accepts nulls."""
+    if conn.dialect.name == 'sqlite':
+        preparer = conn.dialect.identifier_preparer
+        rows = conn.execute('PRAGMA table_info(%s)' %
+            preparer.format_table(column.table)).fetchall()
+        for row in rows:
+            if row[1] == column.name:
+                return not row[3]
+        return True
+    row = conn.execute(text(
+        'SELECT is_nullable FROM information_schema.columns '
+        'WHERE table_name = :table AND column_name = :column'),
+        table=column.table.name, column=column.name).first()
+    return row is None or row[0] == 'YES'
+
+
+def drop_not_null(conn, column):
+    """Allow nulls in an existing column."""
+    preparer = conn.dialect.identifier_preparer
+    log.warning("Allowing nulls in column %s.%s",
+        column.table.name, column.name)
+    if conn.dialect.name == 'sqlite':
+        # SQLite can not alter columns.  Rebuild the table instead.
+        rebuild_sqlite_table(conn, column.table)
+        return
+    conn.execute('ALTER TABLE %s ALTER COLUMN %s DROP NOT NULL' % (
+        preparer.format_table(column.table),
+        preparer.format_column(column),
+    ))
+
+
+def rebuild_sqlite_table(conn, table):
+    """Recreate a SQLite table to match the schema, keeping the rows.
+
+    The columns of the existing table must be a subset of the columns
+    in the schema.
+    """
+    preparer = conn.dialect.identifier_preparer
+    names = [column.name for column in table.columns
+        if column.name in column_names(conn, table)]
+    new_name = table.name + '_new'
+    columns = []
+    for column in table.columns:
+        column = column.copy()
+        column.index = False
+        columns.append(column)
+    new_table = Table(new_name, MetaData(), *columns)
+    new_table.create(conn)
+    column_list = ', '.join(preparer.quote_identifier(name)
+        for name in names)
+    conn.execute('INSERT INTO %s (%s) SELECT %s FROM %s' % (
+        preparer.format_table(new_table), column_list, column_list,
+        preparer.format_table(table)))
+    conn.execute('DROP TABLE %s' % preparer.format_table(table))
+    conn.execute('ALTER TABLE %s RENAME TO %s' % (
+        preparer.format_table(new_table), preparer.format_table(table)))
+    for index in table.indexes:
+        index.create(conn)
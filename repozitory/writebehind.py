@@ -0,0 +1,251 @@
+
+from Queue import Full
+from Queue import Queue
+from repozitory.interfaces import IObjectVersion
+from repozitory.staging import DigestedBlob
+from repozitory.staging import iter_blob_data
+from zope.interface import implements
+import atexit
+import copy
+import logging
+import tempfile
+import threading
+import time
+import transaction
+
+log = logging.getLogger(__name__)
+
+_stop = object()  # Tells the worker thread to stop.
+
+
+class QueuedArchiver(object):
+    """Archives objects on a worker thread after transactions commit.
+
+    Call the archive method of this object instead of Archive.archive()
+    to keep archiving out of the request.  When the current transaction
+    commits, the object versions are captured and queued; a worker
+    thread then archives them with its own session and transaction.
+    Versions of the same object are archived in the order they were
+    committed.
+
+    No more than maxsize versions may be waiting at a time.  When the
+    queue is full, committing waits up to timeout seconds (forever if
+    timeout is None) for room, then fails with Queue.Full.
+
+    Note that versions still in the queue are lost if the process
+    crashes; call close() (done automatically at exit) or wait_for()
+    when durability matters.
+    """
+
+    _spool_size = 1048576  # Blobs larger than this are spooled to disk.
+
+    def __init__(self, archive, maxsize=100, timeout=None):
+        self._archive = archive
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.failures = 0  # Number of versions that could not be archived
+        self._queue = Queue()
+        self._cond = threading.Condition()
+        self._reserved = 0  # Versions captured or queued but not finished
+        self._pending = {}  # {docid: number of queued versions}
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name='repozitory.writebehind')
+        self._thread.setDaemon(True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def archive(self, obj):
+        """Archive an object when the current transaction commits.
+
+        The obj parameter must provide IObjectVersion.  Its data is
+        captured as the transaction commits, so changes made to obj
+        after this call and before the commit are included.
+
+        Returns None, since the version number is not yet known.
+        """
+        if self._closed:
+            raise ValueError("QueuedArchiver is closed")
+        txn = transaction.get()
+        snapshots = []
+        txn.addBeforeCommitHook(self._capture, (obj, snapshots))
+        txn.addAfterCommitHook(self._committed, (snapshots,))
+        txn.addAfterAbortHook(self._aborted, (snapshots,))
+
+    def _capture(self, obj, snapshots):
+        """Reserve room in the queue and copy the object version."""
+        cond = self._cond
+        cond.acquire()
+        try:
+            if self.timeout is not None:
+                deadline = time.time() + self.timeout
+            while self._reserved >= self.maxsize:
+                if self.timeout is None:
+                    cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise Full("The archive queue is full")
+                    cond.wait(remaining)
+            self._reserved += 1
+        finally:
+            cond.release()
+        try:
+            snapshot = ObjectVersionSnapshot(obj, self._spool_size)
+        except:
+            self._aborted([None])
+            raise
+        snapshots.append(snapshot)
+
+    def _committed(self, success, snapshots):
+        if not success:
+            self._aborted(snapshots)
+            return
+        cond = self._cond
+        cond.acquire()
+        try:
+            for snapshot in snapshots:
+                docid = snapshot.docid
+                self._pending[docid] = self._pending.get(docid, 0) + 1
+                self._queue.put(snapshot)
+            del snapshots[:]
+        finally:
+            cond.release()
+
+    def _aborted(self, snapshots):
+        """Release the room reserved by snapshots that won't be queued."""
+        cond = self._cond
+        cond.acquire()
+        try:
+            for snapshot in snapshots:
+                self._reserved -= 1
+                if snapshot is not None:
+                    snapshot.close()
+            del snapshots[:]
+            cond.notifyAll()
+        finally:
+            cond.release()
+
+    def _run(self):
+        """Archive queued versions until told to stop."""
+        archive = self._archive
+        while True:
+            snapshot = self._queue.get()
+            if snapshot is _stop:
+                break
+            try:
+                txn = transaction.begin()
+                try:
+                    archive.archive(snapshot)
+                    txn.commit()
+                except Exception:
+                    txn.abort()
+                    self.failures += 1
+                    log.exception("Unable to archive docid %s",
+                        snapshot.docid)
+            finally:
+                snapshot.close()
+                self._finished(snapshot.docid)
+
+    def _finished(self, docid):
+        cond = self._cond
+        cond.acquire()
+        try:
+            self._reserved -= 1
+            count = self._pending[docid] - 1
+            if count:
+                self._pending[docid] = count
+            else:
+                del self._pending[docid]
+            cond.notifyAll()
+        finally:
+            cond.release()
+
+    def _wait(self, done, timeout):
+        cond = self._cond
+        cond.acquire()
+        try:
+            if timeout is not None:
+                deadline = time.time() + timeout
+            while not done():
+                if timeout is None:
+                    cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    cond.wait(remaining)
+            return True
+        finally:
+            cond.release()
+
+    def wait_for(self, docid, timeout=None):
+        """Wait until the committed versions of an object are archived.
+
+        Returns True when no committed versions of the object remain in
+        the queue, or False if the timeout (in seconds) expires first.
+        Check the failures counter to find out whether archiving failed.
+        """
+        return self._wait(lambda: docid not in self._pending, timeout)
+
+    def flush(self, timeout=None):
+        """Wait until all committed versions are archived.
+
+        Returns False if the timeout (in seconds) expires first.
+        """
+        return self._wait(lambda: not self._pending, timeout)
+
+    def close(self, timeout=None):
+        """Archive the committed versions, then stop the worker thread.
+
+        Returns False if the timeout expires before the queue is empty.
+        """
+        if self._closed:
+            return True
+        self._closed = True
+        res = self.flush(timeout)
+        self._queue.put(_stop)
+        if res:
+            self._thread.join(timeout)
+        return res
+
+
+class ObjectVersionSnapshot(object):
+    """A copy of an IObjectVersion, including copies of its blobs."""
+    implements(IObjectVersion)
+
+    def __init__(self, obj, spool_size):
+        self.docid = obj.docid
+        self.title = obj.title
+        self.description = obj.description
+        self.created = obj.created
+        self.modified = obj.modified
+        self.path = obj.path
+        self.attrs = copy.deepcopy(obj.attrs)
+        self.user = obj.user
+        self.comment = obj.comment
+        klass = getattr(obj, 'klass', None)
+        if klass is None:
+            klass = obj.__class__
+        self.klass = klass
+
+        self.blobs = {}
+        blobs = getattr(obj, 'blobs', None)
+        if blobs:
+            for name, value in blobs.items():
+                self.blobs[name] = self._copy_blob(value, spool_size)
+
+    def _copy_blob(self, value, spool_size):
+        copy_f = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        for data in iter_blob_data(value, spool_size):
+            copy_f.write(data)
+        copy_f.seek(0)
+        if isinstance(value, DigestedBlob):
+            return DigestedBlob(copy_f, value.digests, value.length)
+        return copy_f
+
+    def close(self):
+        for f in self.blobs.values():
+            if isinstance(f, DigestedBlob):
+                f = f.data
+            f.close()
@@ -29,6 +29,7 @@ setup(
         'psycopg2',
         'simplejson',
         'SQLAlchemy>=0.7.1',
+        'transaction>=3.0',
         'zope.interface',
         'zope.schema',
         'zope.sqlalchemy',